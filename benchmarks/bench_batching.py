@@ -0,0 +1,62 @@
+"""まとめ処理 (analyze_images) のスループット比較ベンチマーク
+
+1枚ずつの analyze_image と、チャンク/バッチサイズを変えた analyze_images で
+同じ画像列を解析し、段階ごとの枚数/秒と結果の一致を表示する (キャッシュ無効)。
+顔の写った実写フォルダで評価すること。
+
+使い方:
+    PYTHONPATH=src python3 benchmarks/bench_batching.py --folder path/to/photos --chunk 4 16 --batch-size 8 32
+"""
+import argparse
+import itertools
+import sys
+import time
+
+import numpy as np
+
+from twins_recognition.cli import collect_images
+from twins_recognition.batch import analyze_one
+from twins_recognition.processor import AnalyzeOptions, analyze_images
+from twins_recognition.stats import StageStats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="まとめ処理ベンチマーク")
+    parser.add_argument("--folder", type=str, required=True, help="評価画像フォルダ")
+    parser.add_argument("--chunk", type=int, nargs="+", default=[4, 16], help="まとめる画像枚数")
+    parser.add_argument("--batch-size", type=int, nargs="+", default=[8, 32])
+    parser.add_argument("--model", choices=["hog", "cnn"], default="hog")
+    parser.add_argument("--max-side", type=int, default=None)
+    args = parser.parse_args()
+
+    paths = collect_images(args.folder)
+    if not paths:
+        print("画像がありません", file=sys.stderr)
+        return 1
+
+    base_opts = AnalyzeOptions(model=args.model, max_side=args.max_side)
+    t0 = time.perf_counter()
+    base = [analyze_one(p, base_opts)[0] for p in paths]
+    base_t = time.perf_counter() - t0
+    print(f"# {len(paths)} images, faces={sum(len(a.faces) for a in base if a is not None)}")
+    print("chunk\tbatch\timages/s\tspeedup\tmax_diff\tstages (images/s)")
+    print(f"1\t-\t{len(paths)/base_t:.2f}\t1.00x\t0\t-")
+    for chunk, bs in itertools.product(args.chunk, args.batch_size):
+        opts = AnalyzeOptions(model=args.model, max_side=args.max_side, batch_size=bs)
+        stats = StageStats()
+        t0 = time.perf_counter()
+        results = []
+        for i in range(0, len(paths), chunk):
+            results.extend(analyze_images(paths[i:i + chunk], opts, stats))
+        t = time.perf_counter() - t0
+        diff = 0.0
+        for a, (b, _) in zip(base, results):
+            if a is not None and b is not None and len(a.embeddings) and len(a.embeddings) == len(b.embeddings):
+                diff = max(diff, float(np.abs(a.embeddings - b.embeddings).max()))
+        rates = " ".join(f"{n}={d['images_per_sec']}" for n, d in stats.to_dict()["stages"].items())
+        print(f"{chunk}\t{bs}\t{len(paths)/t:.2f}\t{base_t/t:.2f}x\t{diff:.2g}\t{rates}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,62 @@
+"""classify_embeddings マイクロベンチマーク
+
+変更前の純Python実装 (ジェネレータによる距離計算を O(n^2) 回) と
+現行の距離行列ベクトル化版を 2 / 10 / 200 顔で比較する。
+
+使い方:
+    PYTHONPATH=src python3 benchmarks/bench_classifier.py
+"""
+import argparse
+import math
+import timeit
+
+import numpy as np
+
+from twins_recognition.classifier import classify_embeddings
+
+
+def legacy_euclidean_distance(vec1, vec2):
+    return math.sqrt(sum((a - b) ** 2 for a, b in zip(vec1, vec2)))
+
+
+def legacy_classify(embeddings):
+    # 変更前の実装: 全組合せを Python ループで比較
+    min_dist = float("inf")
+    for i in range(len(embeddings)):
+        for j in range(i + 1, len(embeddings)):
+            d = legacy_euclidean_distance(embeddings[i], embeddings[j])
+            if d < min_dist:
+                min_dist = d
+    return min_dist
+
+
+def bench(fn, arg, repeat: int) -> float:
+    number = 1
+    # 1回あたり 0.2 秒程度になるよう回数を決める
+    while True:
+        t = timeit.timeit(lambda: fn(arg), number=number)
+        if t > 0.2 or number >= 1 << 20:
+            break
+        number *= 2
+    best = min(timeit.repeat(lambda: fn(arg), number=number, repeat=repeat))
+    return best / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description="classify_embeddings ベンチマーク")
+    parser.add_argument("--faces", type=int, nargs="+", default=[2, 10, 200])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print("faces\tlegacy_us\tvector_us\tspeedup")
+    for n in args.faces:
+        arr = rng.normal(scale=0.1, size=(n, 128)).astype(np.float32)
+        as_lists = [list(map(float, e)) for e in arr]  # 変更前の face_embeddings 出力形式
+        legacy = bench(legacy_classify, as_lists, args.repeat)
+        vector = bench(classify_embeddings, arr, args.repeat)
+        print(f"{n}\t{legacy*1e6:.1f}\t{vector*1e6:.1f}\t{legacy/vector:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
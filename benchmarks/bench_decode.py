@@ -0,0 +1,96 @@
+"""画像デコード回数とウォールタイムの比較ベンチマーク
+
+旧パイプライン (load_image + detect_faces(path) で2回デコード) と
+現行の analyze_image (1回デコード) を同じフォルダで比較する。
+
+使い方:
+    PYTHONPATH=src python3 benchmarks/bench_decode.py --folder path/to/jpegs
+    PYTHONPATH=src python3 benchmarks/bench_decode.py --generate 8 --size 6000x4000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import face_recognition  # type: ignore
+
+from twins_recognition import detector, processor
+from twins_recognition.cli import collect_images
+from twins_recognition.classifier import classify_embeddings
+from twins_recognition.embedding import face_embeddings
+
+
+class DecodeCounter:
+    """face_recognition.load_image_file をラップしてデコード回数を数える。"""
+
+    def __init__(self):
+        self.count = 0
+        self._orig = face_recognition.load_image_file
+
+    def __enter__(self):
+        def counted(*args, **kwargs):
+            self.count += 1
+            return self._orig(*args, **kwargs)
+        face_recognition.load_image_file = counted
+        return self
+
+    def __exit__(self, *exc):
+        face_recognition.load_image_file = self._orig
+
+
+def legacy_analyze(path: str):
+    # 変更前の processor.analyze_image と同じ処理順
+    img = detector.load_image(path)
+    faces = detector.detect_faces(path)
+    embeddings = face_embeddings(img, faces) if len(faces) > 0 else []
+    return classify_embeddings(embeddings)
+
+
+def generate_jpegs(folder: str, n: int, size: str):
+    from PIL import Image
+    w, h = (int(v) for v in size.lower().split("x"))
+    for i in range(n):
+        # ノイズ画像はJPEGデコード負荷が実写に近くなる
+        im = Image.effect_noise((w, h), 64).convert("RGB")
+        im.save(os.path.join(folder, f"bench_{i:03d}.jpg"), quality=90)
+
+
+def run(label: str, fn, paths):
+    with DecodeCounter() as dc:
+        t0 = time.perf_counter()
+        for p in paths:
+            fn(p)
+        elapsed = time.perf_counter() - t0
+    print(f"{label}\tdecodes={dc.count}\twall={elapsed:.2f}s\tper_image={elapsed/max(len(paths),1)*1000:.1f}ms")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="デコード回数ベンチマーク")
+    parser.add_argument("--folder", type=str, default=None, help="JPEGフォルダ (省略時は一時生成)")
+    parser.add_argument("--generate", type=int, default=4, help="生成する画像枚数")
+    parser.add_argument("--size", type=str, default="6000x4000", help="生成画像サイズ WxH")
+    args = parser.parse_args()
+
+    tmp = None
+    folder = args.folder
+    if folder is None:
+        tmp = tempfile.TemporaryDirectory(prefix="twins_bench_")
+        folder = tmp.name
+        generate_jpegs(folder, args.generate, args.size)
+    paths = collect_images(folder)
+    if not paths:
+        print("画像がありません", file=sys.stderr)
+        return 1
+    print(f"# {len(paths)} images in {folder}")
+    legacy = run("legacy", legacy_analyze, paths)
+    single = run("single", processor.analyze_image, paths)
+    print(f"speedup: {legacy/single:.2f}x")
+    if tmp is not None:
+        tmp.cleanup()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,78 @@
+"""縮小検出 (--max-side) の精度/レイテンシ比較ベンチマーク
+
+原寸での検出結果を基準に、各 max_side での検出数・一致率 (IoU >= 0.5)・
+1枚あたりの検出時間を表示する。実写フォルダで評価すること
+(--folder 省略時はノイズ画像を生成するので時間の比較のみ)。
+
+使い方:
+    PYTHONPATH=src python3 benchmarks/bench_downscale.py --folder path/to/photos --max-side 1600 1024 640
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+from twins_recognition.cli import collect_images
+from twins_recognition.detector import detect_faces_in_image, iou, load_image
+
+
+def match_count(base, found, thresh: float = 0.5) -> int:
+    used = set()
+    n = 0
+    for b in base:
+        for i, f in enumerate(found):
+            if i not in used and iou(b, f) >= thresh:
+                used.add(i)
+                n += 1
+                break
+    return n
+
+
+def main():
+    parser = argparse.ArgumentParser(description="縮小検出ベンチマーク")
+    parser.add_argument("--folder", type=str, default=None, help="評価画像フォルダ")
+    parser.add_argument("--max-side", type=int, nargs="+", default=[1600, 1024, 640])
+    parser.add_argument("--upsample", type=int, default=1)
+    parser.add_argument("--generate", type=int, default=3, help="--folder 省略時に生成する枚数")
+    parser.add_argument("--size", type=str, default="6000x4000", help="生成画像サイズ WxH")
+    args = parser.parse_args()
+
+    tmp = None
+    folder = args.folder
+    if folder is None:
+        from PIL import Image
+        tmp = tempfile.TemporaryDirectory(prefix="twins_bench_")
+        folder = tmp.name
+        w, h = (int(v) for v in args.size.lower().split("x"))
+        for i in range(args.generate):
+            Image.effect_noise((w, h), 64).convert("RGB").save(os.path.join(folder, f"bench_{i:03d}.jpg"))
+    paths = collect_images(folder)
+    if not paths:
+        print("画像がありません", file=sys.stderr)
+        return 1
+    images = [load_image(p) for p in paths]
+
+    def run(max_side):
+        t0 = time.perf_counter()
+        found = [detect_faces_in_image(img, upsample=args.upsample, max_side=max_side) for img in images]
+        return found, (time.perf_counter() - t0) / len(images)
+
+    base, base_t = run(None)
+    n_base = sum(len(f) for f in base)
+    print(f"# {len(images)} images, baseline faces={n_base}")
+    print("max_side\tfaces\trecall\tms/image\tspeedup")
+    print(f"full\t{n_base}\t1.000\t{base_t*1000:.1f}\t1.00x")
+    for ms in args.max_side:
+        found, t = run(ms)
+        n = sum(len(f) for f in found)
+        matched = sum(match_count(b, f) for b, f in zip(base, found))
+        recall = matched / n_base if n_base else float("nan")
+        print(f"{ms}\t{n}\t{recall:.3f}\t{t*1000:.1f}\t{base_t/t:.2f}x")
+    if tmp is not None:
+        tmp.cleanup()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,101 @@
+"""推論サーバー (twins-serve) の負荷試験
+
+起動済みのサーバーへ、指定した同時接続数で画像を送り続け、
+スループットと応答時間の p50/p99、ステータスコードの内訳を表示する。
+
+使い方:
+    twins-serve --port 8765 --workers 4 &
+    PYTHONPATH=src python3 benchmarks/bench_server.py --folder path/to/photos --concurrency 16 --requests 400
+    PYTHONPATH=src python3 benchmarks/bench_server.py --folder path/to/photos --paths   # パス指定で送る
+"""
+from collections import Counter
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import numpy as np
+
+from twins_recognition.cli import collect_images
+
+
+def post(url: str, body: bytes, content_type: str, timeout: float) -> int:
+    req = urllib.request.Request(url, data=body, headers={"Content-Type": content_type}, method="POST")
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            resp.read()
+            return resp.status
+    except urllib.error.HTTPError as e:
+        e.read()
+        return e.code
+    except OSError:
+        return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="twins-serve 負荷試験")
+    parser.add_argument("--url", type=str, default="http://127.0.0.1:8765/v1/analyze")
+    parser.add_argument("--folder", type=str, required=True, help="送信する画像フォルダ")
+    parser.add_argument("--concurrency", type=int, default=8, help="同時接続数")
+    parser.add_argument("--requests", type=int, default=200, help="送信する要求の総数")
+    parser.add_argument("--paths", action="store_true", help="バイト列ではなくパス (JSON) で送る")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    args = parser.parse_args()
+
+    paths = collect_images(args.folder)
+    if not paths:
+        print("画像がありません", file=sys.stderr)
+        return 1
+    if args.paths:
+        bodies = [(json.dumps({"path": os.path.abspath(p)}).encode(), "application/json") for p in paths]
+    else:
+        bodies = []
+        for p in paths:
+            with open(p, "rb") as f:
+                bodies.append((f.read(), "application/octet-stream"))
+
+    latencies = []
+    statuses: Counter = Counter()
+    lock = threading.Lock()
+    counter = iter(range(args.requests))
+
+    def worker():
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            body, ctype = bodies[i % len(bodies)]
+            t0 = time.perf_counter()
+            status = post(args.url, body, ctype, args.timeout)
+            dt = time.perf_counter() - t0
+            with lock:
+                statuses[status] += 1
+                if status == 200:
+                    latencies.append(dt)
+
+    t0 = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(max(1, args.concurrency))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - t0
+
+    print(f"# {args.requests} requests, concurrency={args.concurrency}, {len(paths)} distinct images")
+    print(f"wall_s\t{wall:.2f}")
+    print(f"ok_per_sec\t{len(latencies) / wall:.2f}")
+    if latencies:
+        p50, p99 = np.percentile(np.asarray(latencies) * 1000, [50, 99])
+        print(f"p50_ms\t{p50:.1f}")
+        print(f"p99_ms\t{p99:.1f}")
+    print("status\t" + " ".join(f"{k}={v}" for k, v in sorted(statuses.items())))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
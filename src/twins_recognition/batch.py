@@ -0,0 +1,137 @@
+"""バッチ解析エンジン
+processor.analyze_image をプロセスプールで並列実行する。
+- ワーカー起動時にモデルをウォームアップ
+- チャンク単位で投入し、投入中の仕事量を上限で抑える
+- 出力は入力順を維持し、失敗は画像単位で報告 (全体は止めない)
+CLI / GUI / Web から共通で利用する。
+"""
+from concurrent.futures import ProcessPoolExecutor, Future
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, Iterable, Iterator, List, Optional, Tuple
+import itertools
+import multiprocessing
+import os
+
+from .processor import analyze_image, analyze_images, ImageAnalysis, ImageResult, AnalyzeOptions
+from .stats import StageStats
+
+
+@dataclass
+class BatchItem:
+    index: int
+    path: str
+    analysis: Optional[ImageAnalysis]
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def default_workers() -> int:
+    """環境変数 TWINS_WORKERS があれば優先、無ければ CPU数-1 (最低1)。"""
+    env = os.environ.get("TWINS_WORKERS")
+    if env:
+        try:
+            return max(1, int(env))
+        except ValueError:
+            pass
+    return max(1, (os.cpu_count() or 1) - 1)
+
+
+def init_worker():
+    """ワーカープロセス初期化: dlib モデルを読み込み、初回呼び出しコストを先に払う。"""
+    import numpy as np
+    from .detector import detect_faces_in_image
+    detect_faces_in_image(np.zeros((64, 64, 3), dtype=np.uint8))
+
+
+def analyze_one(path: str, options: Optional[AnalyzeOptions],
+                stats: Optional[StageStats] = None, data: Optional[bytes] = None) -> Tuple[Optional[ImageAnalysis], Optional[str]]:
+    """1枚を解析する。data (エンコード済み画像のバイト列) を渡すとファイルは読まない。"""
+    if data is not None or (options is not None and options.dedup):
+        # 重複の判定 (内容ハッシュ/dHash) は analyze_images 側で行う
+        return analyze_images([path], options, stats, blobs=[data])[0]
+    try:
+        return analyze_image(path, options, stats), None
+    except Exception as e:
+        return None, str(e) or type(e).__name__
+
+
+def _analyze_chunk(paths: List[str], options: Optional[AnalyzeOptions]) -> Tuple[List[ImageResult], StageStats]:
+    """チャンク内の画像を段階ごとにまとめて解析する (段階別の計測も返す)。"""
+    stats = StageStats()
+    return analyze_images(paths, options, stats), stats
+
+
+def _chunks(paths: Iterable[str], size: int) -> Iterator[List[str]]:
+    it = iter(paths)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def analyze_batch(
+    paths: Iterable[str],
+    workers: int = 1,
+    chunksize: int = 4,
+    max_inflight: Optional[int] = None,
+    options: Optional[AnalyzeOptions] = None,
+    stats: Optional[StageStats] = None,
+) -> Iterator[BatchItem]:
+    """画像パス列を解析し、入力順に BatchItem を返すジェネレータ。
+
+    workers <= 1 の場合はプロセスプールを使わず逐次実行する。
+    max_inflight は同時に投入しておくチャンク数 (既定: workers * 2)。
+    paths はジェネレータでもよい (先読みは max_inflight * chunksize 件まで)。
+    options (検出設定/キャッシュ) は各ワーカーへそのまま渡される。
+    チャンクは processor.analyze_images でまとめて検出・エンコードされる。
+    stats を渡すと段階ごとの処理時間と枚数を合算する。
+    """
+    chunksize = max(1, chunksize)
+    if workers <= 1:
+        next_index = 0
+        for chunk in _chunks(paths, chunksize):
+            results, chunk_stats = _analyze_chunk(chunk, options)
+            if stats is not None:
+                stats.merge(chunk_stats)
+            for offset, (p, (analysis, err)) in enumerate(zip(chunk, results)):
+                yield BatchItem(index=next_index + offset, path=p, analysis=analysis, error=err)
+            next_index += len(chunk)
+        return
+
+    limit = max(1, max_inflight or workers * 2)
+    ctx = multiprocessing.get_context("spawn")  # スレッドを持つ GUI/Flask からでも安全に起動
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=ctx, initializer=init_worker)
+    pending: Deque[Tuple[int, List[str], Future]] = deque()
+    chunks = _chunks(paths, chunksize)
+    next_index = 0
+    try:
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < limit:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    exhausted = True
+                    break
+                pending.append((next_index, chunk, pool.submit(_analyze_chunk, chunk, options)))
+                next_index += len(chunk)
+            if not pending:
+                break
+            # 先頭から順に待つことで出力順を入力順に固定する
+            start, chunk, fut = pending.popleft()
+            try:
+                results, chunk_stats = fut.result()
+                if stats is not None:
+                    stats.merge(chunk_stats)
+            except Exception as e:
+                # ワーカー異常終了などはチャンク内の全画像を失敗扱い
+                results = [(None, str(e) or type(e).__name__)] * len(chunk)
+            for offset, (p, (analysis, err)) in enumerate(zip(chunk, results)):
+                yield BatchItem(index=start + offset, path=p, analysis=analysis, error=err)
+    finally:
+        # 途中で打ち切られた場合 (クライアント切断など) は未着手分を破棄
+        pool.shutdown(wait=False, cancel_futures=True)
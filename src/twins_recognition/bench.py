@@ -0,0 +1,534 @@
+"""再現可能なベンチマーク (twins-bench)
+合成画像 (解像度 x 顔の数) をオフラインで生成し、analyze_image の全体と各段階
+(デコード / 検出 / 切り出し / エンコード / 分類) を個別に計測して JSON に書き出す。
+保存したベースラインとの比較 (compare) は、設定した割合を超える劣化があれば
+終了コード 1 を返す (CI 用)。
+
+    twins-bench run --sizes 640x480 1920x1080 --faces 0 1 4 --out bench.json
+    twins-bench compare baseline.json bench.json --throughput 10 --latency 20
+    twins-bench startup --budget-ms 400
+    twins-bench quantize --store path/to/store --min-agreement 0.99
+
+合成画像の顔は、--fixtures で実写フォルダを渡すとそこから切り出した顔を貼り込む
+(検出も実写に近い負荷になる)。無ければ図形で描いた顔を使い、切り出し/エンコードは
+貼り込んだ位置で計測する (図形の顔は HOG で検出されないことがある)。
+--fixtures の画像はそれ自体も1つのケースとして計測する。
+"""
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from .detector import FaceLocation, detect_faces_in_image, load_image
+from .scanner import scan_images
+
+FORMAT_VERSION = 1
+DEFAULT_SIZES = ("640x480", "1920x1080", "4000x3000")
+DEFAULT_FACES = (0, 1, 4)
+STAGE_NAMES = ("decode", "detect", "align", "encode", "classify")
+# twins_recognition.cli の import で読み込んではいけない重いモジュール (初回使用時に遅延読み込み)
+HEAVY_MODULES = ("dlib", "face_recognition", "cv2", "PIL", "flask")
+FIXTURE_PATCHES = 16      # --fixtures から切り出す顔の上限
+JPEG_QUALITY = 90
+
+
+@dataclass(frozen=True)
+class BenchCase:
+    name: str
+    paths: Tuple[str, ...]
+    boxes: Tuple[Tuple[FaceLocation, ...], ...]   # 画像ごとの顔位置 (合成なら貼り込んだ位置)
+    width: int = 0
+    height: int = 0
+    faces: int = 0
+
+
+def parse_size(text: str) -> Tuple[int, int]:
+    w, h = (int(v) for v in text.lower().split("x"))
+    return w, h
+
+
+def peak_rss_mb() -> Optional[float]:
+    """このプロセスの最大常駐メモリ (MB)。取得できない環境では None。"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux は KB、macOS はバイト
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def latency_summary(samples: Sequence[float], images: Optional[int] = None) -> Dict[str, Any]:
+    """秒の列から枚/秒と mean/p50/p95/p99 (ms) を求める。"""
+    arr = np.asarray(samples, dtype=np.float64)
+    if arr.size == 0:
+        return {"n": 0}
+    total = float(arr.sum())
+    n = images if images is not None else int(arr.size)
+    p50, p95, p99 = np.percentile(arr, [50, 95, 99]) * 1000
+    return {
+        "n": int(arr.size),
+        "images_per_sec": round(n / total, 3) if total > 0 else None,
+        "mean_ms": round(float(arr.mean()) * 1000, 3),
+        "p50_ms": round(float(p50), 3),
+        "p95_ms": round(float(p95), 3),
+        "p99_ms": round(float(p99), 3),
+    }
+
+
+# --- 合成データ ---
+
+def _drawn_face(size: int, rng: np.random.Generator):
+    """図形で描いた正面顔 (肌色の楕円に目・眉・鼻・口)。"""
+    from PIL import Image, ImageDraw
+    im = Image.new("RGB", (size, size), (0, 0, 0))
+    mask = Image.new("L", (size, size), 0)
+    skin = tuple(int(v) for v in rng.integers([170, 120, 90], [235, 190, 160]))
+    d = ImageDraw.Draw(im)
+    ImageDraw.Draw(mask).ellipse([size * 0.1, 0, size * 0.9, size], fill=255)
+    d.ellipse([size * 0.1, 0, size * 0.9, size], fill=skin)
+    s = size / 100.0
+    for cx in (35, 65):
+        d.ellipse([(cx - 8) * s, 36 * s, (cx + 8) * s, 46 * s], fill=(250, 250, 250))
+        d.ellipse([(cx - 4) * s, 37 * s, (cx + 4) * s, 45 * s], fill=(40, 30, 25))
+        d.line([(cx - 10) * s, 30 * s, (cx + 10) * s, 29 * s], fill=(60, 40, 30), width=max(1, int(3 * s)))
+    d.polygon([(50 * s, 45 * s), (44 * s, 64 * s), (56 * s, 64 * s)], fill=tuple(max(0, c - 40) for c in skin))
+    d.chord([35 * s, 68 * s, 65 * s, 84 * s], 0, 180, fill=(150, 50, 60))
+    return im, mask
+
+
+def fixture_patches(folder: str, limit: int = FIXTURE_PATCHES) -> List[Any]:
+    """実写フォルダから顔を少し広めに切り出した PIL 画像を返す。"""
+    from PIL import Image
+    patches = []
+    for path in sorted(scan_images(folder)):
+        try:
+            img = load_image(path)
+        except Exception:
+            continue
+        h, w = img.shape[:2]
+        for t, r, b, l in detect_faces_in_image(img):
+            m = int((b - t) * 0.3)
+            crop = img[max(0, t - m):min(h, b + m), max(0, l - m):min(w, r + m)]
+            patches.append(Image.fromarray(crop))
+            if len(patches) >= limit:
+                return patches
+    return patches
+
+
+def synth_image(width: int, height: int, n_faces: int, rng: np.random.Generator,
+                patches: Sequence[Any] = ()) -> Tuple[Any, List[FaceLocation]]:
+    """背景 (グラデーション + ノイズ) に n_faces 個の顔を格子状に重ならないよう配置する。"""
+    from PIL import Image
+    yy, xx = np.mgrid[0:height, 0:width].astype(np.float32)
+    base = rng.uniform(40, 200, size=3).astype(np.float32)
+    grad = (xx / max(width, 1))[..., None] * rng.uniform(-60, 60, size=3) + (yy / max(height, 1))[..., None] * rng.uniform(-60, 60, size=3)
+    noise = rng.normal(0, 12, size=(height, width, 3))
+    im = Image.fromarray(np.clip(base + grad + noise, 0, 255).astype(np.uint8))
+    boxes: List[FaceLocation] = []
+    if n_faces <= 0:
+        return im, boxes
+    cols = int(np.ceil(np.sqrt(n_faces * width / max(height, 1))))
+    rows = int(np.ceil(n_faces / cols))
+    cell_w, cell_h = width // cols, height // rows
+    size = int(min(cell_w, cell_h) * 0.7)
+    for k in range(n_faces):
+        r, c = divmod(k, cols)
+        left = c * cell_w + int(rng.integers(0, max(1, cell_w - size)))
+        top = r * cell_h + int(rng.integers(0, max(1, cell_h - size)))
+        if patches:
+            face = patches[int(rng.integers(0, len(patches)))].convert("RGB").resize((size, size))
+            im.paste(face, (left, top))
+            # 切り出し時の余白 (30%) を除いた顔の範囲
+            m = int(size * 0.3 / 1.6)
+            boxes.append((top + m, left + size - m, top + size - m, left + m))
+        else:
+            face, mask = _drawn_face(size, rng)
+            im.paste(face, (left, top), mask)
+            boxes.append((top, left + size, top + size, left))
+    return im, boxes
+
+
+def build_cases(out_dir: str, sizes: Sequence[str], faces: Sequence[int], images: int,
+                seed: int = 0, fixtures: Optional[str] = None) -> List[BenchCase]:
+    """合成画像を out_dir に書き出してケースの一覧を返す。同じ引数なら同じ画像になる。"""
+    patches = fixture_patches(fixtures) if fixtures else []
+    cases = []
+    for size in sizes:
+        w, h = parse_size(size)
+        for n in faces:
+            name = f"{w}x{h}_f{n}"
+            # ケースごとに独立した乱数列 (ケースの増減で他のケースの画像が変わらない)
+            rng = np.random.default_rng([seed, w, h, n])
+            paths, boxes = [], []
+            for i in range(images):
+                im, b = synth_image(w, h, n, rng, patches)
+                path = os.path.join(out_dir, f"{name}_{i:02d}.jpg")
+                im.save(path, quality=JPEG_QUALITY)
+                paths.append(path)
+                boxes.append(tuple(b))
+            cases.append(BenchCase(name, tuple(paths), tuple(boxes), w, h, n))
+    if fixtures:
+        paths = sorted(scan_images(fixtures))
+        if paths:
+            boxes = [tuple(detect_faces_in_image(load_image(p))) for p in paths]
+            cases.append(BenchCase("fixtures", tuple(paths), tuple(boxes), faces=sum(len(b) for b in boxes)))
+    return cases
+
+
+# --- 計測 ---
+
+def _timed(fn: Callable[[], Any]) -> Tuple[float, Any]:
+    t0 = time.perf_counter()
+    out = fn()
+    return time.perf_counter() - t0, out
+
+
+def measure_case(case: BenchCase, repeat: int = 3, options=None) -> Dict[str, Any]:
+    """1ケースについて全体 (analyze_image) と各段階の処理時間を計測する。"""
+    from .classifier import classify_embeddings
+    from .embedding import encode_chips, face_chips
+    from .processor import AnalyzeOptions, analyze_image
+    options = options or AnalyzeOptions()
+
+    pipeline: List[float] = []
+    detected = 0
+    stages: Dict[str, List[float]] = {n: [] for n in STAGE_NAMES}
+    for _ in range(max(1, repeat)):
+        for path, boxes in zip(case.paths, case.boxes):
+            sec, analysis = _timed(lambda: analyze_image(path, options))
+            pipeline.append(sec)
+            detected += len(analysis.faces)
+
+            sec, img = _timed(lambda: load_image(path))
+            stages["decode"].append(sec)
+            sec, _ = _timed(lambda: detect_faces_in_image(img, model=options.model, upsample=options.upsample,
+                                                          max_side=options.max_side))
+            stages["detect"].append(sec)
+            # 切り出し以降は既知の顔位置で計測する (検出結果に左右されない)
+            sec, chips = _timed(lambda: face_chips(img, list(boxes)))
+            stages["align"].append(sec)
+            sec, emb = _timed(lambda: encode_chips(chips, batch_size=options.batch_size))
+            stages["encode"].append(sec)
+            sec, _ = _timed(lambda: classify_embeddings(emb))
+            stages["classify"].append(sec)
+    runs = max(1, repeat)
+    return {
+        "width": case.width,
+        "height": case.height,
+        "faces": case.faces,
+        "images": len(case.paths),
+        "faces_detected": round(detected / runs, 2),
+        "pipeline": latency_summary(pipeline),
+        "stages": {n: latency_summary(v) for n, v in stages.items()},
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def environment() -> Dict[str, Any]:
+    env: Dict[str, Any] = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+    }
+    try:
+        import dlib
+        env["dlib"] = dlib.__version__
+        env["dlib_avx"] = bool(getattr(dlib, "USE_AVX_INSTRUCTIONS", False))
+    except Exception:
+        pass
+    return env
+
+
+def run_benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    from .processor import AnalyzeOptions, analyze_image
+    options = AnalyzeOptions(model=args.model, max_side=args.max_side, batch_size=args.batch_size)
+    with tempfile.TemporaryDirectory(prefix="twins_bench_") as tmp:
+        data_dir = args.data_dir or tmp
+        os.makedirs(data_dir, exist_ok=True)
+        cases = build_cases(data_dir, args.sizes, args.faces, args.images, args.seed, args.fixtures)
+        # モデルの読み込みを計測に含めない
+        if cases and cases[0].paths:
+            analyze_image(cases[0].paths[0], options)
+        # 最大 RSS は単調増加なので、小さいケースから順に計測する (実写ケースは最後)
+        cases.sort(key=lambda c: (c.width == 0, c.width * c.height, c.faces))
+        results = {}
+        for case in cases:
+            results[case.name] = measure_case(case, args.repeat, options)
+            if not args.quiet:
+                p = results[case.name]["pipeline"]
+                print(f"{case.name}\t{p['images_per_sec']} img/s\tp50={p['p50_ms']}ms\tp95={p['p95_ms']}ms\t"
+                      f"rss={results[case.name]['peak_rss_mb']}MB", file=sys.stderr)
+    return {
+        "version": FORMAT_VERSION,
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "environment": environment(),
+        "config": {"sizes": list(args.sizes), "faces": list(args.faces), "images": args.images,
+                   "repeat": args.repeat, "seed": args.seed, "model": args.model, "max_side": args.max_side,
+                   "batch_size": args.batch_size, "fixtures": bool(args.fixtures)},
+        "cases": results,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+# --- 比較 ---
+
+@dataclass
+class Regression:
+    case: str
+    metric: str
+    baseline: float
+    current: float
+    change_pct: float
+    limit_pct: float
+    regressed: bool
+
+
+def compare_results(baseline: Dict[str, Any], current: Dict[str, Any], throughput_pct: float = 10.0,
+                    latency_pct: float = 20.0, rss_pct: float = 25.0, min_ms: float = 1.0,
+                    stages: bool = True) -> List[Regression]:
+    """共通するケースの指標を比べる。
+
+    枚/秒は低下率、p50/p95 は増加率、最大 RSS は増加率が上限を超えると劣化とする。
+    ベースラインの平均が min_ms 未満の段階は計測誤差が大きいので比較しない。
+    """
+    rows: List[Regression] = []
+
+    def check(case: str, metric: str, base: Optional[float], cur: Optional[float], limit: float, higher_is_better: bool):
+        if base is None or cur is None or base <= 0:
+            return
+        change = (cur - base) / base * 100.0
+        worse = -change if higher_is_better else change
+        rows.append(Regression(case, metric, base, cur, round(change, 2), limit, worse > limit))
+
+    for name, base in baseline.get("cases", {}).items():
+        cur = current.get("cases", {}).get(name)
+        if cur is None:
+            continue
+        groups = [("pipeline", base.get("pipeline", {}), cur.get("pipeline", {}))]
+        if stages:
+            groups += [(f"stages.{s}", base.get("stages", {}).get(s, {}), cur.get("stages", {}).get(s, {}))
+                       for s in STAGE_NAMES]
+        for prefix, b, c in groups:
+            if (b.get("mean_ms") or 0) < min_ms:
+                continue
+            check(name, f"{prefix}.images_per_sec", b.get("images_per_sec"), c.get("images_per_sec"),
+                  throughput_pct, True)
+            for q in ("p50_ms", "p95_ms"):
+                check(name, f"{prefix}.{q}", b.get(q), c.get(q), latency_pct, False)
+        check(name, "peak_rss_mb", base.get("peak_rss_mb"), cur.get("peak_rss_mb"), rss_pct, False)
+    return rows
+
+
+def format_comparison(rows: Sequence[Regression], only_regressions: bool = False) -> str:
+    lines = [f"{'case':<18}{'metric':<30}{'baseline':>12}{'current':>12}{'change':>10}  status"]
+    for r in rows:
+        if only_regressions and not r.regressed:
+            continue
+        status = f"REGRESSION (> {r.limit_pct:g}%)" if r.regressed else "ok"
+        lines.append(f"{r.case:<18}{r.metric:<30}{r.baseline:>12.3f}{r.current:>12.3f}{r.change_pct:>+9.1f}%  {status}")
+    return "\n".join(lines)
+
+
+def _load(path: str) -> Dict[str, Any]:
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if data.get("version") != FORMAT_VERSION:
+        raise ValueError(f"未対応のベンチマーク形式です: {path} (version={data.get('version')})")
+    return data
+
+
+# --- 起動時間 ---
+
+_STARTUP_PROBE = """
+import json, sys, time
+t0 = time.perf_counter()
+import twins_recognition.cli
+elapsed = time.perf_counter() - t0
+print(json.dumps({"import_ms": elapsed * 1000, "heavy": [m for m in %r if m in sys.modules]}))
+""" % (HEAVY_MODULES,)
+
+
+def measure_startup(runs: int = 5) -> Dict[str, Any]:
+    """新しいインタプリタで twins_recognition.cli の import 時間と --help の所要時間を測る。"""
+    import subprocess
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(p for p in sys.path if p))
+    imports, helps, heavy = [], [], set()
+    for _ in range(max(1, runs)):
+        out = subprocess.run([sys.executable, "-c", _STARTUP_PROBE], env=env, check=True,
+                             capture_output=True, text=True).stdout
+        probe = json.loads(out.strip().splitlines()[-1])
+        imports.append(probe["import_ms"])
+        heavy.update(probe["heavy"])
+        sec, _ = _timed(lambda: subprocess.run([sys.executable, "-m", "twins_recognition.cli", "--help"], env=env,
+                                               check=True, capture_output=True))
+        helps.append(sec * 1000)
+    return {
+        "runs": len(imports),
+        "import_ms": round(float(np.median(imports)), 1),
+        "help_ms": round(float(np.median(helps)), 1),
+        "heavy_modules": sorted(heavy),
+    }
+
+
+def startup_main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="twins-bench startup", description="CLI の import 時間を計測し、予算を超えたら終了コード 1")
+    parser.add_argument("--runs", type=int, default=5, help="計測回数 (中央値を使う)")
+    parser.add_argument("--budget-ms", type=float, default=400.0, help="twins_recognition.cli の import 時間の上限 (ms)")
+    args = parser.parse_args(argv)
+    result = measure_startup(args.runs)
+    print(json.dumps(result, ensure_ascii=False))
+    failed = False
+    if result["heavy_modules"]:
+        print(f"# import 時に読み込まれた重いモジュール: {', '.join(result['heavy_modules'])}", file=sys.stderr)
+        failed = True
+    if result["import_ms"] > args.budget_ms:
+        print(f"# import 時間 {result['import_ms']}ms が予算 {args.budget_ms:g}ms を超えました", file=sys.stderr)
+        failed = True
+    return 1 if failed else 0
+
+
+def run_main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="twins-bench run", description="合成画像で解析パイプラインを計測して JSON に保存")
+    parser.add_argument("--sizes", nargs="+", default=list(DEFAULT_SIZES), help="画像サイズ WxH (複数可)")
+    parser.add_argument("--faces", nargs="+", type=int, default=list(DEFAULT_FACES), help="1枚あたりの顔の数 (複数可)")
+    parser.add_argument("--images", type=int, default=3, help="ケースごとの画像枚数")
+    parser.add_argument("--repeat", type=int, default=3, help="各画像の計測回数")
+    parser.add_argument("--seed", type=int, default=0, help="合成画像の乱数シード")
+    parser.add_argument("--fixtures", type=str, default=None, help="顔の切り出し元かつ追加ケースにする実写フォルダ")
+    parser.add_argument("--data-dir", type=str, default=None, help="合成画像の保存先 (既定: 一時ディレクトリ)")
+    parser.add_argument("--model", choices=["hog", "cnn"], default="hog")
+    parser.add_argument("--max-side", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--out", type=str, default="bench.json", help="結果 JSON の出力先 (- で標準出力)")
+    parser.add_argument("--quiet", action="store_true", help="ケースごとの進捗を表示しない")
+    args = parser.parse_args(argv)
+
+    result = run_benchmark(args)
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.out == "-":
+        print(text)
+    else:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+        print(f"結果を書き出しました: {args.out}", file=sys.stderr)
+    return 0
+
+
+def compare_main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="twins-bench compare", description="ベースラインと比較し、劣化があれば終了コード 1")
+    parser.add_argument("baseline", help="ベースラインの JSON")
+    parser.add_argument("current", help="今回の JSON")
+    parser.add_argument("--throughput", type=float, default=10.0, help="許容する枚/秒の低下率 (%%)")
+    parser.add_argument("--latency", type=float, default=20.0, help="許容する p50/p95 の増加率 (%%)")
+    parser.add_argument("--rss", type=float, default=25.0, help="許容する最大 RSS の増加率 (%%)")
+    parser.add_argument("--min-ms", type=float, default=1.0, help="ベースラインの平均がこれ未満の段階は比較しない (ms)")
+    parser.add_argument("--pipeline-only", action="store_true", help="段階別の指標は比較しない")
+    parser.add_argument("--only-regressions", action="store_true", help="劣化した行だけ表示")
+    args = parser.parse_args(argv)
+
+    try:
+        baseline, current = _load(args.baseline), _load(args.current)
+    except (OSError, ValueError) as e:
+        print(f"エラー: {e}", file=sys.stderr)
+        return 2
+    rows = compare_results(baseline, current, args.throughput, args.latency, args.rss, args.min_ms,
+                           stages=not args.pipeline_only)
+    missing = sorted(set(baseline.get("cases", {})) - set(current.get("cases", {})))
+    print(format_comparison(rows, args.only_regressions))
+    if missing:
+        print(f"# 今回の結果に無いケース: {', '.join(missing)}", file=sys.stderr)
+    if baseline.get("environment") != current.get("environment"):
+        print("# 注意: 計測環境が異なります", file=sys.stderr)
+    failed = [r for r in rows if r.regressed]
+    print(f"# {len(failed)} regression(s) / {len(rows)} metric(s)", file=sys.stderr)
+    return 1 if failed else 0
+
+
+def synthetic_embeddings(people: int = 500, per: int = 4, seed: int = 0) -> np.ndarray:
+    """dlib 埋め込みに近い分布 (ノルム約 1.3、別人の距離 0.8〜1.0、同一人物 0.3 前後) の合成埋め込み。
+
+    人物の半分は直前の人物の双子/兄弟程度の距離に置き、閾値付近のペアも含める。
+    """
+    rng = np.random.default_rng(seed)
+    mean = rng.normal(size=128)
+    mean *= 1.25 / np.linalg.norm(mean)
+    centers = mean + rng.normal(scale=0.056, size=(people, 128))
+    step = rng.normal(size=(people // 2, 128))
+    step /= np.linalg.norm(step, axis=1, keepdims=True)
+    gap = rng.uniform(0.2, 0.7, size=(people // 2, 1))
+    centers[1::2] = centers[0:people - people % 2:2] + step * gap
+    x = centers.repeat(per, axis=0) + rng.normal(scale=0.012, size=(people * per, 128))
+    return x.astype(np.float32)
+
+
+def format_quantize_report(rows: Sequence[Dict[str, Any]]) -> str:
+    lines = ["kind      metric     bytes/face  faces/GB    agreement  near(n)            max_err    mean_err"]
+    for r in rows:
+        lines.append(f"{r['kind']:9s} {r['metric']:10s} {r['bytes_per_face']:10d}  {r['faces_per_gb']:10d}  "
+                     f"{r['label_agreement']:9.5f}  {r['near_agreement']:7.5f} ({r['near_pairs']:8d})  "
+                     f"{r['max_distance_error']:.2e}  {r['mean_distance_error']:.2e}")
+    return "\n".join(lines)
+
+
+def quantize_main(argv: Optional[List[str]] = None) -> int:
+    from .quantize import KINDS, REPORT_PAIRS, accuracy_report
+
+    parser = argparse.ArgumentParser(prog="twins-bench quantize",
+                                     description="埋め込みの省メモリ表現・コサイン距離と float64 ユークリッド距離のラベル一致率を測る")
+    src = parser.add_mutually_exclusive_group()
+    src.add_argument("--store", type=str, help="埋め込みを読むバイナリストア (float32 で保存したもの)")
+    src.add_argument("--index", type=str, help="埋め込みを読む検索インデックス")
+    parser.add_argument("--synthetic", type=int, default=500, help="ストア/インデックスを指定しない場合の合成人物数 (1人4顔)")
+    parser.add_argument("--kinds", nargs="+", choices=KINDS, default=list(KINDS), help="比べる表現")
+    parser.add_argument("--metrics", nargs="+", choices=["euclidean", "cosine"], default=["euclidean", "cosine"])
+    parser.add_argument("--max-pairs", type=int, default=REPORT_PAIRS, help="比べるペア数の上限 (超えたら無作為抽出)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--min-agreement", type=float, default=None,
+                        help="境界付近のペアのラベル一致率がこれ未満の組があれば終了コード 1")
+    parser.add_argument("--json", action="store_true", help="結果を JSON で表示")
+    args = parser.parse_args(argv)
+
+    if args.store:
+        from .store import EmbeddingStore
+        x = np.asarray(EmbeddingStore(args.store).embeddings, dtype=np.float32)
+    elif args.index:
+        from .index import EmbeddingIndex
+        x = np.asarray(EmbeddingIndex.load(args.index).embeddings, dtype=np.float32)
+    else:
+        x = synthetic_embeddings(args.synthetic, seed=args.seed)
+    rows = accuracy_report(x, args.kinds, args.metrics, args.max_pairs, args.seed)
+    print(json.dumps(rows, ensure_ascii=False, indent=2) if args.json else format_quantize_report(rows))
+    if args.min_agreement is not None:
+        low = [r for r in rows if r["near_pairs"] and r["near_agreement"] < args.min_agreement]
+        for r in low:
+            print(f"# {r['kind']}/{r['metric']}: 境界付近の一致率 {r['near_agreement']:.5f} < {args.min_agreement}", file=sys.stderr)
+        return 1 if low else 0
+    return 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    argv = list(sys.argv[1:] if argv is None else argv)
+    if argv and argv[0] == "quantize":
+        return quantize_main(argv[1:])
+    if argv and argv[0] == "compare":
+        return compare_main(argv[1:])
+    if argv and argv[0] == "startup":
+        return startup_main(argv[1:])
+    if argv and argv[0] == "run":
+        argv = argv[1:]
+    return run_main(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,229 @@
+"""顔位置・埋め込みの永続キャッシュ
+画像内容のハッシュ + 検出設定 (モデル/アップサンプル回数) をキーに、
+検出結果と128次元埋め込みを SQLite に保存する。サイズ上限 (パス -> ハッシュの対応表を含む) を
+超えると最終利用時刻の古いものから削除する (LRU)。
+閾値変更後の再実行では検出/エンコードを省略して分類だけを行える。
+1つの接続をロックで直列化して使うので、スレッドワーカー (twins-serve --mode thread) からも共有できる。
+"""
+from typing import Dict, List, Optional, Tuple
+import atexit
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+FaceLocation = Tuple[int, int, int, int]
+
+# キャッシュ形式やキーに含める設定を変えたら上げる
+CACHE_VERSION = 2
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+EMBEDDING_DIM = 128
+
+_TOUCH_FLUSH = 256   # atime 更新をまとめて書き込む件数
+_EVICT_EVERY = 64    # 何回の put ごとに容量チェックするか
+_DIGEST_ROW_BYTES = 24   # digests の1行あたりの固定分 (パスとハッシュの長さに加える)
+
+
+def default_cache_dir() -> str:
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "twins-recognition")
+
+
+def sha256_bytes(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class EmbeddingCache:
+    """内容ハッシュをキーにした顔位置/埋め込みキャッシュ (プロセスごとに1インスタンス、スレッド間で共有可)。"""
+
+    def __init__(self, root: str, max_bytes: int = DEFAULT_MAX_BYTES):
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._touched: Dict[str, float] = {}
+        self._puts = 0
+        # 接続は作成スレッド以外からも使う。BEGIN..COMMIT を含む操作ごとに _lock で直列化する
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(os.path.join(root, "cache.sqlite"), timeout=30, isolation_level=None,
+                                     check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                faces TEXT NOT NULL,
+                embeddings BLOB NOT NULL,
+                nbytes INTEGER NOT NULL,
+                atime REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS entries_atime ON entries(atime);
+            -- 同一ファイル (パス/サイズ/mtime 不変) の再ハッシュを省くための対応表
+            CREATE TABLE IF NOT EXISTS digests (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                digest TEXT NOT NULL
+            );
+            """
+        )
+        atexit.register(self.close)
+
+    @staticmethod
+    def make_key(digest: str, model: str, upsample: int, max_side: Optional[int] = None,
+                 tile: Optional[int] = None, tile_overlap: int = 0) -> str:
+        key = f"v{CACHE_VERSION}:{digest}:{model}:{upsample}"
+        # 縮小検出・タイル分割検出は結果が変わりうるので別キー (未指定時は従来のキーのまま)
+        if max_side:
+            key = f"{key}:max{max_side}"
+        return f"{key}:tile{tile}o{tile_overlap}" if tile else key
+
+    def digest_file(self, path: str) -> Tuple[str, Optional[bytes]]:
+        """ファイルの内容ハッシュを返す。
+
+        パス/サイズ/mtime が前回と同じなら記録済みハッシュを返し、ファイルは読まない
+        (その場合 bytes は None)。読んだ場合は再デコード用に bytes も返す。
+        """
+        st = os.stat(path)
+        apath = os.path.abspath(path)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT digest FROM digests WHERE path=? AND size=? AND mtime_ns=?",
+                (apath, st.st_size, st.st_mtime_ns),
+            ).fetchone()
+        if row is not None:
+            return row[0], None
+        with open(path, "rb") as f:
+            data = f.read()
+        digest = sha256_bytes(data)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO digests(path, size, mtime_ns, digest) VALUES (?, ?, ?, ?)",
+                (apath, st.st_size, st.st_mtime_ns, digest),
+            )
+        return digest, data
+
+    def get(self, key: str) -> Optional[Tuple[List[FaceLocation], np.ndarray]]:
+        with self._lock:
+            row = self._conn.execute("SELECT faces, embeddings FROM entries WHERE key=?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._touched[key] = time.time()
+            if len(self._touched) >= _TOUCH_FLUSH:
+                self._flush_touches()
+        faces = [tuple(f) for f in json.loads(row[0])]
+        embeddings = np.frombuffer(row[1], dtype=np.float32).reshape(-1, EMBEDDING_DIM)
+        return faces, embeddings
+
+    def put(self, key: str, faces: List[FaceLocation], embeddings: np.ndarray):
+        blob = np.asarray(embeddings, dtype=np.float32).reshape(-1, EMBEDDING_DIM).tobytes()
+        faces_text = json.dumps([list(f) for f in faces])
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries(key, faces, embeddings, nbytes, atime) VALUES (?, ?, ?, ?, ?)",
+                (key, faces_text, blob, len(blob) + len(faces_text) + len(key), time.time()),
+            )
+            self._puts += 1
+            if self._puts % _EVICT_EVERY == 0:
+                self.evict()
+
+    def total_bytes(self) -> int:
+        """エントリと digests (パス -> ハッシュの対応表) の合計バイト数 (上限と比べる値)。"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT (SELECT COALESCE(SUM(nbytes), 0) FROM entries),"
+                " (SELECT COALESCE(SUM(length(CAST(path AS BLOB)) + length(digest) + ?), 0) FROM digests)",
+                (_DIGEST_ROW_BYTES,),
+            ).fetchone()
+            return int(row[0]) + int(row[1])
+
+    def evict(self):
+        """上限超過時、最終利用の古い順に上限の90%まで削除する。
+
+        どのエントリからも参照されなくなった digests の行も消す (ファイルの削除・改名で残った行を含む)。
+        まだ put していない画像の行が消えた場合は、次回ハッシュを計算し直すだけ。
+        """
+        with self._lock:
+            self._flush_touches()
+            total = self.total_bytes()
+            if total <= self.max_bytes:
+                return
+            target = int(self.max_bytes * 0.9)
+            self._conn.execute("BEGIN")
+            self._prune_digests()
+            total = self.total_bytes()
+            while total > target:
+                rows = self._conn.execute("SELECT key, nbytes FROM entries ORDER BY atime ASC").fetchall()
+                if not rows:
+                    break
+                victims = []
+                for key, nbytes in rows:
+                    if total <= target:
+                        break
+                    victims.append((key,))
+                    total -= nbytes
+                self._conn.executemany("DELETE FROM entries WHERE key=?", victims)
+                self._prune_digests()
+                total = self.total_bytes()
+            self._conn.execute("COMMIT")
+
+    def _prune_digests(self):
+        # キーは "v{版}:{ハッシュ}:..." なので、そのハッシュのキーの範囲を主キーの索引で調べる
+        prefix = f"v{CACHE_VERSION}:"
+        self._conn.execute(
+            "DELETE FROM digests WHERE NOT EXISTS (SELECT 1 FROM entries"
+            " WHERE key >= ? || digest || ':' AND key < ? || digest || ';')",
+            (prefix, prefix),
+        )
+
+    def _flush_touches(self):
+        with self._lock:
+            if not self._touched:
+                return
+            items = [(t, k) for k, t in self._touched.items()]
+            self._touched.clear()
+            self._conn.execute("BEGIN")
+            self._conn.executemany("UPDATE entries SET atime=? WHERE key=?", items)
+            self._conn.execute("COMMIT")
+
+    def close(self):
+        with self._lock:
+            if self._conn is None:
+                return
+            try:
+                self.evict()
+            finally:
+                self._conn.close()
+                self._conn = None  # type: ignore[assignment]
+
+
+_CACHES: Dict[Tuple[str, int], EmbeddingCache] = {}
+_CACHES_LOCK = threading.Lock()
+
+
+def get_cache(root: str, max_bytes: int = DEFAULT_MAX_BYTES) -> EmbeddingCache:
+    """プロセス内で共有するキャッシュインスタンスを返す (ワーカープロセスごとに1つ)。"""
+    key = (os.path.abspath(root), max_bytes)
+    with _CACHES_LOCK:
+        cache = _CACHES.get(key)
+        if cache is None:
+            cache = EmbeddingCache(root, max_bytes=max_bytes)
+            _CACHES[key] = cache
+    return cache
+
+
+def close_caches():
+    """プロセス内で共有しているキャッシュをすべて閉じて捨てる (常駐プロセスの要求ごと)。"""
+    with _CACHES_LOCK:
+        caches = list(_CACHES.values())
+        _CACHES.clear()
+    for cache in caches:
+        cache.close()
@@ -0,0 +1,270 @@
+"""閾値の較正 (twins-cli calibrate)
+保存済みの埋め込み (バイナリストアまたは検索インデックス) と、正解ラベル付きの顔ペア一覧から
+THRESHOLDS を決め直す。検出・エンコードはやり直さない。
+
+距離はユークリッド距離 (THRESHOLDS) かコサイン距離 (COSINE_THRESHOLDS) を選べる。
+ラベルは twins < siblings < similar < different の順に近い関係とみなし、各閾値 L は
+「正解が L 以下 (例: siblings なら twins と siblings)」を陽性とする2値判定として評価する。
+全ペアの距離を固定幅のヒストグラムにまとめ、累積和から全閾値候補の
+TP/FP/FN/TN を一度に求める (ペア数が数百万でも1回の走査で済む)。
+
+ペア一覧 (CSV, ヘッダ行は任意):
+    path_a,face_a,path_b,face_b,label
+    family/p01.jpg,0,family/p01.jpg,1,twins     # 同じ写真の顔 0 と顔 1
+    a.jpg,0,b.jpg,0,different
+path_b を空にすると path_a の顔 face_a と face_b のペア。相対パスはペア一覧のある
+ディレクトリから解決する (見つからなければカレントディレクトリ)。
+"""
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, TextIO, Tuple
+import csv
+import os
+
+import numpy as np
+
+from .classifier import THRESHOLDS, unit_rows
+
+# 近い順。different は陰性専用
+PAIR_LABELS = ("twins", "siblings", "similar", "different")
+RANKS = {label: i for i, label in enumerate(PAIR_LABELS)}
+MAX_DISTANCE = 2.0
+BIN_WIDTH = 1e-3
+CHUNK = 262144   # 距離計算で一度に扱うペア数
+
+
+@dataclass
+class PairList:
+    """正解ペアの列 (1要素 = 1ペア)。"""
+    path_a: List[str]
+    face_a: np.ndarray
+    path_b: List[str]
+    face_b: np.ndarray
+    ranks: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.path_a)
+
+
+def read_pairs(f: TextIO) -> PairList:
+    """ペア一覧を列ごとに読む。列数・顔番号・ラベルが不正なら ValueError。
+
+    数百万行でも行のリストを保持せず、読みながら列ごとのリストへ振り分けてから配列へ変換する。
+    """
+    cols: List[List[str]] = [[], [], [], [], []]
+    path_a, face_a, path_b, face_b, labels = cols
+    n = 0
+    for r in csv.reader(f):
+        if not r or r[0].lstrip().startswith("#"):
+            continue
+        if n == 0 and r[0].strip().lower() == "path_a":
+            continue
+        n += 1
+        if len(r) != 5:
+            raise ValueError(f"{n}件目のペア: 列数が 5 ではありません")
+        for col, value in zip(cols, r):
+            col.append(value)
+    if not n:
+        empty = np.empty(0, dtype=np.int64)
+        return PairList([], empty, [], empty, np.empty(0, dtype=np.int8))
+    path_a = [p.strip() for p in path_a]
+    path_b = [q.strip() or p for p, q in zip(path_a, path_b)]
+    ranks = np.array([RANKS.get(label.strip(), -1) for label in labels], dtype=np.int8)
+    if (ranks < 0).any():
+        n = int(np.argmax(ranks < 0))
+        raise ValueError(f"{n + 1}件目のペア: 不明なラベル {labels[n].strip()!r} ({', '.join(PAIR_LABELS)} のいずれか)")
+    return PairList(path_a, _face_numbers(face_a), path_b, _face_numbers(face_b), ranks)
+
+
+def _face_numbers(col: Sequence[str]) -> np.ndarray:
+    try:
+        return np.array([int(x) if x.strip() else 0 for x in col], dtype=np.int64)
+    except ValueError as e:
+        raise ValueError(f"顔番号が整数ではありません: {e}") from None
+
+
+class EmbeddingTable:
+    """画像パス -> 顔の行番号を引ける埋め込み (ストア/インデックスの共通の見え方)。"""
+
+    def __init__(self, paths: Sequence[str], face_start: np.ndarray, face_count: np.ndarray, embeddings: np.ndarray):
+        self.ids = {p: i for i, p in enumerate(paths)}
+        self.face_start = np.asarray(face_start, dtype=np.int64)
+        self.face_count = np.asarray(face_count, dtype=np.int64)
+        self.embeddings = embeddings
+
+    @classmethod
+    def from_store(cls, root: str) -> "EmbeddingTable":
+        from .store import EmbeddingStore
+        store = EmbeddingStore(root, readonly=True)
+        return cls(store.paths, np.asarray(store.column("image_face_start")),
+                   np.asarray(store.column("image_face_count")), store.embeddings)
+
+    @classmethod
+    def from_index(cls, root: str) -> "EmbeddingTable":
+        from .index import EmbeddingIndex
+        index = EmbeddingIndex.load(root)
+        ids = index.image_ids
+        # 画像の顔は登録順に連続している
+        count = np.bincount(ids, minlength=len(index.paths))
+        start = np.concatenate([[0], np.cumsum(count)[:-1]])
+        return cls(index.paths, start, count, index.embeddings)
+
+    def rows(self, paths: Sequence[str], faces: np.ndarray, base_dir: str) -> np.ndarray:
+        """各 (パス, 顔番号) の行番号 (画像や顔が無ければ -1)。
+
+        相対パスは base_dir から、見つからなければカレントディレクトリから解決する。
+        """
+        lookup: Dict[str, int] = {}
+        for p in set(paths):
+            i = self.ids.get(os.path.abspath(os.path.join(base_dir, p)))
+            if i is None:
+                i = self.ids.get(os.path.abspath(p), -1)
+            lookup[p] = i
+        image = np.array([lookup[p] for p in paths], dtype=np.int64)
+        ok = image >= 0
+        safe = np.where(ok, image, 0)
+        ok &= (faces >= 0) & (faces < self.face_count[safe])
+        return np.where(ok, self.face_start[safe] + faces, -1)
+
+
+def resolve_rows(table: EmbeddingTable, pairs: PairList, base_dir: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray, int]:
+    """ペアを (行a, 行b, 正解の順位) の配列にする。引けなかったペアの数も返す。"""
+    ra = table.rows(pairs.path_a, pairs.face_a, base_dir)
+    rb = table.rows(pairs.path_b, pairs.face_b, base_dir)
+    ok = (ra >= 0) & (rb >= 0) & (ra != rb)
+    return ra[ok], rb[ok], pairs.ranks[ok], int((~ok).sum())
+
+
+def pair_distances(embeddings: np.ndarray, ra: np.ndarray, rb: np.ndarray, metric: str = "euclidean",
+                   chunk: int = CHUNK) -> np.ndarray:
+    """ペアごとの距離 (ユークリッド距離、または正規化した埋め込みのコサイン距離)。
+
+    差分から直接求めるので float32 でも桁落ちせず、ヒストグラムの刻み (1e-3) より十分細かい。
+    """
+    out = np.empty(ra.size, dtype=np.float64)
+    for s in range(0, ra.size, chunk):
+        a = np.asarray(embeddings[ra[s:s + chunk]], dtype=np.float32)
+        b = np.asarray(embeddings[rb[s:s + chunk]], dtype=np.float32)
+        if metric == "cosine":
+            a, b = unit_rows(a), unit_rows(b)
+        diff = a - b
+        sq = np.einsum("ij,ij->i", diff, diff)
+        # 単位ベクトルでは |u-v|^2 / 2 = 1 - cos
+        out[s:s + chunk] = sq / 2.0 if metric == "cosine" else np.sqrt(sq)
+    return out
+
+
+@dataclass
+class Curve:
+    """1つのラベルの閾値ごとの混同行列 (thresholds[i] 以下を陽性と予測)。"""
+    label: str
+    thresholds: np.ndarray
+    tp: np.ndarray
+    fp: np.ndarray
+    positives: int
+    negatives: int
+
+    @property
+    def fn(self) -> np.ndarray:
+        return self.positives - self.tp
+
+    @property
+    def recall(self) -> np.ndarray:
+        return self.tp / max(self.positives, 1)
+
+    @property
+    def fpr(self) -> np.ndarray:
+        return self.fp / max(self.negatives, 1)
+
+    @property
+    def precision(self) -> np.ndarray:
+        predicted = self.tp + self.fp
+        return np.divide(self.tp, predicted, out=np.ones(predicted.shape), where=predicted > 0)
+
+    @property
+    def f1(self) -> np.ndarray:
+        p, r = self.precision, self.recall
+        return np.divide(2 * p * r, p + r, out=np.zeros(p.shape), where=(p + r) > 0)
+
+    def auc(self) -> Optional[float]:
+        """ROC 曲線の下側面積 (陽性・陰性の両方が無ければ None)。"""
+        if self.positives == 0 or self.negatives == 0:
+            return None
+        x = np.concatenate([[0.0], self.fpr, [1.0]])
+        y = np.concatenate([[0.0], self.recall, [1.0]])
+        return float(np.sum((x[1:] - x[:-1]) * (y[1:] + y[:-1]) / 2))
+
+    def best(self, criterion: str = "f1") -> int:
+        """criterion (f1 / youden) が最大になる閾値の位置。同点なら小さい閾値。"""
+        score = self.f1 if criterion == "f1" else self.recall - self.fpr
+        return int(np.argmax(score))
+
+    def at(self, threshold: float) -> int:
+        """閾値 threshold で判定したときの位置 (それ以下で最大の候補)。"""
+        return max(int(np.searchsorted(self.thresholds, threshold + 1e-9, side="right")) - 1, 0)
+
+
+def sweep(distances: np.ndarray, ranks: np.ndarray, bin_width: float = BIN_WIDTH) -> Dict[str, Curve]:
+    """全閾値候補 (bin_width 刻み) の混同行列をラベルごとに求める。"""
+    nbins = int(round(MAX_DISTANCE / bin_width))
+    # 埋め込みの無い顔 (NaN) を含むペアは数えない
+    ok = np.isfinite(distances)
+    distances, ranks = distances[ok], ranks[ok]
+    # ビン k は距離 (k*w, (k+1)*w] (閾値 (k+1)*w で陽性になる)
+    bins = np.clip(np.ceil(distances / bin_width).astype(np.int64) - 1, 0, nbins - 1)
+    hist = np.zeros((len(PAIR_LABELS), nbins), dtype=np.int64)
+    for rank in range(len(PAIR_LABELS)):
+        hist[rank] = np.bincount(bins[ranks == rank], minlength=nbins)
+    cum = np.cumsum(hist, axis=1)
+    thresholds = (np.arange(nbins) + 1) * bin_width
+    curves: Dict[str, Curve] = {}
+    for rank, label in enumerate(PAIR_LABELS[:-1]):
+        tp = cum[:rank + 1].sum(axis=0)
+        fp = cum[rank + 1:].sum(axis=0)
+        curves[label] = Curve(label, thresholds, tp, fp, int(tp[-1]), int(fp[-1]))
+    return curves
+
+
+def choose_thresholds(curves: Dict[str, Curve], criterion: str = "f1",
+                      current: Optional[Dict[str, float]] = None) -> Dict[str, float]:
+    """ラベルごとに最良の閾値を選ぶ。陽性/陰性の無いラベルは現在値のまま。
+
+    twins <= siblings <= similar の順序を保つよう、前の閾値を下回る値は引き上げる。
+    """
+    current = dict(current if current is not None else THRESHOLDS)
+    out: Dict[str, float] = {}
+    floor = 0.0
+    for label in PAIR_LABELS[:-1]:
+        c = curves[label]
+        t = float(round(c.thresholds[c.best(criterion)], 6)) if c.positives and c.negatives else current[label]
+        out[label] = max(t, floor)
+        floor = out[label]
+    return out
+
+
+def report_rows(curves: Dict[str, Curve], chosen: Dict[str, float],
+                current: Optional[Dict[str, float]] = None) -> List[Dict[str, object]]:
+    """ラベルごとの要約 (新旧の閾値での precision/recall/F1/FPR と AUC)。"""
+    current = current if current is not None else THRESHOLDS
+    rows = []
+    for label, c in curves.items():
+        row: Dict[str, object] = {"label": label, "positives": c.positives, "negatives": c.negatives, "auc": c.auc()}
+        for prefix, t in (("current", current[label]), ("new", chosen[label])):
+            i = c.at(t)
+            row[f"{prefix}_threshold"] = round(t, 4)
+            row[f"{prefix}_precision"] = round(float(c.precision[i]), 4)
+            row[f"{prefix}_recall"] = round(float(c.recall[i]), 4)
+            row[f"{prefix}_f1"] = round(float(c.f1[i]), 4)
+            row[f"{prefix}_fpr"] = round(float(c.fpr[i]), 4)
+        rows.append(row)
+    return rows
+
+
+def write_curves(curves: Dict[str, Curve], f: TextIO, every: int = 10):
+    """ROC / precision-recall 曲線を CSV で書く (every ビンごとに1行)。"""
+    writer = csv.writer(f)
+    writer.writerow(["label", "threshold", "tp", "fp", "precision", "recall", "fpr", "f1"])
+    for label, c in curves.items():
+        p, r, fpr, f1 = c.precision, c.recall, c.fpr, c.f1
+        for i in range(every - 1, c.thresholds.size, every):
+            writer.writerow([label, round(float(c.thresholds[i]), 6), int(c.tp[i]), int(c.fp[i]),
+                             round(float(p[i]), 6), round(float(r[i]), 6), round(float(fpr[i]), 6), round(float(f1[i]), 6)])
@@ -1,9 +1,21 @@
 """双子/兄弟/類似/非類似分類ロジック
 距離に基づくヒューリスティック。閾値は暫定で調整可能。
+
+距離はユークリッド距離 (既定) か、L2 正規化した埋め込みのコサイン距離 (1 - cos) を選べる。
+コサイン距離はノルムの差を無視するので、閾値は COSINE_THRESHOLDS を使う。
+
+閾値は設定ファイル (twins-cli calibrate が書き出す JSON) で上書きできる。
+読み込み先は環境変数 TWINS_THRESHOLDS、無ければ ~/.config/twins-recognition/thresholds.json。
+設定ファイルは import 時には読まず、CLI / Web の起動時に runtime_thresholds で読んで
+AnalyzeOptions.thresholds として渡す (THRESHOLDS / COSINE_THRESHOLDS は書き換えない)。
 """
 from dataclasses import dataclass
-from typing import Literal, List, Dict
+from typing import Literal, List, Dict, Mapping, Optional, Sequence, Union
+import json
 import math
+import os
+
+import numpy as np
 
 # 類似度閾値設定（ユーザが後で調整可能）
 THRESHOLDS = {
@@ -11,14 +23,166 @@ THRESHOLDS = {
     "siblings": 0.55,    # twinsより大きく siblings 以下なら兄弟候補
     "similar": 0.60      # siblingsより大きく similar 以下なら単なる似ている人
 }
+# コサイン距離 (1 - cos) の閾値。dlib 埋め込みの典型的なノルム (約 1.35) で THRESHOLDS を
+# 換算した暫定値 (d^2 / 2r^2)。twins-cli calibrate --metric cosine で決め直すこと
+COSINE_THRESHOLDS = {
+    "twins": 0.044,
+    "siblings": 0.083,
+    "similar": 0.099,
+}
+DEFAULT_THRESHOLDS = dict(THRESHOLDS)
+DEFAULT_COSINE_THRESHOLDS = dict(COSINE_THRESHOLDS)
+THRESHOLDS_ENV = "TWINS_THRESHOLDS"
+METRICS = ("euclidean", "cosine")
+# 設定ファイルのキー -> 既定値
+_CONFIG_KEYS = {
+    "thresholds": DEFAULT_THRESHOLDS,
+    "cosine_thresholds": DEFAULT_COSINE_THRESHOLDS,
+}
 
 ClassificationLabel = Literal["twins", "siblings", "similar", "different", "single_person", "no_face"]
 
 
+# (n,128) の float32 配列、または従来どおり float リストのリスト
+EmbeddingsLike = Union[np.ndarray, Sequence[Sequence[float]]]
+
+
 def euclidean_distance(vec1: List[float], vec2: List[float]) -> float:
     return math.sqrt(sum((a - b) ** 2 for a, b in zip(vec1, vec2)))
 
 
+def as_matrix(embeddings: EmbeddingsLike) -> np.ndarray:
+    """埋め込み列を (n, d) の2次元配列にする (既に配列ならコピーしない)。"""
+    arr = np.asarray(embeddings)
+    if arr.size == 0:
+        return arr.reshape(0, arr.shape[-1] if arr.ndim == 2 else 0)
+    if arr.ndim == 1:
+        arr = arr.reshape(1, -1)
+    return arr
+
+
+def thresholds_for(metric: str = "euclidean", thresholds: Optional[Mapping[str, float]] = None) -> Mapping[str, float]:
+    """metric の閾値。thresholds (設定ファイルから読んだ値など) を渡すとそれを返す。"""
+    if thresholds is not None and metric in METRICS:
+        return thresholds
+    if metric == "euclidean":
+        return THRESHOLDS
+    if metric == "cosine":
+        return COSINE_THRESHOLDS
+    raise ValueError(f"距離は {', '.join(METRICS)} のいずれか: {metric}")
+
+
+def config_key(metric: str) -> str:
+    """閾値設定ファイルで metric の閾値を置くキー。"""
+    thresholds_for(metric)
+    return "thresholds" if metric == "euclidean" else f"{metric}_thresholds"
+
+
+def unit_rows(x: np.ndarray) -> np.ndarray:
+    """各行を L2 正規化する (ノルム 0 の行はそのまま)。"""
+    norms = np.sqrt(np.einsum("ij,ij->i", x, x))
+    return x / np.where(norms > 0, norms, 1.0)[:, None]
+
+
+def pairwise_distances(embeddings: EmbeddingsLike, metric: str = "euclidean") -> np.ndarray:
+    """全ペアの距離行列 (n, n) を1回の行列演算で求める。
+
+    ユークリッド距離は |a-b|^2 = |a|^2 + |b|^2 - 2a・b を float64 で計算し、丸め誤差による負値は0に丸める。
+    コサイン距離は正規化した行の内積から 1 - cos を求める。
+    """
+    thresholds_for(metric)
+    x = as_matrix(embeddings).astype(np.float64, copy=False)
+    if metric == "cosine":
+        u = unit_rows(x)
+        d = 1.0 - u @ u.T
+        np.clip(d, 0.0, 2.0, out=d)
+        np.fill_diagonal(d, 0.0)
+        return d
+    sq = np.einsum("ij,ij->i", x, x)
+    d2 = sq[:, None] + sq[None, :] - 2.0 * (x @ x.T)
+    np.maximum(d2, 0.0, out=d2)
+    np.fill_diagonal(d2, 0.0)
+    return np.sqrt(d2)
+
+
+def default_thresholds_path(environ: Optional[Mapping[str, str]] = None) -> str:
+    environ = os.environ if environ is None else environ
+    base = environ.get("XDG_CONFIG_HOME") or os.path.join(os.path.expanduser("~"), ".config")
+    return os.path.join(base, "twins-recognition", "thresholds.json")
+
+
+def _validated(values: Dict, defaults: Dict[str, float], path: str) -> Dict[str, float]:
+    merged = dict(defaults)
+    for label, value in values.items():
+        if label not in merged:
+            raise ValueError(f"不明な閾値ラベル {label!r}: {path}")
+        if not isinstance(value, (int, float)) or not 0 < value <= 2:
+            raise ValueError(f"閾値 {label} は 0 より大きく 2 以下の数: {value!r}")
+        merged[label] = float(value)
+    if not merged["twins"] <= merged["siblings"] <= merged["similar"]:
+        raise ValueError(f"閾値は twins <= siblings <= similar の順である必要があります: {merged}")
+    return merged
+
+
+def read_thresholds(path: str) -> Dict[str, Dict[str, float]]:
+    """閾値設定ファイルを読んで検証し、キー (thresholds / cosine_thresholds) -> 閾値 を返す。
+
+    ラベル -> 値 だけの辞書はユークリッド距離の閾値とみなす。書かれていないキーは既定値。
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if not isinstance(data, dict):
+        raise ValueError(f"閾値設定の形式が不正です: {path}")
+    if not any(key in data for key in _CONFIG_KEYS):
+        data = {"thresholds": data}
+    out = {}
+    for key, defaults in _CONFIG_KEYS.items():
+        values = data.get(key, {})
+        if not isinstance(values, dict):
+            raise ValueError(f"閾値設定の形式が不正です ({key}): {path}")
+        out[key] = _validated(values, defaults, path)
+    return out
+
+
+def runtime_thresholds(metric: str = "euclidean", path: Optional[str] = None,
+                       environ: Optional[Mapping[str, str]] = None) -> Dict[str, float]:
+    """設定ファイルを反映した metric の閾値を返す (グローバルの閾値は書き換えない)。
+
+    path を省略すると environ (既定は os.environ) の TWINS_THRESHOLDS、無ければ既定の場所を見て、
+    ファイルが無ければ既定値を返す。壊れた設定ファイルは ValueError / OSError。
+    """
+    key = config_key(metric)
+    if path is None:
+        environ = os.environ if environ is None else environ
+        path = environ.get(THRESHOLDS_ENV) or default_thresholds_path(environ)
+        if not os.path.exists(path):
+            return dict(_CONFIG_KEYS[key])
+    return read_thresholds(path)[key]
+
+
+def label_for_distance(dist: float, metric: str = "euclidean",
+                       thresholds: Optional[Mapping[str, float]] = None) -> ClassificationLabel:
+    t = thresholds_for(metric, thresholds)
+    if dist <= t["twins"]:
+        return "twins"
+    if dist <= t["siblings"]:
+        return "siblings"
+    if dist <= t["similar"]:
+        return "similar"
+    return "different"
+
+
+_DISTANCE_LABELS = np.array(["twins", "siblings", "similar", "different"])
+
+
+def labels_for_distances(dist: np.ndarray, metric: str = "euclidean",
+                         thresholds: Optional[Mapping[str, float]] = None) -> np.ndarray:
+    """label_for_distance の配列版 (ラベル文字列の配列を返す)。"""
+    t = thresholds_for(metric, thresholds)
+    edges = np.array([t["twins"], t["siblings"], t["similar"]])
+    return _DISTANCE_LABELS[np.searchsorted(edges, np.asarray(dist), side="left")]
+
+
 @dataclass
 class TwinClassificationResult:
     label: ClassificationLabel
@@ -28,35 +192,39 @@ class TwinClassificationResult:
 
 def classify_pair(embedding1: List[float], embedding2: List[float]) -> TwinClassificationResult:
     dist = euclidean_distance(embedding1, embedding2)
-    if dist <= THRESHOLDS["twins"]:
-        label: ClassificationLabel = "twins"
-    elif dist <= THRESHOLDS["siblings"]:
-        label = "siblings"
-    elif dist <= THRESHOLDS["similar"]:
-        label = "similar"
-    else:
-        label = "different"
+    label = label_for_distance(dist)
     return TwinClassificationResult(label=label, distance=dist, detail={"distance": dist})
 
 
-def classify_embeddings(embeddings: List[List[float]]) -> TwinClassificationResult:
-    if len(embeddings) == 0:
+def classify_embeddings(embeddings: EmbeddingsLike, metric: str = "euclidean",
+                        thresholds: Optional[Mapping[str, float]] = None) -> TwinClassificationResult:
+    """最も近い顔ペアの距離で分類する。thresholds を省略すると metric の既定の閾値。"""
+    x = as_matrix(embeddings)
+    n = x.shape[0]
+    if n == 0:
         return TwinClassificationResult(label="no_face", distance=None, detail={})
-    if len(embeddings) == 1:
+    if n == 1:
         return TwinClassificationResult(label="single_person", distance=None, detail={})
     # 2つだけ比較（>2 の場合は最も距離が小さいペアを採用して代表分類）
-    if len(embeddings) == 2:
-        return classify_pair(embeddings[0], embeddings[1])
-    # 3人以上: 全組合せから最小距離ペア
-    min_dist = float("inf")
-    best = None
-    for i in range(len(embeddings)):
-        for j in range(i + 1, len(embeddings)):
-            d = euclidean_distance(embeddings[i], embeddings[j])
-            if d < min_dist:
-                min_dist = d
-                best = (embeddings[i], embeddings[j])
-    result = classify_pair(best[0], best[1])  # type: ignore
-    result.detail["faces_count"] = len(embeddings)
-    result.detail["min_pair_distance"] = min_dist
+    if n == 2:
+        i, j = 0, 1
+    else:
+        # 3人以上: 距離行列を一括計算し、上三角から最小距離ペアを選ぶ
+        d = pairwise_distances(x, metric)
+        d[np.tril_indices(n)] = np.inf
+        i, j = np.unravel_index(int(np.argmin(d)), d.shape)
+    # 代表ペアの距離は差分から直接求め直す (行列計算の桁落ちを避ける)
+    a, b = x[i].astype(np.float64), x[j].astype(np.float64)
+    if metric == "cosine":
+        na, nb = np.linalg.norm(a), np.linalg.norm(b)
+        diff = a / (na or 1.0) - b / (nb or 1.0)
+        dist = float(np.dot(diff, diff) / 2.0)   # 単位ベクトルでは |u-v|^2 / 2 = 1 - cos
+    else:
+        diff = a - b
+        dist = float(np.sqrt(np.dot(diff, diff)))
+    result = TwinClassificationResult(label=label_for_distance(dist, metric, thresholds), distance=dist, detail={"distance": dist})
+    if n > 2:
+        result.detail["faces_count"] = n
+        result.detail["min_pair_distance"] = dist
     return result
+
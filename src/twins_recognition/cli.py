@@ -2,130 +2,599 @@
 使い方:
     python3 -m twins_recognition.cli --image path/to/img.jpg
     python3 -m twins_recognition.cli --folder path/to/images
+    python3 -m twins_recognition.cli --folder path/to/images --workers 4
+    python3 -m twins_recognition.cli --folder path/to/images --workers 4 --chunksize 16 --profile
+    python3 -m twins_recognition.cli --folder path/to/images --no-cache
+    python3 -m twins_recognition.cli --folder path/to/images --jsonl --output results.jsonl
+    python3 -m twins_recognition.cli --folder path/to/images --journal run.journal --output results.json
+    python3 -m twins_recognition.cli search build --folder path/to/images --index path/to/index
+    python3 -m twins_recognition.cli search query --index path/to/index --image path/to/img.jpg
+    python3 -m twins_recognition.cli cluster --index path/to/index --folder path/to/images --output clusters.csv
+    python3 -m twins_recognition.cli calibrate --store path/to/store --pairs pairs.csv --output thresholds.json
+    python3 -m twins_recognition.cli video --input path/to/video.mp4 --stride 5
+    python3 -m twins_recognition.cli --daemon &
+    python3 -m twins_recognition.cli --use-daemon --image path/to/img.jpg
 """
+from contextlib import nullcontext
 import argparse
 import json
 import os
-from typing import List
+import sys
+import tempfile
+import time
+from typing import Iterable, Iterator, List, Optional
 
-from .processor import analyze_image
+from .batch import analyze_batch
+from .cache import default_cache_dir
+from .classifier import runtime_thresholds, thresholds_for
+from .dedup import DEFAULT_MAX_DISTANCE
+from .detector import DEFAULT_TILE_OVERLAP
+from .processor import AnalyzeOptions
+from .quantize import KINDS
+from .scanner import SUPPORTED_EXT, background, scan_images, sniff_image
+from .journal import Journal, atomic_write, write_jsonl
+from .stats import RunningSummary, StageStats
+from .store import EmbeddingStore, write_json_array
 from typing import Dict
 
-try:
-    from PIL import Image  # Pillow がサポートする拡張を利用
-except ImportError:
-    Image = None  # Pillow未インストールでも最低限動く（face_recognition内部でPIL必要）
-
-# Pillow標準対応 + よく使われる形式を追加 (HEIC/AVIF は別途プラグインが必要なので除外)
-SUPPORTED_EXT = {
-    ".jpg", ".jpeg", ".png", ".bmp", ".webp", ".tif", ".tiff", ".gif",
-    ".jp2", ".ppm", ".pnm", ".pbm", ".pgm"
-}
-
 
 def is_image_file(path: str) -> bool:
     ext = os.path.splitext(path)[1].lower()
     if ext in SUPPORTED_EXT:
         return True
-    # 拡張子で弾かれたが Pillow が開ける可能性を一応確認（パフォーマンス目的で例外は握りつぶす）
-    if Image is not None:
-        try:
-            with Image.open(path):
-                return True
-        except Exception:
-            return False
-    return False
+    # 拡張子で判定できない場合は先頭バイトのマジックナンバーで判定 (Pillow で開くより軽い)
+    return sniff_image(path)
+
+
+def iter_images(folder: str, scan_workers: int = 8, manifest: Optional[str] = None) -> Iterator[str]:
+    """フォルダを走査し、見つけた画像パスを逐次返す (ディレクトリごとに名前順)。"""
+    return scan_images(folder, probe_workers=scan_workers, manifest_path=manifest)
 
 
 def collect_images(folder: str) -> List[str]:
-    paths: List[str] = []
-    for root, _, files in os.walk(folder):
-        for f in files:
-            full = os.path.join(root, f)
-            if is_image_file(full):
-                paths.append(full)
-    return sorted(paths)
+    return sorted(iter_images(folder))
+
+
+def add_analysis_args(parser: argparse.ArgumentParser):
+    """解析設定 (並列数/検出設定/キャッシュ) の共通オプション。"""
+    parser.add_argument("--workers", type=int, default=1, help="並列ワーカープロセス数 (既定: 1 = 逐次)")
+    parser.add_argument("--chunksize", type=int, default=4, help="ワーカーへ一度に渡す画像枚数 (この単位でまとめて検出・エンコード)")
+    parser.add_argument("--batch-size", type=int, default=32, help="エンコーダ (cnn は検出も) へ一度に渡す顔/画像の数")
+    parser.add_argument("--batch-memory-mb", type=int, default=256, help="ワーカーがまとめて保持するデコード済み画像の上限 (MB)")
+    parser.add_argument("--model", choices=["hog", "cnn"], default="hog", help="顔検出モデル")
+    parser.add_argument("--upsample", type=int, default=1, help="顔検出時のアップサンプル回数")
+    parser.add_argument("--max-side", type=int, default=None, help="検出時に長辺をこの画素数まで縮小 (埋め込みは原寸で計算)")
+    parser.add_argument("--tile-size", type=int, default=None,
+                        help="長辺がこの画素数を超える画像は重なり合うタイルに分けて検出し、顔の周りだけで埋め込みを計算する (8k 超のパノラマ・集合写真向け)")
+    parser.add_argument("--tile-overlap", type=int, default=DEFAULT_TILE_OVERLAP, help="タイルの重なり (画素。写っている最大の顔より大きく)")
+    parser.add_argument("--cache-dir", type=str, default=default_cache_dir(), help="顔位置/埋め込みキャッシュの保存先")
+    parser.add_argument("--cache-max-mb", type=int, default=1024, help="キャッシュ容量上限 (MB, 超過分は古い順に削除)")
+    parser.add_argument("--no-cache", action="store_true", help="キャッシュを使わない")
+    parser.add_argument("--dedup", action="store_true",
+                        help="解析済みの画像と同じ/ほぼ同じ画像 (再エンコード・縮小) は検出・エンコードを省いて結果を流用する")
+    parser.add_argument("--dedup-distance", type=int, default=DEFAULT_MAX_DISTANCE,
+                        help="ほぼ同じとみなす知覚ハッシュ (dHash 64bit) のビット差 (連写も拾うなら 6〜10 程度)")
+    parser.add_argument("--metric", choices=["euclidean", "cosine"], default="euclidean",
+                        help="分類に使う距離 (cosine は正規化した埋め込みの 1 - cos と COSINE_THRESHOLDS)")
+    parser.add_argument("--thresholds", type=str, default=None,
+                        help="分類閾値の設定ファイル (twins-cli calibrate の出力。省略時は TWINS_THRESHOLDS または既定の場所)")
+    parser.add_argument("--profile-every", type=int, default=0,
+                        help="約 1/N の画像を cProfile/tracemalloc 付きで解析し --profile-dir へ保存 (0 で無効)")
+    parser.add_argument("--profile-dir", type=str, default="twins-profile", help="詳細プロファイルの出力先")
+
+
+def configured_thresholds(metric: str, path: Optional[str] = None,
+                          environ: Optional[Dict[str, str]] = None) -> Dict[str, float]:
+    """実行時の閾値 (--thresholds、無ければ TWINS_THRESHOLDS / 既定の場所の設定ファイル)。
+
+    明示したファイルの誤りはそのまま送出し、暗黙の設定ファイルが壊れていれば既定値で続ける。
+    """
+    if path:
+        return runtime_thresholds(metric, path)
+    try:
+        return runtime_thresholds(metric, environ=environ)
+    except (OSError, ValueError) as e:
+        print(f"閾値設定を読み込めないため既定値を使います: {e}", file=sys.stderr)
+        return dict(thresholds_for(metric))
+
+
+def analysis_options(args: argparse.Namespace, environ: Optional[Dict[str, str]] = None) -> AnalyzeOptions:
+    """引数から解析設定を作る。閾値は AnalyzeOptions に載せてワーカーへ渡す (グローバルは変えない)。"""
+    return AnalyzeOptions(
+        model=args.model,
+        upsample=args.upsample,
+        max_side=args.max_side,
+        cache_dir=None if args.no_cache else args.cache_dir,
+        cache_max_bytes=args.cache_max_mb * 1024 * 1024,
+        batch_size=args.batch_size,
+        batch_memory_mb=args.batch_memory_mb,
+        profile_every=args.profile_every,
+        profile_dir=args.profile_dir if args.profile_every > 0 else None,
+        dedup=args.dedup,
+        dedup_distance=args.dedup_distance,
+        metric=args.metric,
+        tile_size=args.tile_size,
+        tile_overlap=args.tile_overlap,
+        thresholds=configured_thresholds(args.metric, args.thresholds, environ),
+    )
+
+
+def ja_label(label: str) -> str:
+    return {
+        'twins': '双子',
+        'siblings': '兄弟/姉妹/兄妹/姉弟',
+        'similar': '類似',
+        'different': '異なる',
+        'single_person': '単一人物',
+        'no_face': '顔未検出',
+    }.get(label, label)
+
+
+def index_folder(index, folder: str, args: argparse.Namespace, options: AnalyzeOptions) -> int:
+    """フォルダ内の未登録画像を解析してインデックスへ追加し、追加した顔数を返す。"""
+    paths = [p for p in collect_images(folder) if p not in index]
+    added = 0
+    for item in analyze_batch(paths, workers=args.workers, chunksize=args.chunksize, options=options):
+        if item.analysis is None:
+            print(f"error\t{item.path}\t{item.error}", file=sys.stderr)
+            continue
+        added += index.add(item.analysis)
+    return added
+
+
+def search_main(argv: List[str]):
+    """twins-cli search: 画像コレクション横断の顔検索"""
+    from .index import EmbeddingIndex, hits_to_dicts
+
+    parser = argparse.ArgumentParser(prog="twins-cli search", description="画像間の双子/兄弟候補検索")
+    sub = parser.add_subparsers(dest="command", required=True)
+    b = sub.add_parser("build", help="フォルダを解析してインデックスへ追加")
+    b.add_argument("--folder", type=str, required=True, help="登録する画像フォルダ")
+    b.add_argument("--index", type=str, required=True, help="インデックス保存ディレクトリ")
+    b.add_argument("--ivf", type=int, default=0, help="近似検索用 IVF のリスト数 (0 = 学習しない)")
+    add_analysis_args(b)
+    q = sub.add_parser("query", help="画像内の各顔に近い顔を検索")
+    q.add_argument("--index", type=str, required=True, help="インデックス保存ディレクトリ")
+    q.add_argument("--image", type=str, required=True, help="クエリ画像")
+    q.add_argument("--k", type=int, default=10, help="返す近傍数")
+    q.add_argument("--radius", choices=["twins", "siblings", "similar"], default=None,
+                   help="k近傍の代わりに THRESHOLDS[ラベル] 以下の顔をすべて返す")
+    q.add_argument("--nprobe", type=int, default=None, help="IVF 近似検索で走査するリスト数 (省略時は厳密検索)")
+    q.add_argument("--include-self", action="store_true", help="クエリ画像自身の顔も結果に含める")
+    q.add_argument("--pretty", action="store_true", help="整形して表示")
+    add_analysis_args(q)
+    args = parser.parse_args(argv)
+    if args.metric != "euclidean":
+        parser.error("search のインデックスはユークリッド距離のみ対応です (--metric cosine は使えません)")
+    options = analysis_options(args)
+
+    if args.command == "build":
+        index = EmbeddingIndex.open(args.index)
+        added = index_folder(index, args.folder, args, options)
+        if args.ivf:
+            index.train_ivf(args.ivf)
+        index.save(args.index)
+        print(f"added_faces: {added}\ntotal_faces: {len(index)}\nimages: {len(index.paths)}")
+        return
+
+    index = EmbeddingIndex.load(args.index)
+    analysis = next(analyze_batch([args.image], options=options))
+    if analysis.analysis is None:
+        print(f"error\t{args.image}\t{analysis.error}", file=sys.stderr)
+        sys.exit(1)
+    a = analysis.analysis
+    exclude = None if args.include_self else a.path
+    if args.radius:
+        results = index.radius_search(a.embeddings, label=args.radius, nprobe=args.nprobe, exclude_path=exclude,
+                                      thresholds=options.thresholds)
+    else:
+        results = index.search(a.embeddings, k=args.k, nprobe=args.nprobe, exclude_path=exclude,
+                               thresholds=options.thresholds)
+    out = [{"face": list(face), "hits": hits} for face, hits in zip(a.faces, hits_to_dicts(results))]
+    print(json.dumps(out, ensure_ascii=False, indent=2 if args.pretty else None))
+
+
+def cluster_main(argv: List[str]):
+    """twins-cli cluster: 検索インデックスの全顔を人物/家族クラスタにまとめる"""
+    from .cluster import DEFAULT_BLOCK, LEVELS, build_clusters, cluster_summary, describe, iter_table, write_table
+    from .index import EmbeddingIndex
+
+    parser = argparse.ArgumentParser(prog="twins-cli cluster", description="顔の人物クラスタ (双子) / 家族クラスタ (兄弟姉妹)")
+    parser.add_argument("--index", type=str, required=True, help="インデックス保存ディレクトリ (クラスタも同じ場所に保存)")
+    parser.add_argument("--folder", type=str, default=None, help="未登録の画像を解析してから併合する")
+    parser.add_argument("--output", type=str, default=None, help="クラスタ表 (1行1顔) の保存先")
+    parser.add_argument("--format", choices=["csv", "jsonl"], default="csv", help="クラスタ表の形式")
+    parser.add_argument("--min-size", type=int, default=1, help="この顔数未満の家族クラスタは表に出さない")
+    parser.add_argument("--nprobe", type=int, default=None, help="IVF 学習済みなら近いリスト同士だけを比べる (近似)")
+    parser.add_argument("--block", type=int, default=DEFAULT_BLOCK, help="距離計算のブロックの顔数 (メモリは block^2 に比例)")
+    parser.add_argument("--rebuild", action="store_true", help="保存済みのクラスタを使わず全顔から作り直す")
+    add_analysis_args(parser)
+    args = parser.parse_args(argv)
+    if args.metric != "euclidean":
+        parser.error("cluster はユークリッド距離のみ対応です (--metric cosine は使えません)")
+
+    index = EmbeddingIndex.open(args.index)
+    added_faces = 0
+    if args.folder:
+        added_faces = index_folder(index, args.folder, args, analysis_options(args))
+        index.save(args.index)
+    if len(index) == 0:
+        print("インデックスに顔がありません (--folder で画像を追加してください)", file=sys.stderr)
+        return 1
+    t0 = time.perf_counter()
+    thresholds = configured_thresholds("euclidean", args.thresholds)
+    clusters, merged = build_clusters(index, args.index, block=args.block, nprobe=args.nprobe, rebuild=args.rebuild,
+                                      radii={level: thresholds[level] for level in LEVELS})
+    cols = describe(clusters, index.image_ids)
+    if args.output:
+        atomic_write(args.output, lambda f: write_table(iter_table(index, cols, args.min_size), f, args.format))
+    print(f"added_faces: {added_faces}\nmerged_faces: {merged}\ncluster_seconds: {time.perf_counter() - t0:.3f}")
+    for key, value in cluster_summary(cols).items():
+        print(f"{key}: {value}")
+    return 0
+
+
+def calibrate_main(argv: List[str]):
+    """twins-cli calibrate: 保存済みの埋め込みと正解ペアから分類閾値を決め直す"""
+    from .calibrate import (BIN_WIDTH, EmbeddingTable, choose_thresholds, pair_distances, read_pairs,
+                            report_rows, resolve_rows, sweep, write_curves)
+    from .classifier import METRICS, config_key, default_thresholds_path
+
+    parser = argparse.ArgumentParser(prog="twins-cli calibrate", description="正解ラベル付きの顔ペアによる閾値の較正 (再検出なし)")
+    src = parser.add_mutually_exclusive_group(required=True)
+    src.add_argument("--store", type=str, help="埋め込みを読むバイナリストア (--store で保存したもの)")
+    src.add_argument("--index", type=str, help="埋め込みを読む検索インデックス")
+    parser.add_argument("--pairs", type=str, required=True, help="正解ペアの CSV (path_a,face_a,path_b,face_b,label)")
+    parser.add_argument("--metric", choices=METRICS, default="euclidean", help="較正する距離 (cosine は COSINE_THRESHOLDS)")
+    parser.add_argument("--criterion", choices=["f1", "youden"], default="f1",
+                        help="閾値の選び方 (f1: F1 最大 / youden: 再現率 - 誤検出率 が最大)")
+    parser.add_argument("--bin-width", type=float, default=BIN_WIDTH, help="閾値を走査する刻み幅 (距離)")
+    parser.add_argument("--output", type=str, default=None, help="閾値設定ファイル (JSON) の保存先")
+    parser.add_argument("--install", action="store_true", help=f"既定の場所 ({default_thresholds_path()}) へ保存する")
+    parser.add_argument("--curves", type=str, default=None, help="ROC / precision-recall 曲線を CSV で保存")
+    parser.add_argument("--json", action="store_true", help="要約を JSON で表示")
+    args = parser.parse_args(argv)
+
+    t0 = time.perf_counter()
+    table = EmbeddingTable.from_store(args.store) if args.store else EmbeddingTable.from_index(args.index)
+    try:
+        with open(args.pairs, "r", encoding="utf-8", newline="") as f:
+            ra, rb, ranks, skipped = resolve_rows(table, read_pairs(f), os.path.dirname(os.path.abspath(args.pairs)))
+    except ValueError as e:
+        print(f"{args.pairs}: {e}", file=sys.stderr)
+        return 2
+    if ra.size == 0:
+        print("埋め込みを引けるペアがありません (パス・顔番号を確認してください)", file=sys.stderr)
+        return 1
+    t1 = time.perf_counter()
+    current = configured_thresholds(args.metric)
+    curves = sweep(pair_distances(table.embeddings, ra, rb, args.metric), ranks, args.bin_width)
+    chosen = choose_thresholds(curves, args.criterion, current)
+    rows = report_rows(curves, chosen, current)
+    t2 = time.perf_counter()
+
+    outputs = [p for p in (args.output, default_thresholds_path() if args.install else None) if p]
+    for path in outputs:
+        # 既存の設定ファイルは、もう一方の距離の閾値を残したまま今回の距離の分だけ置き換える
+        config = {}
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    config = json.load(f)
+                if not isinstance(config, dict):
+                    raise ValueError("JSON オブジェクトではありません")
+            except (OSError, ValueError) as e:
+                # 壊れた設定は実行時にも使われない (既定値になる) ので、今回の結果だけで作り直す
+                print(f"{path}: 既存の設定を読み込めないため作り直します: {e}", file=sys.stderr)
+                config = {}
+        config.update({config_key(args.metric): chosen, "criterion": args.criterion, "pairs": int(ra.size),
+                       "source": os.path.abspath(args.store or args.index)})
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        atomic_write(path, lambda f: json.dump(config, f, ensure_ascii=False, indent=2))
+    if args.curves:
+        atomic_write(args.curves, lambda f: write_curves(curves, f))
+
+    if args.json:
+        print(json.dumps({"pairs": int(ra.size), "skipped": skipped, "metric": args.metric, "current": dict(current),
+                          "thresholds": chosen, "labels": rows}, ensure_ascii=False, indent=2))
+    else:
+        print(f"pairs: {ra.size}\nskipped: {skipped}\nload_seconds: {t1 - t0:.3f}\nsweep_seconds: {t2 - t1:.3f}")
+        for row in rows:
+            auc = "-" if row["auc"] is None else f"{row['auc']:.4f}"
+            print(f"{row['label']}\tpos={row['positives']} neg={row['negatives']} auc={auc}")
+            for prefix in ("current", "new"):
+                print(f"  {prefix:7s} {row[prefix + '_threshold']:.3f}  precision={row[prefix + '_precision']:.4f}"
+                      f" recall={row[prefix + '_recall']:.4f} f1={row[prefix + '_f1']:.4f} fpr={row[prefix + '_fpr']:.4f}")
+    for path in outputs:
+        print(f"保存しました: {path}", file=sys.stderr)
+    return 0
+
+
+def video_main(argv: List[str]):
+    """twins-cli video: 動画/カメラ映像の顔トラックごとの分類"""
+    from .video import VideoOptions, VideoStats, track_video
+
+    parser = argparse.ArgumentParser(prog="twins-cli video", description="動画内の顔を追跡し、トラックごとに分類")
+    parser.add_argument("--input", type=str, required=True, help="動画ファイル / カメラ番号 / RTSP・HTTP の URL")
+    parser.add_argument("--stride", type=int, default=5, help="何フレームごとに解析するか")
+    parser.add_argument("--motion-threshold", type=float, default=0.01, help="平均輝度差がこれ未満のフレームは検出を省略 (0 で無効)")
+    parser.add_argument("--scene-threshold", type=float, default=0.25, help="平均輝度差がこれ以上ならシーン切り替えとしてトラックを閉じる")
+    parser.add_argument("--keyframe-interval", type=int, default=10, help="変化が無くても解析フレームこの数ごとに検出する")
+    parser.add_argument("--iou", type=float, default=0.3, help="同じトラックとみなす顔枠の IoU 下限")
+    parser.add_argument("--max-age", type=int, default=3, help="見失ってからトラックを閉じるまでの解析フレーム数")
+    parser.add_argument("--model", choices=["hog", "cnn"], default="hog", help="顔検出モデル")
+    parser.add_argument("--upsample", type=int, default=1, help="顔検出時のアップサンプル回数")
+    parser.add_argument("--max-side", type=int, default=None, help="検出時に長辺をこの画素数まで縮小")
+    parser.add_argument("--thresholds", type=str, default=None,
+                        help="分類閾値の設定ファイル (twins-cli calibrate の出力。省略時は TWINS_THRESHOLDS または既定の場所)")
+    parser.add_argument("--output", type=str, default=None, help="結果の保存先 (JSON / --jsonl なら JSON Lines)")
+    parser.add_argument("--jsonl", action="store_true", help="トラックが閉じるたびに1行ずつ出力")
+    parser.add_argument("--brief", action="store_true", help="簡潔表示 (トラック 区間 ラベル 距離 相手)")
+    parser.add_argument("--pretty", action="store_true", help="整形して表示")
+    parser.add_argument("--summary", action="store_true", help="トラックのラベル件数と処理フレーム数を表示")
+    args = parser.parse_args(argv)
+
+    options = VideoOptions(stride=args.stride, motion_threshold=args.motion_threshold,
+                           scene_threshold=args.scene_threshold, keyframe_interval=args.keyframe_interval,
+                           iou_threshold=args.iou, max_age=args.max_age)
+    analyze = AnalyzeOptions(model=args.model, upsample=args.upsample, max_side=args.max_side,
+                             thresholds=configured_thresholds("euclidean", args.thresholds))
+    stats = VideoStats()
+    summary = RunningSummary()
+    tracks: List[Dict] = []
+    jsonl = None
+    if args.jsonl:
+        sinks = [sys.stdout]
+        if args.output:
+            sinks.append(open(args.output, "w", encoding="utf-8"))
+        jsonl = JsonlWriter(sinks)
+    try:
+        for tr in track_video(args.input, options, analyze, stats):
+            cls = tr.classification
+            assert cls is not None
+            summary.add(cls.label, cls.distance)
+            d = tr.to_dict()
+            d["classification"]["label_ja"] = ja_label(cls.label)
+            if jsonl is not None:
+                jsonl.write(d)
+            elif args.brief:
+                dist = f"{cls.distance:.3f}" if cls.distance is not None else "-"
+                other = tr.nearest_track if tr.nearest_track is not None else "-"
+                print(f"{tr.track_id}\t{tr.first_time:.2f}-{tr.last_time:.2f}\t{ja_label(cls.label)}\t{dist}\t{other}", flush=True)
+            else:
+                tracks.append(d)
+    except FileNotFoundError as e:
+        print(f"error\t{args.input}\t{e}", file=sys.stderr)
+        sys.exit(1)
+    except KeyboardInterrupt:
+        # カメラ/ストリーム入力は Ctrl+C で終了し、そこまでの結果を出力する
+        pass
+    finally:
+        if jsonl is not None:
+            jsonl.close()
+
+    if jsonl is None and not args.brief:
+        out = {"input": args.input, "tracks": tracks, "summary": summary.to_dict(), "stats": stats.to_dict()}
+        text = json.dumps(out, ensure_ascii=False, indent=2 if args.pretty else None)
+        print(text)
+        if args.output:
+            atomic_write(args.output, lambda f: f.write(text))
+    if args.summary:
+        total = summary.total or 1
+        print("\n# summary")
+        for label, cnt in summary.counts.items():
+            print(f"{ja_label(label)}: {cnt} ({cnt/total*100:.1f}%)")
+        print(f"frames: {stats.frames_read} (解析 {stats.frames_decoded}, 検出 {stats.frames_detected}, "
+              f"省略 {stats.frames_gated})  tracks: {stats.tracks}")
+
+
+# twins-cli <サブコマンド> ... で呼び出す追加機能
+SUBCOMMANDS = {
+    "search": search_main,
+    "cluster": cluster_main,
+    "calibrate": calibrate_main,
+    "video": video_main,
+}
 
 
-def main():
+def main(argv: Optional[List[str]] = None):
+    argv = sys.argv[1:] if argv is None else argv
+    # --daemon: モデルを常駐させて待ち受ける / --use-daemon: 常駐プロセスで実行する
+    if "--daemon" in argv:
+        from .daemon import daemon_main
+        return daemon_main(argv)
+    if "--use-daemon" in argv or os.environ.get("TWINS_USE_DAEMON"):
+        from .daemon import forward
+        argv = [a for a in argv if a != "--use-daemon"]
+        code = forward(argv)
+        if code is not None:
+            return code
+        print("デーモンに接続できないため、このプロセスで実行します", file=sys.stderr)
+    if argv and argv[0] in SUBCOMMANDS:
+        return SUBCOMMANDS[argv[0]](argv[1:])
     parser = argparse.ArgumentParser(description="双子識別 (ローカル) CLI")
     g = parser.add_mutually_exclusive_group(required=True)
     g.add_argument("--image", type=str, help="単一画像パス")
-    g.add_argument("--folder", type=str, help="フォルダ内画像を一括処理")
+    g.add_argument("--folder", type=str,
+                   help="フォルダ内画像を一括処理 (出力順はディレクトリ内の画像を名前順 → サブディレクトリを名前順に深さ優先)")
     parser.add_argument("--output", type=str, help="結果JSON保存パス", default=None)
     parser.add_argument("--pretty", action="store_true", help="整形して表示")
     parser.add_argument("--brief", action="store_true", help="結果を1行/画像で要約 (label 距離 顔数 パス)")
     parser.add_argument("--summary", action="store_true", help="全体集計 (各ラベル件数と割合) を表示")
-    args = parser.parse_args()
+    parser.add_argument("--profile", "--stage-stats", dest="profile", action="store_true",
+                        help="段階ごとの処理枚数・速度 (枚/秒)・1枚あたり時間のパーセンタイルを標準エラーへ表示")
+    parser.add_argument("--jsonl", action="store_true", help="1画像1行の JSON Lines で画像ごとに逐次出力")
+    parser.add_argument("--scan-workers", type=int, default=8, help="拡張子の無いファイルを判定する並列スレッド数")
+    parser.add_argument("--manifest", type=str, default=None, help="フォルダ走査結果の保存先 (再走査時に未変更ディレクトリを省略)")
+    parser.add_argument("--journal", type=str, default=None, help="完了済み画像を記録するジャーナル (再実行時は続きから再開)")
+    parser.add_argument("--store", type=str, default=None, help="結果を追記するバイナリストアのディレクトリ (埋め込み含む)")
+    parser.add_argument("--store-dtype", choices=list(KINDS), default="float32",
+                        help="ストアの埋め込み表現 (新規作成時のみ。float16n/int8n は正規化した半精度/8bit とノルム)")
+    parser.add_argument("--daemon", action="store_true", help="モデルを読み込んだまま常駐し、--use-daemon の実行を受け付ける (--socket, --stop)")
+    parser.add_argument("--use-daemon", action="store_true", help="常駐プロセスで実行する (環境変数 TWINS_USE_DAEMON=1 でも可)")
+    add_analysis_args(parser)
+    args = parser.parse_args(argv)
+    options = analysis_options(args)
 
     if args.image:
-        analyses = [analyze_image(args.image)]
+        paths: Iterable[str] = [args.image]
     else:
-        imgs = collect_images(args.folder)
-        analyses = [analyze_image(p) for p in imgs]
+        # 別スレッドで走査しながら解析へ流す (全件の一覧・ソートを待たない)
+        paths = background(iter_images(args.folder, scan_workers=args.scan_workers, manifest=args.manifest))
 
     # 通常JSON（日本語ラベルも付与）
-    def ja_label(label: str) -> str:
-        return {
-            'twins': '双子',
-            'siblings': '兄弟/姉妹/兄妹/姉弟',
-            'similar': '類似',
-            'different': '異なる',
-            'single_person': '単一人物',
-            'no_face': '顔未検出',
-        }.get(label, label)
-
-    out = [a.to_dict() for a in analyses]
-    for item in out:
+    def with_label_ja(item: Dict) -> Dict:
         cls = item.get('classification', {})
         if 'label' in cls:
             cls['label_ja'] = ja_label(cls['label'])
+        return item
 
-    if args.brief:
-        # label 距離(3桁) faces path
-        def ja_label_brief(label: str) -> str:
-            return {
-                'twins': '双子',
-                'siblings': '兄弟/姉妹/兄妹/姉弟',
-                'similar': '類似',
-                'different': '異なる',
-                'single_person': '単一人物',
-                'no_face': '顔未検出',
-            }.get(label, label)
-        for a in analyses:
-            cls = a.classification
-            dist = cls.distance
-            dist_str = f"{dist:.3f}" if dist is not None else "-"
-            print(f"{ja_label_brief(cls.label)}\t{dist_str}\t{len(a.faces)}\t{a.path}")
-    else:
-        text = json.dumps(out, ensure_ascii=False, indent=2 if args.pretty else None)
-        print(text)
+    # --journal: 完了済み画像を追記記録し、再実行時はサイズ/mtime 不変の画像を飛ばす
+    journal = Journal(args.journal) if args.journal else None
+    order: List[str] = []   # ジャーナル使用時の最終出力の並び
+    summary = RunningSummary()
+
+    def pending(paths: Iterable[str]) -> Iterator[str]:
+        for p in paths:
+            if journal is not None:
+                order.append(p)
+                if journal.is_done(p):
+                    e = journal.entries[os.path.abspath(p)]
+                    summary.add(e.label, e.distance)  # type: ignore[arg-type]
+                    continue
+            yield p
+
+    # JSON 配列出力は最後にストア (ジャーナル使用時はジャーナル) から生成する。
+    # --jsonl/--brief は逐次出力なので --store 指定時のみ保存
+    json_array = not (args.brief or args.jsonl)
+    tmp_store = None
+    store = None
+    if args.store is not None:
+        store = EmbeddingStore(args.store, dtype=args.store_dtype)
+    elif json_array and journal is None:
+        tmp_store = tempfile.TemporaryDirectory(prefix="twins_store_")
+        store = EmbeddingStore(tmp_store.name, dtype=args.store_dtype)
+    first_index = store.n_images if store is not None else 0
+
+    stage_stats = StageStats() if args.profile else None
+    started = time.perf_counter()
+
+    sinks = [sys.stdout]
+    if args.jsonl and args.output and journal is None:
+        sinks.append(open(args.output, "w", encoding="utf-8"))
+    jsonl = JsonlWriter(sinks) if args.jsonl else None
+
+    try:
+        # 失敗は画像単位で記録し、全体は止めない
+        for it in analyze_batch(pending(paths), workers=args.workers, chunksize=args.chunksize, options=options,
+                                stats=stage_stats):
+            # 結果の書き出し (ジャーナル/ストア/JSONL/表示) も output 段階として計測する
+            with (stage_stats.stage("output") if stage_stats is not None else nullcontext()):
+                a = it.analysis
+                if a is None:
+                    summary.add_error()
+                    err = {"path": os.path.abspath(it.path), "error": it.error}
+                    if journal is not None:
+                        journal.record(it.path, err)
+                    if store is not None:
+                        store.append_error(it.path, it.error)
+                    if jsonl is not None:
+                        jsonl.write(err)
+                    if args.brief:
+                        print(f"エラー\t-\t-\t{os.path.abspath(it.path)}\t{it.error}", flush=True)
+                    continue
+                summary.add(a.classification.label, a.classification.distance, a.duplicate is not None)
+                if journal is not None:
+                    journal.record(it.path, a.to_dict())
+                if store is not None:
+                    store.append(a)
+                if jsonl is not None:
+                    jsonl.write(with_label_ja(a.to_dict()))
+                if args.brief:
+                    # label 距離(3桁) faces path
+                    dist = a.classification.distance
+                    dist_str = f"{dist:.3f}" if dist is not None else "-"
+                    dup = f"\t重複: {a.duplicate['of']}" if a.duplicate is not None else ""
+                    print(f"{ja_label(a.classification.label)}\t{dist_str}\t{len(a.faces)}\t{a.path}{dup}", flush=True)
+    except KeyboardInterrupt:
+        if journal is not None:
+            journal.close()
+            print(f"\n中断しました。同じ --journal {args.journal} で再実行すると続きから再開します", file=sys.stderr)
+        sys.exit(130)
+    finally:
+        if jsonl is not None:
+            jsonl.close()
+        if store is not None:
+            store.close()
+
+    def final_records() -> Iterator[Dict]:
+        if journal is not None:
+            return (with_label_ja(r) for r in journal.results(order))
+        return (with_label_ja(r) for r in store.iter_records(start=first_index))  # type: ignore[union-attr]
+
+    indent = 2 if args.pretty else None
+    t_write = time.perf_counter()
+    if json_array:
+        write_json_array(final_records(), sys.stdout, indent=indent)
+        sys.stdout.write("\n")
         if args.output:
-            with open(args.output, "w", encoding="utf-8") as f:
-                f.write(text)
+            atomic_write(args.output, lambda f: write_json_array(final_records(), f, indent=indent))
+    elif args.jsonl and args.output and journal is not None:
+        # ジャーナル使用時は再開分も含めた全件を最後にまとめて書き出す
+        atomic_write(args.output, lambda f: write_jsonl(final_records(), f))
+    if stage_stats is not None:
+        # 最後の一括書き出しは枚数に数えず秒数だけ加える
+        stage_stats.add("output", time.perf_counter() - t_write, 0)
+    if journal is not None:
+        journal.close()
+    if tmp_store is not None:
+        tmp_store.cleanup()
+    if stage_stats is not None:
+        # 段階別の秒数はワーカー合計なので、全体の速度は経過時間から別に出す
+        elapsed = time.perf_counter() - started
+        done = summary.total + summary.errors
+        print(f"# profile (workers={args.workers})\n{stage_stats.format()}", file=sys.stderr)
+        print(f"全体: {done} 枚 {elapsed:.3f} 秒 {done / elapsed if elapsed > 0 else 0:.2f} 枚/秒", file=sys.stderr)
 
     if args.summary:
-        from collections import Counter
-        labels = [a.classification.label for a in analyses]
-        c = Counter(labels)
-        total = sum(c.values()) or 1
+        total = summary.total or 1
         print("\n# summary")
-        for label, cnt in c.items():
-            shown = {
-                'twins': '双子',
-                'siblings': '兄弟/姉妹/兄妹/姉弟',
-                'similar': '類似',
-                'different': '異なる',
-                'single_person': '単一人物',
-                'no_face': '顔未検出',
-            }.get(label, label)
-            print(f"{shown}: {cnt} ({cnt/total*100:.1f}%)")
-        # 平均距離 (twins/siblings/similar/different のみ)
-        dists = [a.classification.distance for a in analyses if a.classification.distance is not None]
-        if dists:
-            import statistics
-            print(f"mean_distance: {statistics.mean(dists):.3f}")
-            print(f"median_distance: {statistics.median(dists):.3f}")
+        for label, cnt in summary.counts.items():
+            print(f"{ja_label(label)}: {cnt} ({cnt/total*100:.1f}%)")
+        if summary.errors:
+            print(f"エラー: {summary.errors}")
+        if summary.duplicates:
+            print(f"重複 (結果を流用): {summary.duplicates}")
+        # 平均距離 (twins/siblings/similar/different のみ)。中央値はヒストグラムからの推定
+        if summary.n_distances:
+            print(f"mean_distance: {summary.mean:.3f}")
+            print(f"median_distance: {summary.median:.3f}")
+
+
+class JsonlWriter:
+    """1画像1行の JSON Lines 出力。一定時間ごとに flush して途中経過を確認できるようにする。"""
+
+    def __init__(self, files, flush_interval: float = 1.0):
+        self.files = files
+        self.flush_interval = flush_interval
+        self._last_flush = time.monotonic()
+
+    def write(self, record: Dict):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        for f in self.files:
+            f.write(line)
+        now = time.monotonic()
+        if now - self._last_flush >= self.flush_interval:
+            for f in self.files:
+                f.flush()
+            self._last_flush = now
+
+    def close(self):
+        for f in self.files:
+            f.flush()
+            if f is not sys.stdout:
+                f.close()
+
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,274 @@
+"""コレクション全体の顔クラスタリング
+検索インデックス (index.EmbeddingIndex) に登録した全顔を、classifier.THRESHOLDS の
+距離で結んだグラフの連結成分にまとめる。
+- 人物クラスタ: THRESHOLDS["twins"] 以下で連結 (同一人物。同じ写真の2つの顔が入れば双子)
+- 家族クラスタ: THRESHOLDS["siblings"] 以下で連結 (人物クラスタを2つ以上含めば兄弟姉妹)
+
+距離はブロック単位の行列積で求め (メモリは block^2 に比例)、閾値以下のペアだけを
+union-find に取り込む。クラスタ済みの顔数を保存しておき、インデックスに追加された顔は
+既存の全顔とのペアだけを調べて併合する (全体の再計算はしない)。
+IVF を学習済みのインデックスでは nprobe を指定すると、近いリスト同士だけを比べる近似計算になる。
+クラスタ番号はクラスタ内で最も小さい顔番号 (併合しても既存の番号は小さい側に揃う)。
+"""
+from typing import Any, Dict, Iterator, Optional, TextIO, Tuple
+import csv
+import json
+import os
+
+import numpy as np
+
+from .classifier import THRESHOLDS
+from .index import _RADIUS_MARGIN, EmbeddingIndex, _sq_norms
+
+CLUSTER_VERSION = 1
+LEVELS = ("twins", "siblings")     # 人物クラスタ / 家族クラスタ
+DEFAULT_BLOCK = 4096               # 1ブロックの顔数 (距離行列は block^2 * 4 バイト)
+
+
+def find_roots(parent: np.ndarray, x: np.ndarray) -> np.ndarray:
+    """x の各要素の根 (親をたどり切った番号) を返す。親は常に自分以下の番号。"""
+    r = parent[x]
+    while True:
+        rr = parent[r]
+        if np.array_equal(rr, r):
+            return r
+        r = rr
+
+
+def union_edges(parent: np.ndarray, a: np.ndarray, b: np.ndarray):
+    """辺 (a[i], b[i]) をまとめて併合する。根の大きい側を小さい側へつなぐ。"""
+    while a.size:
+        ra, rb = find_roots(parent, a), find_roots(parent, b)
+        diff = ra != rb
+        if not diff.any():
+            return
+        lo = np.minimum(ra[diff], rb[diff])
+        hi = np.maximum(ra[diff], rb[diff])
+        # 同じ hi への書き込みが競合したら1つだけ残るので、残りは次の周回で併合する
+        parent[hi] = lo
+        a, b = lo, hi
+
+
+def compress(parent: np.ndarray):
+    """全要素の親を根に張り替える (以降 parent がそのままクラスタ番号になる)。"""
+    while True:
+        pp = parent[parent]
+        if np.array_equal(pp, parent):
+            return
+        parent[:] = pp
+
+
+def _block_pairs(q: np.ndarray, q_rows: np.ndarray, x: np.ndarray, x_rows: np.ndarray,
+                 radius: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """q と x の組のうち距離が radius 以下の (q の行, x の行, 距離)。"""
+    d2 = _sq_norms(q)[:, None] + _sq_norms(x)[None, :] - 2.0 * (q @ x.T)
+    qi, xi = np.nonzero(d2 <= (radius + _RADIUS_MARGIN) ** 2)
+    a, b = q_rows[qi], x_rows[xi]
+    keep = b < a
+    qi, xi, a, b = qi[keep], xi[keep], a[keep], b[keep]
+    # float32 の粗い判定で拾った候補は差分から float64 で求め直す
+    diff = q[qi].astype(np.float64) - x[xi].astype(np.float64)
+    dist = np.sqrt(np.einsum("ij,ij->i", diff, diff))
+    keep = dist <= radius
+    return a[keep], b[keep], dist[keep]
+
+
+def radius_pairs(x: np.ndarray, start: int, radius: float, block: int = DEFAULT_BLOCK,
+                 ivf=None, nprobe: Optional[int] = None) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """行 start 以降の顔と、それより前を含む全顔との距離 radius 以下のペアを順に返す。
+
+    各ペアは (大きい行, 小さい行) で1回ずつ。ivf と nprobe を渡すと近いリスト同士だけを比べる。
+    """
+    n = x.shape[0]
+    if ivf is not None and nprobe is not None:
+        yield from _ivf_pairs(x, start, radius, block, ivf, nprobe)
+        return
+    for i0 in range(start, n, block):
+        i1 = min(n, i0 + block)
+        q = np.asarray(x[i0:i1], dtype=np.float32)
+        q_rows = np.arange(i0, i1)
+        for j0 in range(0, i1, block):
+            j1 = min(i1, j0 + block)
+            yield _block_pairs(q, q_rows, np.asarray(x[j0:j1], dtype=np.float32), np.arange(j0, j1), radius)
+
+
+def _ivf_pairs(x: np.ndarray, start: int, radius: float, block: int, ivf, nprobe: int):
+    nprobe = max(1, min(nprobe, ivf.nlist))
+    c = ivf.centroids
+    near = np.argsort(_sq_norms(c)[None, :] - 2.0 * (c @ c.T), axis=1)[:, :nprobe]
+    lists = [ivf.order[ivf.offsets[i]:ivf.offsets[i + 1]] for i in range(ivf.nlist)]
+    for li in range(ivf.nlist):
+        rows = lists[li][lists[li] >= start]
+        if rows.size == 0:
+            continue
+        cand = np.sort(np.concatenate([lists[j] for j in near[li]]))
+        for i0 in range(0, rows.size, block):
+            q_rows = rows[i0:i0 + block]
+            q = np.asarray(x[q_rows], dtype=np.float32)
+            for j0 in range(0, cand.size, block):
+                x_rows = cand[j0:j0 + block]
+                # 新しい顔同士は (大きい行, 小さい行) の向きでだけ拾われる
+                yield _block_pairs(q, q_rows, np.asarray(x[x_rows], dtype=np.float32), x_rows, radius)
+
+
+class FaceClusters:
+    """人物/家族クラスタの union-find。parents[level][i] は顔 i のクラスタ番号。"""
+
+    def __init__(self, radii: Optional[Dict[str, float]] = None):
+        self.radii = dict(radii) if radii is not None else {level: THRESHOLDS[level] for level in LEVELS}
+        self.parents: Dict[str, np.ndarray] = {level: np.empty(0, dtype=np.int64) for level in LEVELS}
+        self.pairs = 0   # これまでに見つけた siblings 以下のペア数
+
+    @property
+    def n_faces(self) -> int:
+        return self.parents[LEVELS[0]].size
+
+    def update(self, embeddings: np.ndarray, block: int = DEFAULT_BLOCK, ivf=None,
+               nprobe: Optional[int] = None) -> int:
+        """まだクラスタに入れていない顔 (行 n_faces 以降) を併合し、その数を返す。"""
+        start, n = self.n_faces, embeddings.shape[0]
+        if n <= start:
+            return 0
+        for level in LEVELS:
+            self.parents[level] = np.concatenate([self.parents[level], np.arange(start, n, dtype=np.int64)])
+        outer = max(self.radii.values())
+        for a, b, dist in radius_pairs(embeddings, start, outer, block, ivf, nprobe):
+            self.pairs += a.size
+            for level in LEVELS:
+                m = dist <= self.radii[level]
+                union_edges(self.parents[level], a[m], b[m])
+        for level in LEVELS:
+            compress(self.parents[level])
+        return n - start
+
+    def labels(self, level: str) -> np.ndarray:
+        return self.parents[level]
+
+    # --- 永続化 (インデックスと同じディレクトリに置く) ---
+
+    def save(self, root: str):
+        os.makedirs(root, exist_ok=True)
+        for level in LEVELS:
+            tmp = os.path.join(root, f".clusters_{level}.tmp.npy")
+            np.save(tmp, self.parents[level])
+            os.replace(tmp, os.path.join(root, f"clusters_{level}.npy"))
+        meta = {"version": CLUSTER_VERSION, "radii": self.radii, "n_faces": self.n_faces, "pairs": self.pairs}
+        tmp = os.path.join(root, ".clusters.json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(tmp, os.path.join(root, "clusters.json"))
+
+    @classmethod
+    def open(cls, root: str, radii: Optional[Dict[str, float]] = None) -> "FaceClusters":
+        """保存済みのクラスタを読む。閾値が変わっていれば空から作り直す。"""
+        clusters = cls(radii)
+        p = os.path.join(root, "clusters.json")
+        if not os.path.exists(p):
+            return clusters
+        with open(p, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("version") != CLUSTER_VERSION or meta.get("radii") != clusters.radii:
+            return clusters
+        for level in LEVELS:
+            clusters.parents[level] = np.load(os.path.join(root, f"clusters_{level}.npy"))
+        clusters.pairs = int(meta.get("pairs", 0))
+        return clusters
+
+
+def describe(clusters: FaceClusters, image_ids: np.ndarray) -> Dict[str, np.ndarray]:
+    """顔ごとのクラスタ番号・大きさ・種別を列として返す。
+
+    person_kind: 同じ写真の顔を2つ以上含む人物クラスタは "twins"、それ以外は "person"
+    family_kind: 人物クラスタを2つ以上含む家族クラスタは "siblings"、それ以外は "single"
+    """
+    person = clusters.labels("twins")
+    family = clusters.labels("siblings")
+    n = person.size
+    image_ids = np.asarray(image_ids[:n], dtype=np.int64)
+    person_size = np.bincount(person, minlength=n)[person]
+    family_size = np.bincount(family, minlength=n)[family]
+    # (人物クラスタ, 画像) の組が重複していれば同じ写真に2人 = 双子
+    key = person * (int(image_ids.max(initial=0)) + 1) + image_ids
+    uniq, counts = np.unique(key, return_counts=True)
+    twin_flag = np.zeros(n, dtype=bool)
+    twin_flag[uniq[counts > 1] // (int(image_ids.max(initial=0)) + 1)] = True
+    # 家族クラスタごとの人物クラスタ数
+    pairs = np.unique(np.stack([family, person], axis=1), axis=0) if n else np.empty((0, 2), dtype=np.int64)
+    persons_in_family = np.bincount(pairs[:, 0], minlength=n)[family] if n else np.empty(0, dtype=np.int64)
+    return {
+        "person": person,
+        "person_size": person_size,
+        "person_kind": np.where(twin_flag[person], "twins", "person"),
+        "family": family,
+        "family_size": family_size,
+        "family_persons": persons_in_family,
+        "family_kind": np.where(persons_in_family > 1, "siblings", "single"),
+    }
+
+
+def cluster_summary(cols: Dict[str, np.ndarray]) -> Dict[str, Any]:
+    person_roots = np.unique(cols["person"])
+    family_roots = np.unique(cols["family"])
+    twins = np.unique(cols["person"][cols["person_kind"] == "twins"])
+    siblings = np.unique(cols["family"][cols["family_kind"] == "siblings"])
+    return {
+        "faces": int(cols["person"].size),
+        "persons": int(person_roots.size),
+        "twin_clusters": int(twins.size),
+        "families": int(family_roots.size),
+        "sibling_clusters": int(siblings.size),
+    }
+
+
+TABLE_COLUMNS = ["face", "path", "top", "right", "bottom", "left", "person", "person_size", "person_kind",
+                 "family", "family_size", "family_persons", "family_kind"]
+
+
+def iter_table(index: EmbeddingIndex, cols: Dict[str, np.ndarray], min_size: int = 1) -> Iterator[Dict[str, Any]]:
+    """顔1行のクラスタ表 (家族クラスタ番号 → 人物クラスタ番号 → 顔番号の順)。
+
+    min_size は家族クラスタの最小顔数 (2 なら1枚にしか写っていない孤立した顔を省く)。
+    """
+    image_ids = index.image_ids
+    faces = index.face_boxes
+    rows = np.flatnonzero(cols["family_size"] >= min_size)
+    rows = rows[np.lexsort((rows, cols["person"][rows], cols["family"][rows]))]
+    for i in rows:
+        t, r, b, l = (int(v) for v in faces[i])
+        yield {
+            "face": int(i), "path": index.paths[int(image_ids[i])], "top": t, "right": r, "bottom": b, "left": l,
+            "person": int(cols["person"][i]), "person_size": int(cols["person_size"][i]),
+            "person_kind": str(cols["person_kind"][i]), "family": int(cols["family"][i]),
+            "family_size": int(cols["family_size"][i]), "family_persons": int(cols["family_persons"][i]),
+            "family_kind": str(cols["family_kind"][i]),
+        }
+
+
+def write_table(rows: Iterator[Dict[str, Any]], f: TextIO, fmt: str = "csv"):
+    if fmt == "jsonl":
+        for r in rows:
+            f.write(json.dumps(r, ensure_ascii=False) + "\n")
+        return
+    writer = csv.DictWriter(f, fieldnames=TABLE_COLUMNS)
+    writer.writeheader()
+    for r in rows:
+        writer.writerow(r)
+
+
+def build_clusters(index: EmbeddingIndex, root: str, block: int = DEFAULT_BLOCK,
+                   nprobe: Optional[int] = None, rebuild: bool = False,
+                   radii: Optional[Dict[str, float]] = None) -> Tuple[FaceClusters, int]:
+    """インデックス root のクラスタを更新して保存し、(クラスタ, 今回併合した顔数) を返す。
+
+    rebuild または保存時より顔数が減った (インデックスを作り直した) 場合は全顔から作り直す。
+    radii (レベル -> 距離) を省略すると THRESHOLDS。
+    """
+    clusters = FaceClusters.open(root, radii)
+    if rebuild or clusters.n_faces > len(index):
+        clusters = FaceClusters(radii)
+    added = clusters.update(index.embeddings, block=block, ivf=index.ivf if nprobe else None, nprobe=nprobe)
+    clusters.save(root)
+    return clusters, added
+
+
+
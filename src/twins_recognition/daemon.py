@@ -0,0 +1,255 @@
+"""常駐プロセス (twins-cli --daemon)
+モデル (dlib の検出器/ランドマーク/エンコーダ) を読み込んだまま Unix ソケットで待ち受け、
+クライアント (twins-cli --use-daemon ...) から渡された引数で CLI を実行する。
+小さなジョブを繰り返し実行するときに、毎回のモデル読み込み (数秒) を省ける。
+
+プロトコル (1行1 JSON):
+    クライアント -> {"argv": [...], "cwd": "...", "env": {名前: 値 or null}}  または {"op": "stop"}
+    デーモン     -> {"stream": "stdout" | "stderr", "data": "..."} を出力のたびに送り、
+                   最後に {"exit": 終了コード}
+ジョブは1件ずつ順に実行する (dlib の呼び出しはもともとプロセス内で直列化される)。
+実行中だけクライアントの環境変数 (CLIENT_ENV) に置き換え、終了後は元に戻して
+要求ごとの状態 (キャッシュの接続、重複画像の索引) を捨てる。モデルだけを持ち越す。
+このモジュールは標準ライブラリのみを import する (クライアント側を軽く保つため)。
+"""
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, TextIO
+import argparse
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+import traceback
+
+
+# クライアントから引き継ぐ環境変数 (設定ファイル・キャッシュの場所と閾値、ワーカー数)
+CLIENT_ENV = ("HOME", "XDG_CACHE_HOME", "XDG_CONFIG_HOME", "TWINS_THRESHOLDS", "TWINS_WORKERS")
+
+
+def client_environ() -> Dict[str, Optional[str]]:
+    return {name: os.environ.get(name) for name in CLIENT_ENV}
+
+
+def default_socket_path() -> str:
+    """ユーザーごとのソケットパス (TWINS_DAEMON_SOCKET で変更可)。"""
+    env = os.environ.get("TWINS_DAEMON_SOCKET")
+    if env:
+        return env
+    base = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    uid = os.getuid() if hasattr(os, "getuid") else 0
+    return os.path.join(base, f"twins-cli-{uid}.sock")
+
+
+def _send(f, msg: Dict[str, Any]):
+    f.write(json.dumps(msg, ensure_ascii=False).encode("utf-8") + b"\n")
+    f.flush()
+
+
+class _RemoteStream:
+    """書き込みをそのままクライアントへ送る stdout/stderr の代わり。"""
+
+    def __init__(self, f, name: str):
+        self._f = f
+        self.name = name
+        self.encoding = "utf-8"
+
+    def write(self, data: str) -> int:
+        if data:
+            _send(self._f, {"stream": self.name, "data": data})
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def isatty(self) -> bool:
+        return False
+
+
+@contextmanager
+def _request_environ(env: Dict[str, Optional[str]]) -> Iterator[None]:
+    """CLIENT_ENV のうち env にあるものをクライアントの値 (null なら削除) にし、終了時に元へ戻す。"""
+    saved = {name: os.environ.get(name) for name in CLIENT_ENV}
+
+    def apply(values: Dict[str, Optional[str]]):
+        for name in CLIENT_ENV:
+            if name not in values:
+                continue
+            value = values[name]
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+    apply(env)
+    try:
+        yield
+    finally:
+        apply(saved)
+
+
+def _reset_state():
+    # 前の要求のキャッシュ接続・重複画像の索引を次の要求へ持ち越さない
+    from .cache import close_caches
+    from .dedup import reset_indexes
+    close_caches()
+    reset_indexes()
+
+
+def _run_cli(argv: List[str], cwd: str, f, env: Optional[Dict[str, Optional[str]]] = None) -> int:
+    from .cli import main
+    out, err = _RemoteStream(f, "stdout"), _RemoteStream(f, "stderr")
+    saved = sys.stdout, sys.stderr, os.getcwd()
+    sys.stdout, sys.stderr = out, err
+    try:
+        os.chdir(cwd)
+        with _request_environ(env or {}):
+            try:
+                code = main(argv)
+            finally:
+                _reset_state()
+        return code if isinstance(code, int) else 0
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        print(e.code, file=err)
+        return 1
+    except (BrokenPipeError, ConnectionResetError):
+        raise
+    except Exception:
+        traceback.print_exc(file=err)
+        return 1
+    finally:
+        sys.stdout, sys.stderr = saved[0], saved[1]
+        os.chdir(saved[2])
+
+
+def _handle(conn: socket.socket) -> bool:
+    """1接続分の要求を処理する。停止要求なら False を返す。"""
+    with conn, conn.makefile("rwb") as f:
+        line = f.readline()
+        if not line:
+            return True
+        req = json.loads(line)
+        if req.get("op") == "stop":
+            _send(f, {"exit": 0})
+            return False
+        argv = [a for a in req.get("argv", []) if a not in ("--daemon", "--use-daemon")]
+        try:
+            code = _run_cli(argv, req.get("cwd") or os.getcwd(), f, req.get("env"))
+            _send(f, {"exit": code})
+        except (BrokenPipeError, ConnectionResetError):
+            pass   # クライアントが先に切断した
+    return True
+
+
+def _connect(path: str, timeout: Optional[float] = None) -> Optional[socket.socket]:
+    if not hasattr(socket, "AF_UNIX"):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    sock.settimeout(None)
+    return sock
+
+
+def serve(path: str, log: TextIO = sys.stderr):
+    """モデルを読み込み、path で待ち受ける (停止要求か Ctrl+C まで)。"""
+    if not hasattr(socket, "AF_UNIX"):
+        raise RuntimeError("このプラットフォームは Unix ソケットに対応していません")
+    probe = _connect(path, timeout=1.0)
+    if probe is not None:
+        probe.close()
+        raise RuntimeError(f"デーモンは既に起動しています: {path}")
+    if os.path.exists(path):
+        os.unlink(path)   # 前回の異常終了で残ったソケット
+
+    from .embedding import preload_models
+    t0 = time.perf_counter()
+    preload_models()
+    print(f"モデルを読み込みました ({time.perf_counter() - t0:.1f}s)", file=log, flush=True)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o177)   # 本人のみ接続可 (0600)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(old_umask)
+    server.listen(8)
+    print(f"待ち受け中: {path}", file=log, flush=True)
+    try:
+        while True:
+            conn, _ = server.accept()
+            try:
+                if not _handle(conn):
+                    break
+            except (BrokenPipeError, ConnectionResetError):
+                pass   # クライアントが先に切断した
+            except Exception:
+                traceback.print_exc(file=log)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+    print("デーモンを停止しました", file=log, flush=True)
+
+
+def forward(argv: List[str], path: Optional[str] = None) -> Optional[int]:
+    """デーモンで CLI を実行し、出力を中継して終了コードを返す。接続できなければ None。"""
+    sock = _connect(path or default_socket_path())
+    if sock is None:
+        return None
+    with sock, sock.makefile("rwb") as f:
+        _send(f, {"argv": argv, "cwd": os.getcwd(), "env": client_environ()})
+        for line in f:
+            msg = json.loads(line)
+            if "exit" in msg:
+                return int(msg["exit"])
+            stream = sys.stderr if msg.get("stream") == "stderr" else sys.stdout
+            try:
+                stream.write(msg.get("data", ""))
+                stream.flush()
+            except BrokenPipeError:
+                # 出力先 (head など) が閉じた。切断するとデーモン側の実行も止まる
+                return 1
+    print("デーモンとの接続が切れました", file=sys.stderr)
+    return 1
+
+
+def stop(path: Optional[str] = None) -> bool:
+    sock = _connect(path or default_socket_path())
+    if sock is None:
+        return False
+    with sock, sock.makefile("rwb") as f:
+        _send(f, {"op": "stop"})
+        f.readline()
+    return True
+
+
+def daemon_main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(prog="twins-cli --daemon", description="モデルを常駐させて CLI の要求を待ち受ける")
+    parser.add_argument("--daemon", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--socket", type=str, default=None, help="Unix ソケットのパス (既定: TWINS_DAEMON_SOCKET またはユーザーごとの一時パス)")
+    parser.add_argument("--stop", action="store_true", help="起動中のデーモンを停止する")
+    args = parser.parse_args(argv)
+    path = args.socket or default_socket_path()
+    if args.stop:
+        if not stop(path):
+            print(f"デーモンは起動していません: {path}", file=sys.stderr)
+            return 1
+        return 0
+    try:
+        serve(path)
+    except RuntimeError as e:
+        print(f"エラー: {e}", file=sys.stderr)
+        return 1
+    return 0
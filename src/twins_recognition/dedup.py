@@ -0,0 +1,164 @@
+"""重複・ほぼ重複画像の省略
+再エンコード・縮小・連写などで同じ写真が何枚も含まれるフォルダ向けに、
+画像ごとの内容ハッシュ (SHA-256) と知覚ハッシュ (dHash, 64bit) を索引に記録し、
+解析済みの画像と一致する画像は検出・エンコードを行わずにその結果を流用する。
+
+- 完全一致 (同じバイト列): デコードも省略する
+- ほぼ一致 (dHash のハミング距離が max_distance 以下、縦横比もほぼ同じ):
+  顔位置は解像度の比で拡大縮小し、埋め込みはそのまま使う
+
+連写のように構図が少しずつ動く画像まで流用すると顔位置・埋め込みは近似になるため、
+既定の max_distance は再エンコード・縮小が拾える程度の小さな値にしている。
+索引はプロセス内のメモリに持つ (ワーカープロセスごとに1つ。同じチャンクに入った画像同士で効く)。
+"""
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+import threading
+
+import numpy as np
+
+from .detector import scale_locations
+
+FaceLocation = Tuple[int, int, int, int]
+
+DEFAULT_MAX_DISTANCE = 2
+DEFAULT_MAX_ENTRIES = 20000
+ASPECT_TOLERANCE = 0.01   # 縦横比の相対誤差がこれを超えたら (トリミング等) 別画像とみなす
+MIN_CONTRAST = 8          # 縮小グレースケールの濃淡差がこれ未満の画像は dHash で比較しない
+
+
+def dhash(img: np.ndarray) -> Tuple[int, bool]:
+    """デコード済み画像 (HxWx3) の dHash と、比較に使えるだけの濃淡があるかを返す。"""
+    from PIL import Image
+    small = Image.fromarray(img).convert("L").resize((9, 8), Image.BILINEAR, reducing_gap=2.0)
+    px = np.asarray(small, dtype=np.int16)
+    bits = (px[:, 1:] > px[:, :-1]).reshape(-1)
+    value = int.from_bytes(np.packbits(bits).tobytes(), "big")
+    return value, int(px.max() - px.min()) >= MIN_CONTRAST
+
+
+def hamming(a: np.ndarray, b: int) -> np.ndarray:
+    """uint64 配列 a の各要素と b のビット差の数。"""
+    x = np.bitwise_xor(a, np.uint64(b))
+    return np.unpackbits(x.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+@dataclass
+class Duplicate:
+    """流用元の解析結果 (faces は流用先の解像度に合わせたもの)。"""
+    source: str
+    faces: List[FaceLocation]
+    embeddings: np.ndarray
+    exact: bool
+    distance: int
+
+    def to_dict(self) -> Dict[str, object]:
+        return {"of": self.source, "exact": self.exact, "distance": self.distance}
+
+
+@dataclass
+class _Entry:
+    path: str
+    digest: Optional[str]
+    width: int
+    height: int
+    faces: List[FaceLocation]
+    embeddings: np.ndarray
+
+
+class DuplicateIndex:
+    """解析済み画像の内容ハッシュ/知覚ハッシュの索引 (上限を超えたら古いものから捨てる)。"""
+
+    def __init__(self, max_distance: int = DEFAULT_MAX_DISTANCE, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.max_distance = max_distance
+        self.max_entries = max(1, max_entries)
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[int, _Entry]" = OrderedDict()   # 登録番号 -> 解析結果
+        self._by_digest: Dict[str, int] = {}
+        self._ids = np.empty(0, dtype=np.int64)       # dHash を持つ登録の番号と値 (ハミング距離を一括計算)
+        self._hashes = np.empty(0, dtype=np.uint64)
+        self._next_id = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def exact(self, digest: Optional[str]) -> Optional[Duplicate]:
+        """同じバイト列の画像が解析済みなら、その結果を返す (デコード前に呼べる)。"""
+        if digest is None:
+            return None
+        with self._lock:
+            i = self._by_digest.get(digest)
+            e = self._entries.get(i) if i is not None else None
+            if e is None:
+                return None
+            return Duplicate(e.path, list(e.faces), e.embeddings, True, 0)
+
+    def near(self, phash: int, width: int, height: int) -> Optional[Duplicate]:
+        """dHash が近く縦横比がほぼ同じ解析済み画像の結果を、この解像度に合わせて返す。"""
+        with self._lock:
+            if self._hashes.size == 0:
+                return None
+            d = hamming(self._hashes, phash)
+            for k in np.argsort(d, kind="stable"):
+                if d[k] > self.max_distance:
+                    break
+                e = self._entries.get(int(self._ids[k]))
+                if e is None or abs(width * e.height / (height * e.width) - 1.0) > ASPECT_TOLERANCE:
+                    continue
+                faces = list(e.faces)
+                if (width, height) != (e.width, e.height):
+                    faces = scale_locations(faces, width / e.width, (height, width))
+                return Duplicate(e.path, faces, e.embeddings, False, int(d[k]))
+            return None
+
+    def matches(self, phash: int, width: int, height: int, other: Tuple[int, int, int]) -> bool:
+        """まだ索引に無い画像 other = (dHash, 幅, 高さ) と near() の条件で一致するか。"""
+        oh, ow, oht = other
+        if bin(phash ^ oh).count("1") > self.max_distance:
+            return False
+        return abs(width * oht / (height * ow) - 1.0) <= ASPECT_TOLERANCE
+
+    def add(self, path: str, digest: Optional[str], phash: Optional[int], width: int, height: int,
+            faces: List[FaceLocation], embeddings: np.ndarray):
+        """解析結果を登録する。phash が None (濃淡が乏しい画像) なら完全一致のみで引く。"""
+        with self._lock:
+            i = self._next_id
+            self._next_id += 1
+            self._entries[i] = _Entry(path, digest, width, height, list(faces), embeddings)
+            if digest is not None:
+                self._by_digest[digest] = i
+            if phash is not None:
+                self._ids = np.append(self._ids, i)
+                self._hashes = np.append(self._hashes, np.uint64(phash))
+            if len(self._entries) > self.max_entries:
+                self._evict()
+
+    def _evict(self):
+        drop = len(self._entries) - int(self.max_entries * 0.9)
+        for _ in range(drop):
+            _, e = self._entries.popitem(last=False)
+            if e.digest is not None and self._by_digest.get(e.digest) is not None \
+                    and self._by_digest[e.digest] not in self._entries:
+                del self._by_digest[e.digest]
+        keep = np.isin(self._ids, np.fromiter(self._entries.keys(), dtype=np.int64))
+        self._ids, self._hashes = self._ids[keep], self._hashes[keep]
+
+
+_INDEXES: Dict[Tuple, DuplicateIndex] = {}
+_INDEXES_LOCK = threading.Lock()
+
+
+def get_index(key: Tuple, max_distance: int = DEFAULT_MAX_DISTANCE) -> DuplicateIndex:
+    """検出設定 key ごとにプロセス内で共有する索引を返す。"""
+    with _INDEXES_LOCK:
+        index = _INDEXES.get((key, max_distance))
+        if index is None:
+            index = _INDEXES[(key, max_distance)] = DuplicateIndex(max_distance)
+        return index
+
+
+def reset_indexes():
+    """プロセス内の索引をすべて捨てる (常駐プロセスで要求ごとに状態を分けるため)。"""
+    with _INDEXES_LOCK:
+        _INDEXES.clear()
@@ -2,26 +2,223 @@
 face_recognition ライブラリを用いて画像中の顔位置(トップ,右,ボトム,左)を返す。
 ローカルのみで動作。
 """
-from typing import List, Tuple
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+import io
 import os
+import threading
 
-try:
-    import face_recognition  # type: ignore
-except ImportError as e:
-    raise ImportError("face_recognition がインストールされていません。requirements.txt を参照してください") from e
+import numpy as np
 
 FaceLocation = Tuple[int, int, int, int]
 
+# タイル分割検出 (tile_size 指定時) の既定の重なり幅 (検出する画像上の画素)。
+# これより大きい顔はどのタイルにも収まらないことがある
+DEFAULT_TILE_OVERLAP = 256
+# 重なり (小さい方の顔枠に対する交差の割合) がこれを超える顔位置は同じ顔とみなす
+MERGE_OVERLAP = 0.5
+
+# dlib のモデル (HOG/CNN 検出器, ランドマーク, エンコーダ) は1プロセス内で共有されるため、
+# 複数スレッドから同時に呼ぶと止まることがある。プロセス内の呼び出しはこのロックで直列化する
+# (並列化はプロセスプールで行う)。
+dlib_lock = threading.RLock()
+
+
+def face_recognition_module():
+    """face_recognition を初回使用時に読み込んで返す。
+
+    import 時に dlib とモデルファイル (検出器/ランドマーク/エンコーダ) を読み込むため、
+    --help やキャッシュのみで済む実行では読み込まない。
+    """
+    try:
+        import face_recognition  # type: ignore
+    except ImportError as e:
+        raise ImportError("face_recognition がインストールされていません。requirements.txt を参照してください") from e
+    return face_recognition
+
 
 def load_image(path: str):
     if not os.path.exists(path):
         raise FileNotFoundError(f"画像が存在しません: {path}")
-    return face_recognition.load_image_file(path)
+    return face_recognition_module().load_image_file(path)
+
+
+def load_image_bytes(data: bytes, name: Optional[str] = None):
+    """メモリ上のエンコード済み画像 (JPEG/PNG 等) をデコードする。
+
+    name (元のパスなど) を渡すと、画像として読めないときのエラーに BytesIO の代わりに表示する。
+    """
+    try:
+        return face_recognition_module().load_image_file(io.BytesIO(data))
+    except Exception as e:
+        from PIL import UnidentifiedImageError
+        if name is None or not isinstance(e, UnidentifiedImageError):
+            raise
+        raise UnidentifiedImageError(f"cannot identify image file {name!r}") from e
+
+
+def _locate(img, model: str, upsample: int) -> List[FaceLocation]:
+    with dlib_lock:
+        return face_recognition_module().face_locations(img, number_of_times_to_upsample=upsample, model=model)
+
+
+def needs_tiles(shape, tile: Optional[int]) -> bool:
+    return bool(tile) and max(shape[0], shape[1]) > tile
+
+
+def detect_faces_in_image(img, model: str = "hog", upsample: int = 1, max_side: Optional[int] = None,
+                          tile: Optional[int] = None, tile_overlap: int = DEFAULT_TILE_OVERLAP) -> List[FaceLocation]:
+    """デコード済み画像配列 (RGB, HxWx3 の numpy 配列) から顔位置一覧を返す。
+
+    画像の再デコードを避けたい呼び出し側 (processor など) はこちらを使う。
+    model は "hog" (CPU向け) または "cnn"、upsample は小さい顔向けの拡大回数。
+    max_side を指定すると長辺がそれ以下になるよう縮小した画像で検出し、
+    顔位置は元画像の座標に戻して返す (HOG のコストは画素数に比例するため)。
+    tile を指定すると、(縮小後の) 長辺がそれを超える画像は tile 四方の重なり合うタイルごとに
+    検出する (detect_faces_tiled)。アップサンプル後の画像ピラミッドがタイル単位になるので、
+    パノラマや集合写真でも検出のメモリは解像度によらずほぼ一定になる。
+    """
+    scale = downscale_factor(img.shape, max_side)
+    small = resize_image(img, scale) if scale < 1.0 else img
+    if needs_tiles(small.shape, tile):
+        locations = detect_faces_tiled(small, lambda part: _locate(part, model, upsample), tile, tile_overlap)
+    else:
+        locations = _locate(small, model, upsample)
+    if scale >= 1.0:
+        return locations
+    return scale_locations(locations, 1.0 / scale, img.shape)
+
+
+def tile_grid(height: int, width: int, tile: int, overlap: int = DEFAULT_TILE_OVERLAP) -> List[Tuple[int, int, int, int]]:
+    """画像を覆う tile 四方のタイル (top, left, bottom, right) を overlap ずつ重ねて並べる。
+
+    最後の列/行は画像の端に揃える (端のタイルも tile 四方を保つ)。
+    """
+    step = max(1, tile - max(0, overlap))
+
+    def starts(n: int) -> List[int]:
+        if n <= tile:
+            return [0]
+        return list(range(0, n - tile, step)) + [n - tile]
+
+    return [(y, x, min(height, y + tile), min(width, x + tile)) for y in starts(height) for x in starts(width)]
+
+
+def detect_faces_tiled(img, detect: Callable[[np.ndarray], List[FaceLocation]], tile: int,
+                       overlap: int = DEFAULT_TILE_OVERLAP) -> List[FaceLocation]:
+    """タイルごとに detect した顔位置を画像座標に戻し、重複を merge_boxes でまとめる。
+
+    タイル境界で切れた顔は、overlap が顔より大きければ隣のタイルで丸ごと検出される。
+    """
+    h, w = img.shape[:2]
+    found: List[FaceLocation] = []
+    for top, left, bottom, right in tile_grid(h, w, tile, overlap):
+        part = np.ascontiguousarray(img[top:bottom, left:right])
+        for t, r, b, l in detect(part):
+            found.append((t + top, r + left, b + top, l + left))
+    return merge_boxes(found)
+
+
+def _area(a: FaceLocation) -> int:
+    return max(0, a[2] - a[0]) * max(0, a[1] - a[3])
+
+
+def overlap_ratio(a: FaceLocation, b: FaceLocation) -> float:
+    """交差の面積を小さい方の顔枠の面積で割った値 (切れた顔と丸ごとの顔でも 1 に近い)。"""
+    inter_h = min(a[2], b[2]) - max(a[0], b[0])
+    inter_w = min(a[1], b[1]) - max(a[3], b[3])
+    if inter_h <= 0 or inter_w <= 0:
+        return 0.0
+    return inter_h * inter_w / float(max(1, min(_area(a), _area(b))))
+
+
+def merge_boxes(boxes: Sequence[FaceLocation], threshold: float = MERGE_OVERLAP) -> List[FaceLocation]:
+    """重なりが threshold を超える顔位置は大きい方だけを残す (NMS)。結果は上から・左から順。"""
+    kept: List[FaceLocation] = []
+    for box in sorted(set(boxes), key=lambda b: (-_area(b), b)):
+        if all(overlap_ratio(box, k) <= threshold for k in kept):
+            kept.append(box)
+    return sorted(kept, key=lambda b: (b[0], b[3]))
+
+
+def detect_faces_batch(images: Sequence[np.ndarray], model: str = "hog", upsample: int = 1,
+                       max_side: Optional[int] = None, batch_size: int = 32, tile: Optional[int] = None,
+                       tile_overlap: int = DEFAULT_TILE_OVERLAP) -> List[List[FaceLocation]]:
+    """複数画像の顔位置をまとめて求める。
+
+    cnn は (縮小後の) 同じ大きさの画像ごとに face_recognition.batch_face_locations で
+    一括推論する。hog は一括版が無いので1枚ずつ。タイル分割する大きな画像も1枚ずつ。
+    """
+    if model != "cnn":
+        return [detect_faces_in_image(img, model=model, upsample=upsample, max_side=max_side,
+                                      tile=tile, tile_overlap=tile_overlap) for img in images]
+    out: List[List[FaceLocation]] = [[] for _ in images]
+    groups: Dict[Tuple[int, ...], List[int]] = {}
+    smalls: List[np.ndarray] = []
+    scales: List[float] = []
+    for i, img in enumerate(images):
+        scale = downscale_factor(img.shape, max_side)
+        small = resize_image(img, scale) if scale < 1.0 else img
+        smalls.append(small)
+        scales.append(scale)
+        if needs_tiles(small.shape, tile):
+            found = detect_faces_tiled(small, lambda part: _locate(part, model, upsample), tile, tile_overlap)
+            out[i] = found if scale >= 1.0 else scale_locations(found, 1.0 / scale, img.shape)
+            continue
+        groups.setdefault(tuple(small.shape), []).append(i)
+    for idx in groups.values():
+        with dlib_lock:
+            found = face_recognition_module().batch_face_locations([smalls[i] for i in idx], number_of_times_to_upsample=upsample,
+                                                          batch_size=max(1, batch_size))
+        for i, locations in zip(idx, found):
+            if scales[i] >= 1.0:
+                out[i] = list(locations)
+            else:
+                out[i] = scale_locations(locations, 1.0 / scales[i], images[i].shape)
+    return out
+
+
+def downscale_factor(shape, max_side: Optional[int]) -> float:
+    """長辺を max_side 以下にする縮小率 (縮小不要なら 1.0)。"""
+    if not max_side:
+        return 1.0
+    longest = max(shape[0], shape[1])
+    return min(1.0, max_side / float(longest))
+
+
+def resize_image(img, scale: float):
+    from PIL import Image
+    h, w = img.shape[:2]
+    size = (max(1, int(round(w * scale))), max(1, int(round(h * scale))))
+    # reducing_gap で大きな縮小を高速化 (先に整数倍で間引いてから補間)
+    return np.asarray(Image.fromarray(img).resize(size, Image.BILINEAR, reducing_gap=2.0))
+
+
+def scale_locations(locations: List[FaceLocation], factor: float, shape) -> List[FaceLocation]:
+    """顔位置 (top, right, bottom, left) を factor 倍し、画像範囲内に収める。"""
+    h, w = shape[0], shape[1]
+    out: List[FaceLocation] = []
+    for t, r, b, l in locations:
+        out.append((
+            max(0, int(round(t * factor))),
+            min(w, int(round(r * factor))),
+            min(h, int(round(b * factor))),
+            max(0, int(round(l * factor))),
+        ))
+    return out
+
+
+def iou(a: FaceLocation, b: FaceLocation) -> float:
+    """2つの顔位置 (top, right, bottom, left) の IoU。"""
+    inter_h = min(a[2], b[2]) - max(a[0], b[0])
+    inter_w = min(a[1], b[1]) - max(a[3], b[3])
+    if inter_h <= 0 or inter_w <= 0:
+        return 0.0
+    inter = inter_h * inter_w
+    area_a = (a[2] - a[0]) * (a[1] - a[3])
+    area_b = (b[2] - b[0]) * (b[1] - b[3])
+    return inter / float(area_a + area_b - inter)
 
 
 def detect_faces(path: str) -> List[FaceLocation]:
     """画像パスから顔位置一覧を返す。"""
-    img = load_image(path)
-    # モデルを変えたい場合は face_recognition.face_locations(img, model="cnn") など
-    locations = face_recognition.face_locations(img)
-    return locations
+    return detect_faces_in_image(load_image(path))
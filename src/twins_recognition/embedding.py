@@ -1,17 +1,94 @@
 """顔埋め込み生成モジュール
 検出済み顔領域から128次元の顔エンコーディングを取得。
+顔ごとにランドマークで正規化した 150x150 の切り出し (チップ) を作り、
+エンコーダへはチップをまとめて渡す (face_recognition.face_encodings と同じ結果)。
 """
-from typing import List, Tuple
+from typing import List, Sequence
 
-try:
-    import face_recognition  # type: ignore
-except ImportError as e:
-    raise ImportError("face_recognition がインストールされていません。requirements.txt を参照してください") from e
+import numpy as np
 
-FaceLocation = Tuple[int, int, int, int]
+from .detector import FaceLocation, dlib_lock, face_recognition_module
 
+EMBEDDING_DIM = 128
+# face_recognition.face_encodings (dlib の compute_face_descriptor) と同じ整列設定
+CHIP_SIZE = 150
+CHIP_PADDING = 0.25
+NUM_JITTERS = 1
+# crop=True で切り出す余白 (顔枠の長辺に対する割合)。チップは顔枠の約 1.5 倍を回転して
+# 切り出すので、これだけあれば全体画像から作ったチップと同じ画素になる
+CROP_MARGIN = 1.0
 
-def face_embeddings(image, face_locations: List[FaceLocation]) -> List[List[float]]:
-    """face_recognition で顔埋め込みを取得"""
-    encodings = face_recognition.face_encodings(image, face_locations)
-    return [list(e) for e in encodings]
+
+def _models():
+    """(dlib, face_recognition.api) を返す。初回はモデルファイルの読み込みを伴う。"""
+    face_recognition_module()
+    import dlib  # type: ignore
+    from face_recognition import api  # type: ignore
+    return dlib, api
+
+
+def preload_models():
+    """検出・ランドマーク・エンコーダのモデルを先に読み込んでおく (常駐プロセス用)。"""
+    _models()
+
+
+def empty_embeddings() -> np.ndarray:
+    return np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+
+
+def face_crop(image, location: FaceLocation, margin: float = CROP_MARGIN):
+    """顔枠の周りに margin の余白を付けた切り出し (コピー) と、その左上の座標 (top, left)。"""
+    t, r, b, l = location
+    m = int(max(b - t, r - l) * margin) + 2
+    top, left = max(0, t - m), max(0, l - m)
+    h, w = image.shape[:2]
+    return np.ascontiguousarray(image[top:min(h, b + m), left:min(w, r + m)]), (top, left)
+
+
+def face_chips(image, face_locations: List[FaceLocation], crop: bool = False) -> List[np.ndarray]:
+    """顔ごとに 5点ランドマークで回転・拡縮を揃えた 150x150 の RGB 切り出しを返す。
+
+    チップは元画像より十分小さいので、元画像を先に解放してエンコードをまとめられる。
+    crop=True ならランドマーク推定とチップ作成を顔の周りの小さな切り出し (face_crop) だけで
+    行う (巨大な画像を dlib へ丸ごと渡さない。結果は全体画像から作った場合と同じ)。
+    """
+    if not face_locations:
+        return []
+    dlib, api = _models()
+    predictor = api.pose_predictor_5_point
+    if crop:
+        chips = []
+        with dlib_lock:
+            for loc in face_locations:
+                part, (top, left) = face_crop(image, loc)
+                t, r, b, l = loc
+                shape = predictor(part, dlib.rectangle(l - left, t - top, r - left, b - top))
+                chips.append(dlib.get_face_chip(part, shape, size=CHIP_SIZE, padding=CHIP_PADDING))
+        return chips
+    shapes = dlib.full_object_detections()
+    with dlib_lock:
+        for t, r, b, l in face_locations:
+            shapes.append(predictor(image, dlib.rectangle(l, t, r, b)))
+        return list(dlib.get_face_chips(image, shapes, size=CHIP_SIZE, padding=CHIP_PADDING))
+
+
+def encode_chips(chips: Sequence[np.ndarray], batch_size: int = 32) -> np.ndarray:
+    """チップ列を batch_size 枚ずつエンコーダへ渡し (n, 128) の float32 配列で返す。"""
+    if len(chips) == 0:
+        return empty_embeddings()
+    batch_size = max(1, batch_size)
+    _, api = _models()
+    out = np.empty((len(chips), EMBEDDING_DIM), dtype=np.float32)
+    for start in range(0, len(chips), batch_size):
+        part = list(chips[start:start + batch_size])
+        with dlib_lock:
+            vecs = api.face_encoder.compute_face_descriptor(part, NUM_JITTERS)
+        out[start:start + len(part)] = np.asarray([np.asarray(v) for v in vecs], dtype=np.float32)
+    return out
+
+
+def face_embeddings(image, face_locations: List[FaceLocation], crop: bool = False) -> np.ndarray:
+    """1枚の画像の顔埋め込みを (n, 128) の float32 配列で返す (全顔を1回でエンコード)。"""
+    if not face_locations:
+        return empty_embeddings()
+    return encode_chips(face_chips(image, face_locations, crop=crop))
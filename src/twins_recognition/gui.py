@@ -5,8 +5,9 @@ import threading
 import os
 from typing import List
 
-from .processor import analyze_image
-from .cli import collect_images
+from .batch import analyze_batch, default_workers
+from .cli import collect_images, configured_thresholds
+from .processor import AnalyzeOptions
 
 def ja_label(label: str) -> str:
     return {
@@ -64,15 +65,20 @@ class App(tk.Tk):
     def process_images(self, paths: List[str]):
         self.status.set("処理中...")
         self.tree.delete(*self.tree.get_children())
+        # 1枚だけならプロセス起動コストの方が大きいので逐次
+        workers = default_workers() if len(paths) > 1 else 1
+        # 閾値は CLI と同じく TWINS_THRESHOLDS / 既定の場所の設定ファイルから読む
+        options = AnalyzeOptions(thresholds=configured_thresholds("euclidean"))
         def worker():
-            for p in paths:
-                try:
-                    a = analyze_image(p)
-                    dist = a.classification.distance
-                    shown = ja_label(a.classification.label)
-                    self.tree.insert("", tk.END, values=(shown, f"{dist:.3f}" if dist else "-", len(a.faces)))
-                except Exception as e:
-                    self.tree.insert("", tk.END, values=(f"error:{e}", "-", "-"))
+            for item in analyze_batch(paths, workers=workers, options=options):
+                a = item.analysis
+                if a is None:
+                    self.tree.insert("", tk.END, values=(f"error:{item.error}", "-", "-"))
+                    continue
+                dist = a.classification.distance
+                shown = ja_label(a.classification.label)
+                self.tree.insert("", tk.END, values=(shown, f"{dist:.3f}" if dist else "-", len(a.faces)))
+                self.status.set(f"処理中... {item.index + 1}/{len(paths)}")
             self.status.set("完了")
         threading.Thread(target=worker, daemon=True).start()
 
@@ -0,0 +1,339 @@
+"""画像間の顔検索インデックス
+analyze_image の結果 (顔ごとの埋め込み) を永続化し、コレクション全体に対して
+k近傍検索と半径検索 (twins / siblings 閾値) を行う。距離はユークリッド距離のみ (THRESHOLDS)。
+- 厳密検索: ブロック単位の行列積による総当たり (NumPy のみ)
+- 近似検索: k-means 粗量子化による転置ファイル (IVF) で候補を絞り込む
+"""
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Mapping, Optional, Sequence, Tuple
+import json
+import os
+
+import numpy as np
+
+from .classifier import ClassificationLabel, label_for_distance, thresholds_for
+from .processor import ImageAnalysis
+
+FaceLocation = Tuple[int, int, int, int]
+
+INDEX_VERSION = 1
+EMBEDDING_DIM = 128
+DEFAULT_BLOCK = 65536   # 1ブロックの行数 (float32 で 32MB 程度)
+_RADIUS_MARGIN = 1e-3   # float32 の粗い判定で取りこぼさないための余裕
+
+
+@dataclass
+class SearchHit:
+    path: str
+    face: FaceLocation
+    distance: float
+    label: ClassificationLabel
+
+    def to_dict(self) -> Dict:
+        return {"path": self.path, "face": list(self.face), "distance": self.distance, "label": self.label}
+
+
+def _sq_norms(x: np.ndarray) -> np.ndarray:
+    return np.einsum("ij,ij->i", x, x, dtype=np.float32)
+
+
+def _blocked_scan(q: np.ndarray, x: np.ndarray, x_sq: np.ndarray, block: int):
+    """(開始行, 距離^2 行列 (m, b)) をブロック単位で返す。メモリは m * block に比例。"""
+    q_sq = _sq_norms(q)
+    for start in range(0, x.shape[0], block):
+        xb = np.asarray(x[start:start + block], dtype=np.float32)
+        d2 = q_sq[:, None] + x_sq[None, start:start + xb.shape[0]] - 2.0 * (q @ xb.T)
+        np.maximum(d2, 0.0, out=d2)
+        yield start, d2
+
+
+def _exact_distances(q: np.ndarray, x: np.ndarray, rows: np.ndarray) -> np.ndarray:
+    """候補行との距離を差分から float64 で求め直す。"""
+    diff = np.asarray(x[rows], dtype=np.float64) - q.astype(np.float64)
+    return np.sqrt(np.einsum("ij,ij->i", diff, diff))
+
+
+def kmeans(x: np.ndarray, k: int, iters: int = 20, sample: int = 100_000, seed: int = 0,
+           block: int = DEFAULT_BLOCK) -> np.ndarray:
+    """素朴な Lloyd 法。大きい入力はサンプルで学習する。戻り値は (k, dim) の重心。"""
+    rng = np.random.default_rng(seed)
+    n = x.shape[0]
+    if n < k:
+        raise ValueError(f"IVF のリスト数 {k} が登録顔数 {n} より多いです")
+    rows = np.sort(rng.choice(n, size=min(n, sample), replace=False))
+    data = np.asarray(x[rows], dtype=np.float32)
+    centroids = data[rng.choice(data.shape[0], size=k, replace=False)].copy()
+    for _ in range(iters):
+        assign = _nearest_centroid(data, centroids, block)
+        sums = np.zeros_like(centroids, dtype=np.float64)
+        np.add.at(sums, assign, data)
+        counts = np.bincount(assign, minlength=k)
+        empty = counts == 0
+        centroids = (sums / np.maximum(counts, 1)[:, None]).astype(np.float32)
+        if empty.any():
+            # 空クラスタは適当な点で置き直す
+            centroids[empty] = data[rng.choice(data.shape[0], size=int(empty.sum()), replace=False)]
+    return centroids
+
+
+def _nearest_centroid(x: np.ndarray, centroids: np.ndarray, block: int = DEFAULT_BLOCK) -> np.ndarray:
+    c_sq = _sq_norms(centroids)
+    out = np.empty(x.shape[0], dtype=np.int32)
+    for start in range(0, x.shape[0], block):
+        xb = np.asarray(x[start:start + block], dtype=np.float32)
+        # |x|^2 は argmin に影響しないので省略
+        d = c_sq[None, :] - 2.0 * (xb @ centroids.T)
+        out[start:start + xb.shape[0]] = np.argmin(d, axis=1)
+    return out
+
+
+class IVF:
+    """転置ファイル: 各行を最寄りの重心のリストに割り当てておき、検索時は近いリストだけ走査する。"""
+
+    def __init__(self, centroids: np.ndarray, assignments: np.ndarray):
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.assignments = np.asarray(assignments, dtype=np.int32)
+        self._rebuild()
+
+    def _rebuild(self):
+        self.order = np.argsort(self.assignments, kind="stable").astype(np.int64)
+        self.offsets = np.searchsorted(self.assignments[self.order], np.arange(self.nlist + 1))
+
+    @property
+    def nlist(self) -> int:
+        return self.centroids.shape[0]
+
+    def extend(self, x_new: np.ndarray):
+        """追加された行を既存の重心に割り当てる (再学習はしない)。"""
+        self.assignments = np.concatenate([self.assignments, _nearest_centroid(x_new, self.centroids)])
+        self._rebuild()
+
+    def candidates(self, q: np.ndarray, nprobe: int) -> np.ndarray:
+        d = _sq_norms(self.centroids) - 2.0 * (self.centroids @ q)
+        lists = np.argsort(d)[:max(1, min(nprobe, self.nlist))]
+        parts = [self.order[self.offsets[i]:self.offsets[i + 1]] for i in lists]
+        return np.sort(np.concatenate(parts)) if parts else np.empty(0, dtype=np.int64)
+
+
+class EmbeddingIndex:
+    """顔埋め込みの検索インデックス。1行 = 1顔。"""
+
+    def __init__(self, dim: int = EMBEDDING_DIM):
+        self.dim = dim
+        self.paths: List[str] = []
+        self._path_ids: Dict[str, int] = {}
+        self._emb = np.empty((0, dim), dtype=np.float32)
+        self._image_ids = np.empty(0, dtype=np.int32)
+        self._faces = np.empty((0, 4), dtype=np.int32)
+        self._pending: List[Tuple[np.ndarray, np.ndarray, np.ndarray]] = []
+        self._sq: Optional[np.ndarray] = None
+        self.ivf: Optional[IVF] = None
+
+    def __len__(self) -> int:
+        return self._emb.shape[0] + sum(p[0].shape[0] for p in self._pending)
+
+    def __contains__(self, path: str) -> bool:
+        return os.path.abspath(path) in self._path_ids
+
+    # --- 追加 ---
+
+    def add(self, analysis: ImageAnalysis) -> int:
+        """解析結果の顔を登録し、追加した顔数を返す。登録済みのパスは無視する。
+
+        顔の無い画像もパスだけ登録し、次回の差分追加 (index_folder) で再解析しない。
+        """
+        if analysis.embeddings is None or analysis.path in self._path_ids:
+            return 0
+        emb = np.asarray(analysis.embeddings, dtype=np.float32).reshape(-1, self.dim)
+        image_id = len(self.paths)
+        self.paths.append(analysis.path)
+        self._path_ids[analysis.path] = image_id
+        if emb.shape[0] == 0:
+            return 0
+        faces = np.asarray(analysis.faces, dtype=np.int32).reshape(-1, 4)
+        self._pending.append((emb, np.full(emb.shape[0], image_id, dtype=np.int32), faces))
+        return emb.shape[0]
+
+    def add_all(self, analyses: Iterable[ImageAnalysis]) -> int:
+        return sum(self.add(a) for a in analyses)
+
+    def _consolidate(self):
+        if not self._pending:
+            return
+        new_emb = np.concatenate([p[0] for p in self._pending])
+        self._emb = np.concatenate([np.asarray(self._emb), new_emb])
+        self._image_ids = np.concatenate([np.asarray(self._image_ids)] + [p[1] for p in self._pending])
+        self._faces = np.concatenate([np.asarray(self._faces)] + [p[2] for p in self._pending])
+        self._pending.clear()
+        self._sq = None
+        if self.ivf is not None:
+            self.ivf.extend(new_emb)
+
+    @property
+    def embeddings(self) -> np.ndarray:
+        self._consolidate()
+        return self._emb
+
+    @property
+    def image_ids(self) -> np.ndarray:
+        """各行 (顔) の画像番号 (paths の添字)。"""
+        self._consolidate()
+        return np.asarray(self._image_ids)
+
+    @property
+    def face_boxes(self) -> np.ndarray:
+        """各行 (顔) の顔位置 (top, right, bottom, left)。"""
+        self._consolidate()
+        return np.asarray(self._faces)
+
+    def _norms(self) -> np.ndarray:
+        self._consolidate()
+        if self._sq is None:
+            self._sq = _sq_norms(np.asarray(self._emb, dtype=np.float32))
+        return self._sq
+
+    def train_ivf(self, nlist: int, iters: int = 20, seed: int = 0):
+        """近似検索用の IVF を学習する (目安: nlist ≈ sqrt(顔数))。"""
+        x = self.embeddings
+        centroids = kmeans(x, nlist, iters=iters, seed=seed)
+        self.ivf = IVF(centroids, _nearest_centroid(x, centroids))
+
+    # --- 検索 ---
+
+    def _hit(self, row: int, dist: float, thresholds: Optional[Mapping[str, float]] = None) -> SearchHit:
+        face = tuple(int(v) for v in self._faces[row])
+        return SearchHit(path=self.paths[int(self._image_ids[row])], face=face,  # type: ignore[arg-type]
+                         distance=float(dist), label=label_for_distance(float(dist), thresholds=thresholds))
+
+    def _excluded_rows(self, exclude_path: Optional[str]) -> np.ndarray:
+        if exclude_path is None:
+            return np.empty(0, dtype=np.int64)
+        image_id = self._path_ids.get(os.path.abspath(exclude_path))
+        if image_id is None:
+            return np.empty(0, dtype=np.int64)
+        return np.flatnonzero(np.asarray(self._image_ids) == image_id)
+
+    def search(self, queries, k: int = 10, nprobe: Optional[int] = None,
+               exclude_path: Optional[str] = None, block: int = DEFAULT_BLOCK,
+               thresholds: Optional[Mapping[str, float]] = None) -> List[List[SearchHit]]:
+        """各クエリ埋め込みの k 近傍を距離の昇順で返す。
+
+        nprobe を指定すると IVF による近似検索 (train_ivf が必要)。
+        exclude_path の画像に含まれる顔は結果から除く (同一写真の自己一致除外用)。
+        thresholds (ユークリッド距離の閾値) を省略すると THRESHOLDS でラベルを付ける。
+        """
+        q = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        x_sq = self._norms()
+        excluded = self._excluded_rows(exclude_path)
+        if nprobe is not None:
+            return [self._probe(qi, nprobe, excluded, k=k, thresholds=thresholds) for qi in q]
+        kk = min(k + excluded.size, len(self))
+        if kk == 0:
+            return [[] for _ in range(q.shape[0])]
+        best_d = np.empty((q.shape[0], 0), dtype=np.float32)
+        best_i = np.empty((q.shape[0], 0), dtype=np.int64)
+        for start, d2 in _blocked_scan(q, self._emb, x_sq, block):
+            idx = np.broadcast_to(np.arange(start, start + d2.shape[1]), d2.shape)
+            cand_d = np.concatenate([best_d, d2], axis=1)
+            cand_i = np.concatenate([best_i, idx], axis=1)
+            if cand_d.shape[1] > kk:
+                part = np.argpartition(cand_d, kk - 1, axis=1)[:, :kk]
+                cand_d = np.take_along_axis(cand_d, part, axis=1)
+                cand_i = np.take_along_axis(cand_i, part, axis=1)
+            best_d, best_i = cand_d, cand_i
+        return [self._finish(qi, rows, excluded, k, thresholds=thresholds) for qi, rows in zip(q, best_i)]
+
+    def radius_search(self, queries, label: str = "siblings", nprobe: Optional[int] = None,
+                      exclude_path: Optional[str] = None, block: int = DEFAULT_BLOCK,
+                      thresholds: Optional[Mapping[str, float]] = None) -> List[List[SearchHit]]:
+        """thresholds[label] (省略時は THRESHOLDS) 以下の距離にある顔をすべて返す (twins / siblings など)。"""
+        thresholds = thresholds_for("euclidean", thresholds)
+        radius = thresholds[label]
+        q = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        x_sq = self._norms()
+        excluded = self._excluded_rows(exclude_path)
+        if nprobe is not None:
+            return [self._probe(qi, nprobe, excluded, radius=radius, thresholds=thresholds) for qi in q]
+        limit = (radius + _RADIUS_MARGIN) ** 2
+        found: List[List[np.ndarray]] = [[] for _ in range(q.shape[0])]
+        for start, d2 in _blocked_scan(q, self._emb, x_sq, block):
+            qi, col = np.nonzero(d2 <= limit)
+            for i in np.unique(qi):
+                found[i].append(col[qi == i] + start)
+        out = []
+        for i in range(q.shape[0]):
+            rows = np.concatenate(found[i]) if found[i] else np.empty(0, dtype=np.int64)
+            out.append(self._finish(q[i], rows, excluded, None, radius=radius, thresholds=thresholds))
+        return out
+
+    def _probe(self, q: np.ndarray, nprobe: int, excluded: np.ndarray, k: Optional[int] = None,
+               radius: Optional[float] = None, thresholds: Optional[Mapping[str, float]] = None) -> List[SearchHit]:
+        if self.ivf is None:
+            raise ValueError("近似検索には train_ivf() で IVF を学習してください")
+        return self._finish(q, self.ivf.candidates(q, nprobe), excluded, k, radius=radius, thresholds=thresholds)
+
+    def _finish(self, q: np.ndarray, rows: np.ndarray, excluded: np.ndarray, k: Optional[int],
+                radius: Optional[float] = None, thresholds: Optional[Mapping[str, float]] = None) -> List[SearchHit]:
+        rows = np.setdiff1d(np.asarray(rows, dtype=np.int64), excluded)
+        if rows.size == 0:
+            return []
+        dist = _exact_distances(q, self._emb, rows)
+        order = np.argsort(dist, kind="stable")
+        if radius is not None:
+            order = order[dist[order] <= radius]
+        if k is not None:
+            order = order[:k]
+        return [self._hit(int(rows[j]), dist[j], thresholds) for j in order]
+
+    # --- 永続化 ---
+
+    def save(self, root: str):
+        self._consolidate()
+        os.makedirs(root, exist_ok=True)
+        arrays = {"embeddings": self._emb, "image_ids": self._image_ids, "faces": self._faces}
+        if self.ivf is not None:
+            arrays["ivf_centroids"] = self.ivf.centroids
+            arrays["ivf_assignments"] = self.ivf.assignments
+        for name, arr in arrays.items():
+            tmp = os.path.join(root, f".{name}.tmp.npy")
+            np.save(tmp, np.asarray(arr))
+            os.replace(tmp, os.path.join(root, f"{name}.npy"))
+        if self.ivf is None:
+            for name in ("ivf_centroids", "ivf_assignments"):
+                p = os.path.join(root, f"{name}.npy")
+                if os.path.exists(p):
+                    os.remove(p)
+        meta = {"version": INDEX_VERSION, "dim": self.dim, "paths": self.paths}
+        tmp = os.path.join(root, ".meta.json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(tmp, os.path.join(root, "meta.json"))
+
+    @classmethod
+    def load(cls, root: str, mmap: bool = True) -> "EmbeddingIndex":
+        with open(os.path.join(root, "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("version") != INDEX_VERSION:
+            raise ValueError(f"未対応のインデックス形式です: {meta.get('version')}")
+        index = cls(dim=meta["dim"])
+        index.paths = list(meta["paths"])
+        index._path_ids = {p: i for i, p in enumerate(index.paths)}
+        mode = "r" if mmap else None
+        index._emb = np.load(os.path.join(root, "embeddings.npy"), mmap_mode=mode)
+        index._image_ids = np.load(os.path.join(root, "image_ids.npy"))
+        index._faces = np.load(os.path.join(root, "faces.npy"))
+        ivf_c = os.path.join(root, "ivf_centroids.npy")
+        if os.path.exists(ivf_c):
+            index.ivf = IVF(np.load(ivf_c), np.load(os.path.join(root, "ivf_assignments.npy")))
+        return index
+
+    @classmethod
+    def open(cls, root: str) -> "EmbeddingIndex":
+        """存在すれば読み込み、無ければ空のインデックスを返す。"""
+        if os.path.exists(os.path.join(root, "meta.json")):
+            return cls.load(root)
+        return cls()
+
+
+def hits_to_dicts(results: Sequence[List[SearchHit]]) -> List[List[Dict]]:
+    return [[h.to_dict() for h in hits] for hits in results]
@@ -0,0 +1,356 @@
+"""バックグラウンドジョブ
+Web の1バッチ (アップロード1回分) を1ジョブとして、リクエストとは別スレッドで処理する。
+- ワーカープール (プロセス/スレッド) は全ジョブで共有
+- 受付待ちジョブ数に上限を設け、超えたら JobQueueFull
+- 画像はジョブ間でラウンドロビンに投入するので、同時に来たバッチが CPU を公平に分け合う
+- 各ジョブの結果は入力順に並べ直してから on_result に渡す
+- 進捗イベントは履歴として残し、購読者は途中から接続しても最初から受け取れる
+  (ブラウザを閉じても処理は続く)
+状態: queued -> running -> done / failed / cancelled
+"""
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+
+from .batch import analyze_one, default_workers, init_worker
+from .processor import AnalyzeOptions, ImageAnalysis
+from .stats import StageStats
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED_STATES = (DONE, FAILED, CANCELLED)
+
+# on_result(job, index, analysis, error) -> 進捗イベントの data
+ResultHandler = Callable[["Job", int, Optional[ImageAnalysis], Optional[str]], Dict[str, Any]]
+# on_finish(job) -> done イベントの data
+FinishHandler = Callable[["Job"], Dict[str, Any]]
+# on_close(job): 終了状態 (done/failed/cancelled) に関わらず最後に1回呼ばれる
+CloseHandler = Callable[["Job"], None]
+
+
+def _analyze_with_stats(path: str, options: Optional[AnalyzeOptions],
+                        data: Optional[bytes] = None) -> Tuple[Optional[ImageAnalysis], Optional[str], StageStats]:
+    """ワーカー側: 1枚を解析し、その段階別計測も返す。"""
+    stats = StageStats()
+    analysis, error = analyze_one(path, options, stats, data)
+    return analysis, error, stats
+
+
+class JobQueueFull(Exception):
+    """受付中のジョブが上限に達している。"""
+
+
+class Job:
+    def __init__(self, job_id: str, paths: List[str], on_result: ResultHandler,
+                 on_finish: Optional[FinishHandler] = None, on_close: Optional[CloseHandler] = None,
+                 options: Optional[AnalyzeOptions] = None, blobs: Optional[List[Optional[bytes]]] = None):
+        self.id = job_id
+        self.paths = paths
+        # blobs[i] があれば paths[i] は読まずにメモリから解析する (on_result の後に手放す)
+        self.blobs = blobs
+        self.options = options
+        self.on_result = on_result
+        self.on_finish = on_finish
+        self.on_close = on_close
+        self.state = QUEUED
+        self.error: Optional[str] = None
+        self.completed = 0
+        self.failed = 0
+        self.created = time.time()
+        self.finished_at: Optional[float] = None
+        self._next_submit = 0
+        self._next_emit = 0
+        self._inflight = 0
+        self._cancel = False
+        self._pending: Dict[int, Tuple[Optional[ImageAnalysis], Optional[str]]] = {}  # 並べ替え待ち
+        self._events: List[Tuple[str, Dict[str, Any]]] = []
+        self._cond = threading.Condition()
+
+    @property
+    def total(self) -> int:
+        return len(self.paths)
+
+    @property
+    def finished(self) -> bool:
+        return self.state in FINISHED_STATES
+
+    def publish(self, event: str, data: Dict[str, Any]):
+        with self._cond:
+            self._events.append((event, data))
+            self._cond.notify_all()
+
+    def events(self, timeout: Optional[float] = None) -> Iterator[Tuple[str, Optional[Dict[str, Any]]]]:
+        """これまでのイベントを再送したあと、ジョブ終了まで新しいイベントを返す。
+
+        timeout 秒イベントが無ければ ("ping", None) を返す (SSE の接続維持用)。
+        """
+        i = 0
+        while True:
+            with self._cond:
+                if i >= len(self._events) and not self.finished:
+                    self._cond.wait(timeout)
+                batch = self._events[i:]
+                finished = self.finished
+            i += len(batch)
+            yield from batch
+            if not batch:
+                if finished:
+                    return
+                yield "ping", None
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        with self._cond:
+            return self._cond.wait_for(lambda: self.finished, timeout)
+
+    def _set_state(self, state: str, error: Optional[str] = None):
+        with self._cond:
+            self.state = state
+            self.error = error
+            if state in FINISHED_STATES:
+                self.finished_at = time.time()
+            self._cond.notify_all()
+
+    def to_dict(self) -> Dict[str, Any]:
+        d: Dict[str, Any] = {"id": self.id, "state": self.state, "total": self.total,
+                             "completed": self.completed, "failed": self.failed}
+        if self.error:
+            d["error"] = self.error
+        return d
+
+
+def _make_executor(workers: int, mode: str) -> Executor:
+    if mode == "thread":
+        return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="twins-job")
+    ctx = multiprocessing.get_context("spawn")
+    return ProcessPoolExecutor(max_workers=workers, mp_context=ctx, initializer=init_worker)
+
+
+class JobManager:
+    """共有ワーカープールと、画像の投入/回収を行うディスパッチャスレッド。
+
+    on_result / on_finish はディスパッチャスレッドで呼ばれる (ジョブごとに逐次)。
+    """
+
+    def __init__(self, workers: Optional[int] = None, max_jobs: int = 16, mode: str = "process",
+                 max_inflight: Optional[int] = None, keep_finished: int = 64):
+        self.workers = workers or default_workers()
+        self.max_jobs = max_jobs
+        self.mode = mode
+        self.max_inflight = max_inflight or self.workers * 2
+        self.keep_finished = keep_finished
+        self._jobs: Dict[str, Job] = {}
+        self._active: List[Job] = []          # 投入順 (ラウンドロビンの対象)
+        self._rr = 0
+        self._inflight: Dict[Future, Tuple[Job, int]] = {}
+        self._lock = threading.Condition()
+        self._executor: Optional[Executor] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = False
+        # 全ジョブ通算の段階別計測と、結果ごとの画像数 (/metrics 用)
+        self.stats = StageStats()
+        self.images_ok = 0
+        self.images_failed = 0
+        self._stats_lock = threading.Lock()
+
+    def submit(self, job: Job) -> Job:
+        with self._lock:
+            if self._stopped:
+                raise RuntimeError("JobManager is shut down")
+            if job.id in self._jobs and not self._jobs[job.id].finished:
+                return self._jobs[job.id]
+            if len(self._active) >= self.max_jobs:
+                raise JobQueueFull(f"処理待ちのバッチが上限 ({self.max_jobs}) に達しています")
+            self._jobs[job.id] = job
+            self._active.append(job)
+            self._prune()
+            self._ensure_started()
+            self._lock.notify_all()
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def counts(self) -> Dict[str, int]:
+        """状態ごとのジョブ数 (保持しているもののみ)。"""
+        with self._lock:
+            counts = {state: 0 for state in (QUEUED, RUNNING) + FINISHED_STATES}
+            for job in self._jobs.values():
+                counts[job.state] += 1
+            return counts
+
+    @property
+    def inflight(self) -> int:
+        with self._lock:
+            return len(self._inflight)
+
+    def snapshot_stats(self) -> Tuple[StageStats, int, int]:
+        """(段階別計測のコピー, 成功枚数, 失敗枚数)"""
+        with self._stats_lock:
+            copy = StageStats()
+            copy.merge(self.stats)
+            return copy, self.images_ok, self.images_failed
+
+    def cancel(self, job_id: str) -> bool:
+        """未投入の画像を取りやめる。投入済みの分は結果を捨て、回収し終えたら cancelled にする。"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.finished or job._cancel:
+                return False
+            job._cancel = True
+            self._lock.notify_all()
+        return True
+
+    def shutdown(self, wait: bool = True):
+        with self._lock:
+            self._stopped = True
+            self._lock.notify_all()
+        if self._thread is not None and wait:
+            self._thread.join()
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=True)
+
+    def _ensure_started(self):
+        if self._thread is None:
+            self._executor = _make_executor(self.workers, self.mode)
+            self._thread = threading.Thread(target=self._run, name="twins-jobs", daemon=True)
+            self._thread.start()
+
+    def _prune(self):
+        finished = [j for j in self._jobs.values() if j.finished]
+        for j in finished[:max(0, len(finished) - self.keep_finished)]:
+            del self._jobs[j.id]
+
+    def _next_task(self) -> Optional[Tuple[Job, int]]:
+        """未投入の画像があるジョブを順番に巡り、1枚ずつ選ぶ。"""
+        n = len(self._active)
+        for k in range(n):
+            job = self._active[(self._rr + k) % n]
+            if not job._cancel and job._next_submit < job.total:
+                self._rr = (self._rr + k + 1) % n
+                i = job._next_submit
+                job._next_submit += 1
+                if job.state == QUEUED:
+                    job._set_state(RUNNING)
+                return job, i
+        return None
+
+    def _run(self):
+        assert self._executor is not None
+        while True:
+            with self._lock:
+                while not self._stopped and len(self._inflight) < self.max_inflight:
+                    task = self._next_task()
+                    if task is None:
+                        break
+                    job, i = task
+                    blob = job.blobs[i] if job.blobs is not None else None
+                    fut = self._executor.submit(_analyze_with_stats, job.paths[i], job.options, blob)
+                    self._inflight[fut] = (job, i)
+                    job._inflight += 1
+                # 画像0枚のジョブと、回収待ちの無くなった取り消しジョブは投入なしで片付ける
+                idle = [j for j in self._active if j._inflight == 0 and (j.total == 0 or j._cancel)]
+                if not self._inflight and not idle:
+                    if self._stopped:
+                        return
+                    self._lock.wait(0.5)
+                    continue
+                futures = list(self._inflight)
+            for job in idle:
+                if job._cancel:
+                    self._close(job, CANCELLED)
+                else:
+                    self._finish(job)
+            if not futures:
+                continue
+            done, _ = wait(futures, timeout=0.5, return_when=FIRST_COMPLETED)
+            for fut in done:
+                with self._lock:
+                    job, i = self._inflight.pop(fut)
+                    job._inflight -= 1
+                try:
+                    analysis, error, stats = fut.result()
+                except Exception as e:  # プロセス異常終了など
+                    analysis, error, stats = None, str(e) or type(e).__name__, None
+                with self._stats_lock:
+                    if stats is not None:
+                        self.stats.merge(stats)
+                    if error is None:
+                        self.images_ok += 1
+                    else:
+                        self.images_failed += 1
+                result = (analysis, error)
+                if job._cancel:
+                    continue
+                job._pending[i] = result
+                self._drain(job)
+
+    def _drain(self, job: Job):
+        """入力順に揃った結果を on_result に渡し、全件そろえば完了処理。"""
+        while job._next_emit in job._pending:
+            i = job._next_emit
+            analysis, error = job._pending.pop(i)
+            job._next_emit += 1
+            if error is not None:
+                job.failed += 1
+            try:
+                payload = job.on_result(job, i, analysis, error)
+            except Exception as e:
+                job.failed += error is None
+                payload = {"index": i + 1, "total": job.total, "error": str(e)}
+            if job.blobs is not None:
+                job.blobs[i] = None
+            job.completed += 1
+            job.publish("progress", payload)
+        if job._next_emit >= job.total:
+            self._finish(job)
+
+    def _finish(self, job: Job):
+        try:
+            data = job.on_finish(job) if job.on_finish is not None else {}
+        except Exception as e:
+            traceback.print_exc()
+            job.publish("failed", {"error": str(e)})
+            self._close(job, FAILED, str(e))
+            return
+        job.publish("done", data)
+        self._close(job, DONE)
+
+    def _close(self, job: Job, state: str, error: Optional[str] = None):
+        with self._lock:
+            if job in self._active:
+                self._active.remove(job)
+        if job.on_close is not None:
+            try:
+                job.on_close(job)
+            except Exception:
+                traceback.print_exc()
+        job._set_state(state, error)
+
+
+_manager: Optional[JobManager] = None
+_manager_lock = threading.Lock()
+
+
+def get_manager() -> JobManager:
+    """プロセス内で共有する JobManager (初回呼び出し時に作成)。
+
+    TWINS_JOB_MODE=thread でスレッドプール、TWINS_MAX_JOBS で受付上限を変えられる。
+    """
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            mode = os.environ.get("TWINS_JOB_MODE", "process")
+            try:
+                max_jobs = max(1, int(os.environ.get("TWINS_MAX_JOBS", "16")))
+            except ValueError:
+                max_jobs = 16
+            _manager = JobManager(max_jobs=max_jobs, mode=mode)
+        return _manager
@@ -0,0 +1,143 @@
+"""再開可能なフォルダ処理のためのジャーナル
+完了した画像の結果を JSON Lines で追記し、再実行時はサイズと mtime が変わって
+いない画像を解析せずに済ませる。1行の形式:
+    {"path": 絶対パス, "size": バイト数, "mtime_ns": 更新時刻, "result": to_dict() または {"path", "error"}}
+失敗した画像は記録するが完了扱いにしない (再実行時に再試行する)。
+"""
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, Iterator, Optional, TextIO
+import json
+import os
+import tempfile
+import time
+
+
+@dataclass
+class JournalEntry:
+    size: int
+    mtime_ns: int
+    offset: int            # ジャーナル内の行の開始位置
+    ok: bool
+    label: Optional[str]
+    distance: Optional[float]
+
+
+class Journal:
+    """完了済み画像の索引 (パス -> 行位置) だけをメモリに持ち、結果本体はファイルから読む。"""
+
+    def __init__(self, path: str, fsync_interval: float = 2.0):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.entries: Dict[str, JournalEntry] = {}
+        self._load()
+        self._f = open(path, "ab")
+        self._last_sync = time.monotonic()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        good_end = 0
+        with open(self.path, "rb") as f:
+            offset = 0
+            for raw in f:
+                if not raw.endswith(b"\n"):
+                    break  # 書き込み途中で落ちた最終行
+                try:
+                    rec = json.loads(raw)
+                except ValueError:
+                    break
+                result = rec.get("result", {})
+                cls = result.get("classification") or {}
+                self.entries[rec["path"]] = JournalEntry(
+                    size=rec["size"], mtime_ns=rec["mtime_ns"], offset=offset,
+                    ok="error" not in result, label=cls.get("label"), distance=cls.get("distance"),
+                )
+                offset += len(raw)
+                good_end = offset
+        if good_end < os.path.getsize(self.path):
+            os.truncate(self.path, good_end)
+
+    def is_done(self, path: str) -> bool:
+        """成功済みで、かつサイズ/mtime が記録時から変わっていなければ True。"""
+        e = self.entries.get(os.path.abspath(path))
+        if e is None or not e.ok:
+            return False
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        return st.st_size == e.size and st.st_mtime_ns == e.mtime_ns
+
+    def record(self, path: str, result: Dict[str, Any]):
+        apath = os.path.abspath(path)
+        try:
+            st = os.stat(path)
+            size, mtime_ns = st.st_size, st.st_mtime_ns
+        except OSError:
+            size, mtime_ns = -1, -1
+        line = (json.dumps({"path": apath, "size": size, "mtime_ns": mtime_ns, "result": result}, ensure_ascii=False) + "\n").encode("utf-8")
+        offset = self._f.tell()
+        self._f.write(line)
+        self._f.flush()
+        cls = result.get("classification") or {}
+        self.entries[apath] = JournalEntry(size=size, mtime_ns=mtime_ns, offset=offset, ok="error" not in result,
+                                           label=cls.get("label"), distance=cls.get("distance"))
+        now = time.monotonic()
+        if now - self._last_sync >= self.fsync_interval:
+            os.fsync(self._f.fileno())
+            self._last_sync = now
+
+    def result(self, path: str) -> Optional[Dict[str, Any]]:
+        """記録済みの結果を読み出す (無ければ None)。"""
+        e = self.entries.get(os.path.abspath(path))
+        if e is None:
+            return None
+        self._f.flush()
+        with open(self.path, "rb") as f:
+            f.seek(e.offset)
+            return json.loads(f.readline())["result"]
+
+    def results(self, paths: Iterable[str]) -> Iterator[Dict[str, Any]]:
+        """paths の順に結果を返す。1つのファイルハンドルでシークしながら読む。"""
+        self._f.flush()
+        with open(self.path, "rb") as f:
+            for p in paths:
+                e = self.entries.get(os.path.abspath(p))
+                if e is None:
+                    continue
+                f.seek(e.offset)
+                yield json.loads(f.readline())["result"]
+
+    def close(self):
+        if self._f.closed:
+            return
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._f.close()
+
+    def __enter__(self) -> "Journal":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def atomic_write(path: str, write_fn):
+    """同じディレクトリの一時ファイルに書き、fsync 後に os.replace で置き換える。"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(prefix=".twins_", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            write_fn(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def write_jsonl(records: Iterable[Dict[str, Any]], f: TextIO):
+    for r in records:
+        f.write(json.dumps(r, ensure_ascii=False) + "\n")
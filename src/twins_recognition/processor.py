@@ -1,11 +1,64 @@
 """画像->分類結果 パイプライン"""
-from dataclasses import dataclass, asdict
-from typing import List, Tuple, Dict, Any
+from dataclasses import dataclass, asdict, field
+from typing import List, Tuple, Dict, Any, Mapping, Optional, Sequence
 import os
 
-from .detector import load_image, detect_faces, FaceLocation
-from .embedding import face_embeddings
+import numpy as np
+
+from .detector import (load_image, load_image_bytes, detect_faces_in_image, detect_faces_batch, needs_tiles,
+                       DEFAULT_TILE_OVERLAP, FaceLocation)
+from .embedding import face_chips, encode_chips, empty_embeddings
 from .classifier import classify_embeddings, TwinClassificationResult
+from .cache import EmbeddingCache, get_cache, sha256_bytes, DEFAULT_MAX_BYTES
+from .dedup import DEFAULT_MAX_DISTANCE, Duplicate, DuplicateIndex, dhash, get_index
+from .profiling import profile_call, should_profile
+from .stats import StageStats
+
+
+@dataclass(frozen=True)
+class AnalyzeOptions:
+    """解析設定。ワーカープロセスへそのまま渡せるよう picklable に保つ。"""
+    model: str = "hog"
+    upsample: int = 1
+    max_side: Optional[int] = None       # 検出時に長辺をこの画素数まで縮小 (None で原寸)
+    cache_dir: Optional[str] = None      # None ならキャッシュ無効
+    cache_max_bytes: int = DEFAULT_MAX_BYTES
+    batch_size: int = 32                 # エンコーダ (cnn は検出も) へ一度に渡す枚数
+    batch_memory_mb: int = 256           # analyze_images がデコード済み画像を保持する上限
+    profile_every: int = 0               # 約 1/N の画像を cProfile/tracemalloc 付きで解析 (0 で無効)
+    profile_dir: Optional[str] = None    # プロファイルの出力先
+    dedup: bool = False                  # 解析済みの重複・ほぼ重複画像の結果を流用する (dedup モジュール参照)
+    dedup_distance: int = DEFAULT_MAX_DISTANCE   # ほぼ重複とみなす dHash のハミング距離 (0 で再エンコードのみ)
+    metric: str = "euclidean"            # 分類に使う距離 (euclidean / cosine)
+    tile_size: Optional[int] = None      # 長辺がこれを超える画像はタイル分割して検出し、顔の周りだけで切り出す
+    tile_overlap: int = DEFAULT_TILE_OVERLAP   # タイルの重なり (検出する画像上の画素。最大の顔より大きく)
+    # 分類閾値 (ラベル -> 距離。metric の閾値)。None なら既定値。設定ファイルは呼び出し側
+    # (cli.analysis_options など) が classifier.runtime_thresholds で読んで渡す
+    thresholds: Optional[Mapping[str, float]] = field(default=None, hash=False)
+
+    def cache(self) -> Optional[EmbeddingCache]:
+        if not self.cache_dir:
+            return None
+        return get_cache(self.cache_dir, self.cache_max_bytes)
+
+    def dedup_index(self) -> Optional[DuplicateIndex]:
+        if not self.dedup:
+            return None
+        return get_index((self.model, self.upsample, self.max_side, self.tile_size, self.tile_overlap), self.dedup_distance)
+
+    def cache_key(self, digest: str) -> str:
+        return EmbeddingCache.make_key(digest, self.model, self.upsample, self.max_side, self.tile_size, self.tile_overlap)
+
+    def detect(self, img) -> List[FaceLocation]:
+        return detect_faces_in_image(img, model=self.model, upsample=self.upsample, max_side=self.max_side,
+                                     tile=self.tile_size, tile_overlap=self.tile_overlap)
+
+    def classify(self, embeddings) -> TwinClassificationResult:
+        return classify_embeddings(embeddings, self.metric, self.thresholds)
+
+    def crop_faces(self, img) -> bool:
+        """顔チップを顔の周りの切り出しだけから作るか (タイル分割する大きな画像)。"""
+        return needs_tiles(img.shape, self.tile_size)
 
 
 @dataclass
@@ -14,22 +67,295 @@ class ImageAnalysis:
     faces: List[FaceLocation]
     embeddings_count: int
     classification: TwinClassificationResult
+    # (n, 128) float32。検索インデックス等で使う。JSON 出力には含めない
+    embeddings: Optional[np.ndarray] = field(default=None, repr=False, compare=False)
+    # 重複画像として結果を流用した場合の {"of": 流用元パス, "exact": bool, "distance": int}
+    duplicate: Optional[Dict[str, Any]] = None
 
     def to_dict(self) -> Dict[str, Any]:
-        d = asdict(self)
-        # face tuple をリストに
-        d["faces"] = [list(f) for f in self.faces]
+        d = {
+            "path": self.path,
+            # face tuple をリストに
+            "faces": [list(f) for f in self.faces],
+            "embeddings_count": self.embeddings_count,
+            "classification": asdict(self.classification),
+        }
+        if self.duplicate is not None:
+            d["duplicate"] = self.duplicate
         return d
 
 
-def analyze_image(path: str) -> ImageAnalysis:
-    img = load_image(path)
-    faces = detect_faces(path)
-    embeddings = face_embeddings(img, faces) if len(faces) > 0 else []
-    classification = classify_embeddings(embeddings)
+def _build_analysis(path: str, faces: List[FaceLocation], embeddings: np.ndarray,
+                    options: Optional[AnalyzeOptions] = None) -> ImageAnalysis:
     return ImageAnalysis(
         path=os.path.abspath(path),
         faces=faces,
         embeddings_count=len(embeddings),
-        classification=classification,
+        classification=(options or AnalyzeOptions()).classify(embeddings),
+        embeddings=embeddings,
     )
+
+
+def _detect_and_embed(img, options: AnalyzeOptions, stats: Optional[StageStats] = None) -> Tuple[List[FaceLocation], np.ndarray]:
+    stats = stats if stats is not None else StageStats()
+    with stats.stage("detect"):
+        faces = options.detect(img)
+    if len(faces) == 0:
+        return faces, empty_embeddings()
+    # 埋め込みは縮小前の原寸画素から求める (顔位置は原寸座標に戻してある)
+    with stats.stage("align"):
+        chips = face_chips(img, faces, crop=options.crop_faces(img))
+    with stats.stage("encode"):
+        embeddings = encode_chips(chips, batch_size=options.batch_size)
+    stats.faces += len(chips)
+    return faces, embeddings
+
+
+def _classify(path: str, faces: List[FaceLocation], embeddings: np.ndarray, stats: StageStats,
+              options: AnalyzeOptions) -> ImageAnalysis:
+    with stats.stage("classify"):
+        return _build_analysis(path, faces, embeddings, options)
+
+
+def analyze_pixels(img, path: str, options: Optional[AnalyzeOptions] = None,
+                   stats: Optional[StageStats] = None) -> ImageAnalysis:
+    """デコード済み画像配列を検出・埋め込み両方に共有して解析する。"""
+    stats = stats if stats is not None else StageStats()
+    options = options or AnalyzeOptions()
+    faces, embeddings = _detect_and_embed(img, options, stats)
+    return _classify(path, faces, embeddings, stats, options)
+
+
+def analyze_image(path: str, options: Optional[AnalyzeOptions] = None,
+                  stats: Optional[StageStats] = None) -> ImageAnalysis:
+    """1枚の画像を解析する。stats を渡すと段階ごとの時間を記録する。"""
+    options = options or AnalyzeOptions()
+    stats = stats if stats is not None else StageStats()
+    cache = options.cache()
+    if cache is None:
+        # デコードは1回のみ。同じ画素バッファを検出と埋め込みに渡す
+        with stats.stage("decode"):
+            img = load_image(path)
+        return analyze_pixels(img, path, options, stats)
+
+    with stats.stage("decode"):
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"画像が存在しません: {path}")
+        digest, data = cache.digest_file(path)
+        key = options.cache_key(digest)
+        hit = cache.get(key)
+        if hit is None:
+            # ハッシュ計算で読んだバイト列をそのままデコードに使う
+            img = load_image_bytes(data, path) if data is not None else load_image(path)
+    if hit is not None:
+        # 検出/エンコード済み: 分類 (距離計算と閾値判定) のみ
+        stats.cache_hits += 1
+        faces, embeddings = hit
+        return _classify(path, faces, embeddings, stats, options)
+    faces, embeddings = _detect_and_embed(img, options, stats)
+    cache.put(key, faces, embeddings)
+    return _classify(path, faces, embeddings, stats, options)
+
+
+def _cache_put(cache: EmbeddingCache, key: str, faces: List[FaceLocation], embeddings: np.ndarray):
+    """キャッシュへの保存に失敗しても (ディスク満杯/ロック等) 解析結果はそのまま返す。"""
+    try:
+        cache.put(key, faces, embeddings)
+    except Exception:
+        pass
+
+
+def _from_duplicate(path: str, dup: Duplicate, stats: StageStats, options: AnalyzeOptions) -> ImageAnalysis:
+    """流用元の顔位置・埋め込みから結果を作る (分類だけ行う)。"""
+    stats.duplicates += 1
+    stats.duplicate_faces += len(dup.faces)
+    a = _build_analysis(path, dup.faces, dup.embeddings, options)
+    a.duplicate = dup.to_dict()
+    return a
+
+
+def _read_bytes(path: str) -> bytes:
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"画像が存在しません: {path}")
+    with open(path, "rb") as f:
+        return f.read()
+
+
+# (解析結果, エラーメッセージ) のどちらか一方が入る
+ImageResult = Tuple[Optional[ImageAnalysis], Optional[str]]
+
+
+def _error_message(e: Exception) -> str:
+    return str(e) or type(e).__name__
+
+
+def analyze_images(paths: Sequence[str], options: Optional[AnalyzeOptions] = None,
+                   stats: Optional[StageStats] = None,
+                   blobs: Optional[Sequence[Optional[bytes]]] = None) -> List[ImageResult]:
+    """複数画像を段階ごとにまとめて解析する (analyze_image と同じ結果)。
+
+    デコード -> 検出 -> 顔チップ切り出し -> エンコード -> 分類 の順に、
+    デコード済み画素が batch_memory_mb に達するまでの画像を1グループとして処理する。
+    エンコードはグループ内の全顔チップを batch_size 枚ずつまとめて行う。
+    options.profile_every / profile_dir を指定すると、抽出された画像だけは1枚ずつ
+    プロファイル付きで解析する (profiling モジュール参照)。
+    blobs[i] にエンコード済み画像 (JPEG/PNG 等) のバイト列を渡すと、paths[i] のファイルは
+    読まずにメモリから直接デコードする (キャッシュキーはバイト列のハッシュ)。
+    options.dedup を指定すると、解析済みの画像と重複・ほぼ重複する画像は検出・エンコードを
+    省き、その結果を流用する (ImageAnalysis.duplicate に流用元を記録)。
+    失敗は画像単位で (None, メッセージ) として返し、例外は送出しない。
+    """
+    options = options or AnalyzeOptions()
+    stats = stats if stats is not None else StageStats()
+    cache = options.cache()
+    index = options.dedup_index()
+    results: List[ImageResult] = [(None, None)] * len(paths)
+    limit = max(1, options.batch_memory_mb) * 1024 * 1024
+    group: List[Tuple[int, np.ndarray, Optional[str]]] = []   # (入力位置, 画素, キャッシュキー)
+    group_bytes = 0
+    # グループ内で結果待ちの画像の (内容ハッシュ, dHash, 幅, 高さ)。解析後に重複索引へ登録する
+    waiting: Dict[int, Tuple[Optional[str], Optional[int], int, int]] = {}
+
+    def flush_group():
+        nonlocal group_bytes
+        _analyze_group(paths, group, options, cache, stats, results)
+        group_bytes = 0
+        if index is not None:
+            for j, (digest, ph, w, h) in waiting.items():
+                a = results[j][0]
+                if a is not None:
+                    index.add(a.path, digest, ph, w, h, a.faces, a.embeddings)
+            waiting.clear()
+
+    def waiting_match(digest: Optional[str], ph: Optional[int], w: int, h: int) -> bool:
+        # 同じグループにまだ結果の無い重複元があるか (あれば先にグループを解析して流用する)
+        for d, p, ww, hh in waiting.values():
+            if digest is not None and d == digest:
+                return True
+            if ph is not None and p is not None and index.matches(ph, w, h, (p, ww, hh)):  # type: ignore[union-attr]
+                return True
+        return False
+
+    for i, path in enumerate(paths):
+        blob = blobs[i] if blobs is not None else None
+        if blob is None and options.profile_dir and should_profile(path, options.profile_every):
+            # 抽出した画像はまとめず1枚で解析し、その間だけプロファイルを取る
+            try:
+                results[i] = (profile_call(path, options.profile_dir, lambda: analyze_image(path, options, stats)), None)
+            except Exception as e:
+                results[i] = (None, _error_message(e))
+            continue
+        try:
+            with stats.stage("decode"):
+                key = None
+                digest: Optional[str] = None
+                data = blob
+                if blob is not None:
+                    if cache is not None or index is not None:
+                        digest = sha256_bytes(blob)
+                elif cache is not None:
+                    if not os.path.exists(path):
+                        raise FileNotFoundError(f"画像が存在しません: {path}")
+                    digest, data = cache.digest_file(path)
+                elif index is not None:
+                    data = _read_bytes(path)
+                    digest = sha256_bytes(data)
+                if cache is not None:
+                    key = options.cache_key(digest)  # type: ignore[arg-type]
+                    hit = cache.get(key)
+                    if hit is not None:
+                        stats.cache_hits += 1
+                        results[i] = (_build_analysis(path, hit[0], hit[1], options), None)
+                        continue
+                # 同じバイト列の画像が解析済みならデコードも省く
+                dup = index.exact(digest) if index is not None else None
+                if dup is None:
+                    img = load_image_bytes(data, path) if data is not None else load_image(path)
+                    ph: Optional[int] = None
+                    h, w = img.shape[:2]
+                    if index is not None:
+                        ph, usable = dhash(img)
+                        ph = ph if usable else None
+                        dup = index.near(ph, w, h) if ph is not None else None
+            if dup is None and index is not None and waiting_match(digest, ph, w, h):
+                flush_group()
+                dup = index.exact(digest) or (index.near(ph, w, h) if ph is not None else None)
+        except Exception as e:
+            results[i] = (None, _error_message(e))
+            continue
+        if dup is not None:
+            results[i] = (_from_duplicate(path, dup, stats, options), None)
+            if cache is not None and key is not None:
+                _cache_put(cache, key, dup.faces, dup.embeddings)
+            continue
+        group.append((i, img, key))
+        group_bytes += img.nbytes
+        if index is not None:
+            waiting[i] = (digest, ph, w, h)
+        if group_bytes >= limit:
+            flush_group()
+    if group:
+        flush_group()
+    return results
+
+
+def _analyze_group(paths: Sequence[str], group: List[Tuple[int, np.ndarray, Optional[str]]],
+                   options: AnalyzeOptions, cache: Optional[EmbeddingCache],
+                   stats: StageStats, results: List[ImageResult]):
+    n = len(group)
+    with stats.stage("detect", n):
+        try:
+            all_faces = detect_faces_batch([img for _, img, _ in group], model=options.model,
+                                           upsample=options.upsample, max_side=options.max_side,
+                                           batch_size=options.batch_size, tile=options.tile_size,
+                                           tile_overlap=options.tile_overlap)
+        except Exception:
+            # 一括検出に失敗したら1枚ずつやり直して失敗画像を特定する
+            all_faces = []
+            for i, img, _ in group:
+                try:
+                    all_faces.append(options.detect(img))
+                except Exception as e:
+                    results[i] = (None, _error_message(e))
+                    all_faces.append(None)
+
+    # 顔チップだけを残し、元画像はここで手放す
+    chips: List[np.ndarray] = []
+    spans: List[Tuple[int, List[FaceLocation], int, int]] = []   # (入力位置, 顔位置, チップ開始, 終了)
+    keys: Dict[int, Optional[str]] = {}
+    with stats.stage("align", n):
+        for (i, img, key), faces in zip(group, all_faces):
+            if faces is None:
+                continue
+            try:
+                c = face_chips(img, faces, crop=options.crop_faces(img))
+            except Exception as e:
+                results[i] = (None, _error_message(e))
+                continue
+            spans.append((i, faces, len(chips), len(chips) + len(c)))
+            keys[i] = key
+            chips.extend(c)
+    group.clear()
+
+    with stats.stage("encode", len(spans)):
+        try:
+            embeddings: Optional[np.ndarray] = encode_chips(chips, batch_size=options.batch_size)
+        except Exception:
+            embeddings = None
+    stats.faces += len(chips)
+
+    with stats.stage("classify", len(spans)):
+        for i, faces, start, stop in spans:
+            if embeddings is not None:
+                emb = embeddings[start:stop].copy() if stop > start else empty_embeddings()
+            else:
+                # 一括エンコードに失敗したら画像ごとにやり直す
+                try:
+                    emb = encode_chips(chips[start:stop], batch_size=options.batch_size)
+                except Exception as e:
+                    results[i] = (None, _error_message(e))
+                    continue
+            key = keys[i]
+            if cache is not None and key is not None:
+                _cache_put(cache, key, faces, emb)
+            results[i] = (_build_analysis(paths[i], faces, emb, options), None)
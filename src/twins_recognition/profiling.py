@@ -0,0 +1,57 @@
+"""抽出した一部画像の詳細プロファイル
+--profile-every N を指定すると、パスのハッシュで決まる約 1/N の画像だけを
+cProfile と tracemalloc の下で解析し、画像ごとに次のファイルを書き出す。
+    <名前>-<ハッシュ>.prof      cProfile の統計 (python -m pstats / snakeviz で閲覧)
+    <名前>-<ハッシュ>.mem.txt   tracemalloc のピークと確保量の多い行 (上位 20)
+抽出はパスだけで決まるので、ワーカー数やチャンク分けが変わっても同じ画像が選ばれる。
+"""
+from typing import Callable, TypeVar
+import cProfile
+import hashlib
+import os
+import tracemalloc
+
+T = TypeVar("T")
+
+TOP_ALLOCATIONS = 20
+
+
+def _path_hash(path: str) -> int:
+    digest = hashlib.blake2b(os.path.abspath(path).encode("utf-8", "surrogateescape"), digest_size=4).digest()
+    return int.from_bytes(digest, "big")
+
+
+def should_profile(path: str, every: int) -> bool:
+    return every > 0 and _path_hash(path) % every == 0
+
+
+def profile_call(path: str, out_dir: str, fn: Callable[[], T]) -> T:
+    """fn() を cProfile + tracemalloc 付きで実行し、path 用のレポートを out_dir へ書く。"""
+    os.makedirs(out_dir, exist_ok=True)
+    stem = os.path.join(out_dir, f"{os.path.basename(path)}-{_path_hash(path):08x}")
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    prof = cProfile.Profile()
+    try:
+        prof.enable()
+        try:
+            return fn()
+        finally:
+            prof.disable()
+            prof.dump_stats(stem + ".prof")
+            _, peak = tracemalloc.get_traced_memory()
+            # プロファイラ自身の確保は除く
+            snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, cProfile.__file__),
+                tracemalloc.Filter(False, tracemalloc.__file__),
+            ])
+            with open(stem + ".mem.txt", "w", encoding="utf-8") as f:
+                f.write(f"path: {os.path.abspath(path)}\n")
+                f.write(f"peak_bytes: {peak}\n")
+                for stat in snapshot.statistics("lineno")[:TOP_ALLOCATIONS]:
+                    f.write(f"{stat}\n")
+    finally:
+        if started:
+            tracemalloc.stop()
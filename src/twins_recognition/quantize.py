@@ -0,0 +1,151 @@
+"""埋め込みの省メモリ表現
+128 次元埋め込みを L2 正規化した方向ベクトル (float16 / int8) と、顔ごとの係数 1つ (float32) で表す。
+
+    float32   512 バイト/顔 (そのまま)
+    float16   256 バイト/顔 (そのまま半精度)
+    float16n  260 バイト/顔 (単位ベクトルの float16 + ノルム)
+    int8n     132 バイト/顔 (単位ベクトルを最大成分で 127 に揃えた int8 + 係数)
+
+復元は codes * scale (scale は float16n ならノルム、int8n ならノルム x 最大成分 / 127)。
+ノルムを残すのでユークリッド距離 (THRESHOLDS) もそのまま使え、コサイン距離は codes だけで求まる。
+accuracy_report で float64 のユークリッド距離に対する距離誤差とラベル一致率を測れる。
+"""
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence
+import math
+
+import numpy as np
+
+KINDS = ("float32", "float16", "float16n", "int8n")
+NORMALIZED_KINDS = ("float16n", "int8n")
+_CODE_DTYPES = {"float32": np.float32, "float16": np.float16, "float16n": np.float16, "int8n": np.int8}
+REPORT_PAIRS = 2_000_000   # accuracy_report で比べるペア数の上限 (超えたら無作為抽出)
+NEAR_MARGIN = 0.1          # similar 閾値 + これ以下のペアを「境界付近」として別に集計する
+
+
+def code_dtype(kind: str) -> np.dtype:
+    if kind not in _CODE_DTYPES:
+        raise ValueError(f"埋め込みの表現は {', '.join(KINDS)} のいずれか: {kind}")
+    return np.dtype(_CODE_DTYPES[kind])
+
+
+@dataclass
+class EncodedEmbeddings:
+    """省メモリ表現の埋め込み。scales は正規化した表現のみ (顔ごとの係数)。"""
+    kind: str
+    codes: np.ndarray
+    scales: Optional[np.ndarray] = None
+
+    def __len__(self) -> int:
+        return self.codes.shape[0]
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + (0 if self.scales is None else self.scales.nbytes)
+
+    def decode(self) -> np.ndarray:
+        """(n, dim) float32 に戻す。"""
+        x = np.asarray(self.codes, dtype=np.float32)
+        if self.scales is not None:
+            x = x * np.asarray(self.scales, dtype=np.float32)[:, None]
+        return x
+
+    def unit(self) -> np.ndarray:
+        """L2 正規化した (n, dim) float32 (コサイン距離用。ノルムは使わない)。"""
+        x = np.asarray(self.codes, dtype=np.float32)
+        norms = np.sqrt(np.einsum("ij,ij->i", x, x))
+        return x / np.where(norms > 0, norms, 1.0)[:, None]
+
+
+def bytes_per_face(kind: str, dim: int = 128) -> int:
+    return dim * code_dtype(kind).itemsize + (4 if kind in NORMALIZED_KINDS else 0)
+
+
+def encode(embeddings: np.ndarray, kind: str) -> EncodedEmbeddings:
+    """(n, dim) の埋め込みを kind の表現にする。NaN を含む行 (埋め込み無し) は scale が NaN。"""
+    dtype = code_dtype(kind)
+    x = np.asarray(embeddings, dtype=np.float32)
+    x = x.reshape(-1, x.shape[-1]) if x.size else x.reshape(0, x.shape[-1] if x.ndim == 2 else 128)
+    if kind not in NORMALIZED_KINDS:
+        return EncodedEmbeddings(kind, x.astype(dtype))
+    bad = ~np.isfinite(x).all(axis=1)
+    x = np.where(bad[:, None], 0.0, x)
+    norms = np.sqrt(np.einsum("ij,ij->i", x, x))
+    u = x / np.where(norms > 0, norms, 1.0)[:, None]
+    if kind == "float16n":
+        codes, scales = u.astype(np.float16), norms
+    else:
+        peak = np.abs(u).max(axis=1) if u.size else np.empty(0, dtype=np.float32)
+        step = np.where(peak > 0, peak / 127.0, 1.0)
+        codes = np.clip(np.rint(u / step[:, None]), -127, 127).astype(np.int8)
+        scales = norms * step
+    scales = np.where(bad, np.nan, scales).astype(np.float32)
+    return EncodedEmbeddings(kind, codes, scales)
+
+
+def _reference_pairs(n: int, max_pairs: int, seed: int):
+    """比べるペア (i < j)。全ペアが max_pairs 以下なら全部、超えたら無作為抽出。"""
+    total = n * (n - 1) // 2
+    if total <= max_pairs:
+        return np.triu_indices(n, k=1)
+    rng = np.random.default_rng(seed)
+    i = rng.integers(0, n, max_pairs)
+    j = rng.integers(0, n - 1, max_pairs)
+    j = np.where(j >= i, j + 1, j)
+    return np.minimum(i, j), np.maximum(i, j)
+
+
+def _pair_distances(x: np.ndarray, i: np.ndarray, j: np.ndarray, metric: str, chunk: int = 262144) -> np.ndarray:
+    out = np.empty(i.size, dtype=np.float64)
+    for s in range(0, i.size, chunk):
+        a, b = x[i[s:s + chunk]], x[j[s:s + chunk]]
+        if metric == "cosine":
+            out[s:s + chunk] = 1.0 - np.einsum("ij,ij->i", a, b)
+        else:
+            diff = a - b
+            out[s:s + chunk] = np.sqrt(np.einsum("ij,ij->i", diff, diff))
+    return out
+
+
+def accuracy_report(embeddings: np.ndarray, kinds: Sequence[str] = KINDS,
+                    metrics: Sequence[str] = ("euclidean", "cosine"),
+                    max_pairs: int = REPORT_PAIRS, seed: int = 0) -> List[Dict[str, object]]:
+    """表現 x 距離の組ごとに、float64 のユークリッド距離との差を測る。
+
+    基準ラベルは float64 ユークリッド距離と THRESHOLDS、比べるラベルはその表現・距離と
+    対応する閾値 (コサインなら COSINE_THRESHOLDS) で決める。distance_error は同じ距離の
+    float64 計算との差。near_* は基準距離が similar 閾値 + NEAR_MARGIN 以下のペアだけの一致率。
+    """
+    from .classifier import labels_for_distances, thresholds_for
+
+    x = np.asarray(embeddings, dtype=np.float64)
+    x = x[np.isfinite(x).all(axis=1)]
+    i, j = _reference_pairs(x.shape[0], max_pairs, seed)
+    ref = _pair_distances(x, i, j, "euclidean")
+    ref_labels = labels_for_distances(ref, "euclidean")
+    near = ref <= thresholds_for("euclidean")["similar"] + NEAR_MARGIN
+    norms = np.sqrt(np.einsum("ij,ij->i", x, x))
+    x_unit = x / np.where(norms > 0, norms, 1.0)[:, None]
+    exact = {"euclidean": ref, "cosine": _pair_distances(x_unit, i, j, "cosine")}
+    rows = []
+    for kind in kinds:
+        enc = encode(x, kind)
+        for metric in metrics:
+            y = enc.unit() if metric == "cosine" else enc.decode()
+            d = _pair_distances(y.astype(np.float64), i, j, metric)
+            labels = labels_for_distances(d, metric)
+            err = np.abs(d - exact[metric])
+            same = labels == ref_labels
+            rows.append({
+                "kind": kind,
+                "metric": metric,
+                "bytes_per_face": bytes_per_face(kind, x.shape[1]),
+                "faces_per_gb": int(2 ** 30 // bytes_per_face(kind, x.shape[1])),
+                "pairs": int(i.size),
+                "label_agreement": float(same.mean()) if i.size else math.nan,
+                "near_pairs": int(near.sum()),
+                "near_agreement": float(same[near].mean()) if near.any() else math.nan,
+                "max_distance_error": float(err.max()) if i.size else math.nan,
+                "mean_distance_error": float(err.mean()) if i.size else math.nan,
+            })
+    return rows
@@ -0,0 +1,191 @@
+"""画像ファイル探索
+os.scandir による再帰走査で画像パスを逐次返す。
+- 既知の拡張子はファイルを開かずに採用
+- 拡張子で判定できないファイルは先頭数十バイトのマジックナンバーで判定
+  (NFS など遅いファイルシステム向けにスレッドで並列に読む)
+- 走査結果をマニフェストに保存し、mtime が変わっていないディレクトリは一覧を再利用
+- background() で別スレッド走査にし、走査中から解析側へパスを流せる
+順序はディレクトリごとの名前順 (os.walk のトップダウン順と同じ深さ優先)。
+"""
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+import json
+import os
+import queue
+import threading
+
+# Pillow標準対応 + よく使われる形式を追加 (HEIC/AVIF は別途プラグインが必要なので除外)
+SUPPORTED_EXT = {
+    ".jpg", ".jpeg", ".png", ".bmp", ".webp", ".tif", ".tiff", ".gif",
+    ".jp2", ".ppm", ".pnm", ".pbm", ".pgm"
+}
+
+MANIFEST_VERSION = 1
+_HEADER_BYTES = 16
+
+
+def sniff_header(head: bytes) -> bool:
+    """先頭バイト列が対応形式のマジックナンバーか判定する。"""
+    if head.startswith(b"\xff\xd8\xff"):                       # JPEG
+        return True
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):                   # PNG
+        return True
+    if head[:6] in (b"GIF87a", b"GIF89a"):                      # GIF
+        return True
+    if head.startswith(b"BM"):                                  # BMP
+        return True
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":           # WebP
+        return True
+    if head[:4] in (b"II*\x00", b"MM\x00*"):                    # TIFF
+        return True
+    if head.startswith(b"\x00\x00\x00\x0cjP  \r\n\x87\n") or head.startswith(b"\xff\x4f\xff\x51"):  # JPEG 2000
+        return True
+    if len(head) >= 3 and head[0:1] == b"P" and head[1:2] in b"1234567" and head[2:3] in b" \t\r\n":  # PNM 系
+        return True
+    return False
+
+
+def sniff_image(path: str) -> bool:
+    try:
+        with open(path, "rb") as f:
+            return sniff_header(f.read(_HEADER_BYTES))
+    except OSError:
+        return False
+
+
+def has_image_ext(name: str) -> bool:
+    return os.path.splitext(name)[1].lower() in SUPPORTED_EXT
+
+
+class Scanner:
+    """フォルダ走査器。manifest_path を指定すると前回の走査結果を再利用・保存する。"""
+
+    def __init__(self, probe_workers: int = 8, manifest_path: Optional[str] = None):
+        self.probe_workers = probe_workers
+        self.manifest_path = manifest_path
+        self._old: Dict[str, Dict] = {}
+        self._new: Dict[str, Dict] = {}
+        self.dirs_scanned = 0
+        self.dirs_reused = 0
+        self.files_probed = 0
+        if manifest_path and os.path.exists(manifest_path):
+            try:
+                with open(manifest_path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                if data.get("version") == MANIFEST_VERSION:
+                    self._old = data.get("dirs", {})
+            except (OSError, ValueError):
+                self._old = {}
+
+    def scan(self, folder: str) -> Iterator[str]:
+        pool = ThreadPoolExecutor(max_workers=self.probe_workers) if self.probe_workers > 1 else None
+        try:
+            stack = [folder]
+            while stack:
+                d = stack.pop()
+                images, subdirs = self._list_dir(d, pool)
+                for name in images:
+                    yield os.path.join(d, name)
+                # 名前順に深さ優先で辿るため逆順に積む
+                stack.extend(os.path.join(d, s) for s in reversed(subdirs))
+        finally:
+            if pool is not None:
+                pool.shutdown(wait=False, cancel_futures=True)
+
+    def _list_dir(self, d: str, pool: Optional[ThreadPoolExecutor]) -> Tuple[List[str], List[str]]:
+        key = os.path.abspath(d)
+        try:
+            mtime_ns = os.stat(d).st_mtime_ns
+        except OSError:
+            return [], []
+        old = self._old.get(key)
+        if old is not None and old["mtime_ns"] == mtime_ns:
+            # エントリの増減が無いディレクトリは前回の一覧をそのまま使う
+            self.dirs_reused += 1
+            self._new[key] = old
+            return old["images"], old["subdirs"]
+        self.dirs_scanned += 1
+        files: List[str] = []
+        subdirs: List[str] = []
+        try:
+            with os.scandir(d) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir():
+                            # os.walk と同じくシンボリックリンク先のディレクトリには入らない
+                            if not entry.is_symlink():
+                                subdirs.append(entry.name)
+                        elif entry.is_file():
+                            files.append(entry.name)
+                    except OSError:
+                        continue
+        except OSError:
+            return [], []
+        files.sort()
+        subdirs.sort()
+        unknown = [n for n in files if not has_image_ext(n)]
+        accepted = set(n for n in files if has_image_ext(n))
+        if unknown:
+            self.files_probed += len(unknown)
+            paths = [os.path.join(d, n) for n in unknown]
+            found = pool.map(sniff_image, paths) if pool is not None else map(sniff_image, paths)
+            accepted.update(n for n, ok in zip(unknown, found) if ok)
+        images = [n for n in files if n in accepted]
+        self._new[key] = {"mtime_ns": mtime_ns, "images": images, "subdirs": subdirs}
+        return images, subdirs
+
+    def save_manifest(self):
+        """今回辿ったディレクトリの一覧をマニフェストへ保存する (アトミックに置換)。"""
+        if not self.manifest_path:
+            return
+        tmp = self.manifest_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"version": MANIFEST_VERSION, "dirs": self._new}, f, ensure_ascii=False)
+        os.replace(tmp, self.manifest_path)
+
+
+def scan_images(folder: str, probe_workers: int = 8, manifest_path: Optional[str] = None) -> Iterator[str]:
+    """folder 以下の画像パスを逐次返す。最後まで読み切るとマニフェストを保存する。"""
+    scanner = Scanner(probe_workers=probe_workers, manifest_path=manifest_path)
+    yield from scanner.scan(folder)
+    scanner.save_manifest()
+
+
+_DONE = object()
+
+
+def background(paths: Iterator[str], maxsize: int = 10000) -> Iterator[str]:
+    """paths を別スレッドで先読みし、走査と解析を並行させる。
+
+    走査側で起きた例外は読み出し側で再送出する。
+    """
+    q: "queue.Queue" = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for p in paths:
+                while not stop.is_set():
+                    try:
+                        q.put(p, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                if stop.is_set():
+                    return
+            q.put(_DONE)
+        except BaseException as e:  # 読み出し側へ伝える
+            q.put(e)
+
+    t = threading.Thread(target=produce, name="twins-scan", daemon=True)
+    t.start()
+    try:
+        while True:
+            item = q.get()
+            if item is _DONE:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
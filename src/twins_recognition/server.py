@@ -0,0 +1,334 @@
+"""推論サーバー (twins-serve)
+同じホスト上の他サービスから呼ぶための JSON API。HTML ページやバッチ用の一時ディレクトリは使わない。
+- POST /v1/analyze に画像バイト列 (本文そのまま / multipart の file) かパス (JSON) を渡すと、
+  ImageAnalysis.to_dict の内容を返す。バイト列は一時ファイルを作らずメモリからデコードする
+- 同時に届いた要求は MicroBatcher がまとめ (最大 max_batch 枚、先頭の要求から max_wait_ms まで待つ)、
+  ワーカーで analyze_images により一括で検出・エンコードする。
+  ワーカーがすべて使用中の間に届いた要求は次のマイクロバッチにまとまる
+- 受付待ちが max_queue を超えたら 429 (Retry-After 付き)
+- ワーカーは起動時にモデルを読み込んでおく (最初の要求が遅くならない)
+
+    twins-serve --port 8765 --workers 4 --max-batch 8 --max-wait-ms 5
+    curl --data-binary @photo.jpg -H 'Content-Type: image/jpeg' http://127.0.0.1:8765/v1/analyze
+    curl -d '{"paths": ["/data/a.jpg", "/data/b.jpg"]}' -H 'Content-Type: application/json' http://127.0.0.1:8765/v1/analyze
+"""
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from dataclasses import dataclass
+from typing import Any, Deque, Dict, List, Optional, Sequence, Tuple
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+from .batch import default_workers, init_worker
+from .processor import AnalyzeOptions, ImageResult, analyze_images
+from .stats import StageStats
+
+DEFAULT_PORT = 8765
+
+
+class ServerBusy(Exception):
+    """受付待ちの要求が上限に達している。"""
+
+
+@dataclass
+class _Request:
+    path: str                 # 結果の path に入る名前 (バイト列の場合はファイル名など)
+    data: Optional[bytes]     # None ならサーバー上のファイル path を読む
+    future: Future
+    enqueued: float
+
+
+def _analyze_micro_batch(paths: List[str], blobs: List[Optional[bytes]],
+                         options: Optional[AnalyzeOptions]) -> Tuple[List[ImageResult], StageStats]:
+    """ワーカー側: マイクロバッチをまとめて解析する。"""
+    stats = StageStats()
+    return analyze_images(paths, options, stats, blobs=blobs), stats
+
+
+def _warm() -> int:
+    time.sleep(0.1)   # 同じワーカーが続けて受け取らないよう少し保持する
+    return os.getpid()
+
+
+class MicroBatcher:
+    """要求をマイクロバッチにまとめてワーカープールへ渡す。"""
+
+    def __init__(self, workers: Optional[int] = None, max_batch: int = 8, max_wait_ms: float = 5.0,
+                 max_queue: int = 64, mode: str = "process", options: Optional[AnalyzeOptions] = None):
+        self.workers = workers or default_workers()
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self.max_queue = max(1, max_queue)
+        self.mode = mode
+        self.options = options
+        self._queue: Deque[_Request] = deque()
+        self._cond = threading.Condition()
+        self._slots = threading.Semaphore(self.workers)   # 実行中のマイクロバッチ数
+        self._executor: Optional[Executor] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = False
+        # /metrics 用
+        self.stats = StageStats()
+        self.requests = 0
+        self.rejected = 0
+        self.batches = 0
+        self.batched_images = 0
+        self.inflight = 0
+        self._stats_lock = threading.Lock()
+
+    def start(self, preload: bool = True) -> "MicroBatcher":
+        if self._thread is not None:
+            return self
+        if self.mode == "thread":
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="twins-serve")
+            if preload:
+                init_worker()
+        else:
+            ctx = multiprocessing.get_context("spawn")
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=ctx, initializer=init_worker)
+            if preload:
+                # 全ワーカーを起動してモデルを読み込ませる
+                for f in [self._executor.submit(_warm) for _ in range(self.workers)]:
+                    f.result()
+        self._thread = threading.Thread(target=self._run, name="twins-batcher", daemon=True)
+        self._thread.start()
+        return self
+
+    @property
+    def queued(self) -> int:
+        with self._cond:
+            return len(self._queue)
+
+    def submit_many(self, items: Sequence[Tuple[str, Optional[bytes]]]) -> List[Future]:
+        """(名前またはパス, バイト列 or None) の列を受け付ける。入りきらなければ ServerBusy。"""
+        now = time.monotonic()
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("MicroBatcher is shut down")
+            if len(self._queue) + len(items) > self.max_queue:
+                with self._stats_lock:
+                    self.rejected += len(items)
+                raise ServerBusy(f"受付待ちの要求が上限 ({self.max_queue}) に達しています")
+            reqs = [_Request(path, data, Future(), now) for path, data in items]
+            self._queue.extend(reqs)
+            self._cond.notify_all()
+        with self._stats_lock:
+            self.requests += len(reqs)
+        return [r.future for r in reqs]
+
+    def submit(self, path: str, data: Optional[bytes] = None) -> Future:
+        return self.submit_many([(path, data)])[0]
+
+    def _next_batch(self) -> Optional[List[_Request]]:
+        with self._cond:
+            while not self._queue and not self._stopped:
+                self._cond.wait()
+            if self._stopped:
+                return None
+            # 先頭の要求が届いてから max_wait まで、max_batch 件に達するのを待つ
+            deadline = self._queue[0].enqueued + self.max_wait
+            while len(self._queue) < self.max_batch and not self._stopped:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            n = min(self.max_batch, len(self._queue))
+            return [self._queue.popleft() for _ in range(n)]
+
+    def _run(self):
+        assert self._executor is not None
+        while True:
+            # 空きワーカーを待つ間に届いた要求は次のバッチにまとまる
+            self._slots.acquire()
+            batch = self._next_batch()
+            if batch is None:
+                self._slots.release()
+                return
+            with self._stats_lock:
+                self.batches += 1
+                self.batched_images += len(batch)
+                self.inflight += len(batch)
+            try:
+                fut = self._executor.submit(_analyze_micro_batch, [r.path for r in batch],
+                                            [r.data for r in batch], self.options)
+            except Exception as e:
+                self._complete(batch, None, e)
+                continue
+            fut.add_done_callback(lambda f, batch=batch: self._complete(batch, f))
+
+    def _complete(self, batch: List[_Request], fut: Optional[Future], error: Optional[Exception] = None):
+        stats = None
+        try:
+            if fut is not None:
+                results, stats = fut.result()
+            else:
+                raise error or RuntimeError("submit failed")
+        except Exception as e:   # ワーカー異常終了など
+            results = [(None, str(e) or type(e).__name__)] * len(batch)
+        finally:
+            self._slots.release()
+        with self._stats_lock:
+            self.inflight -= len(batch)
+            if stats is not None:
+                self.stats.merge(stats)
+        for r, res in zip(batch, results):
+            r.future.set_result(res)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            stats = StageStats()
+            stats.merge(self.stats)
+            return {"stats": stats, "requests": self.requests, "rejected": self.rejected, "batches": self.batches,
+                    "batched_images": self.batched_images, "inflight": self.inflight}
+
+    def shutdown(self, wait: bool = True):
+        with self._cond:
+            self._stopped = True
+            pending = list(self._queue)
+            self._queue.clear()
+            self._cond.notify_all()
+        for r in pending:
+            r.future.set_result((None, "server is shutting down"))
+        if self._thread is not None and wait:
+            self._thread.join()
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=True)
+
+
+def _json(data: Any, status: int = 200, headers: Optional[Dict[str, str]] = None):
+    from flask import Response
+    return Response(json.dumps(data, ensure_ascii=False), status=status, mimetype="application/json",
+                    headers=headers)
+
+
+def _inside(path: str, root: str) -> bool:
+    path, root = os.path.realpath(path), os.path.realpath(root)
+    return path == root or path.startswith(root.rstrip(os.sep) + os.sep)
+
+
+def create_app(batcher: MicroBatcher, max_bytes: int = 32 * 1024 * 1024, path_root: Optional[str] = None,
+               timeout: float = 30.0):
+    """batcher を使う Flask アプリを作る (batcher.start() は呼び出し側で行う)。"""
+    from flask import Flask, Response, request
+
+    app = Flask(__name__)
+    app.config["MAX_CONTENT_LENGTH"] = max_bytes
+
+    @app.post("/v1/analyze")
+    def analyze():
+        items: List[Tuple[str, Optional[bytes]]] = []
+        if request.mimetype == "application/json":
+            body = request.get_json(silent=True) or {}
+            paths = body.get("paths") or ([body["path"]] if body.get("path") else [])
+            if not isinstance(paths, list) or not all(isinstance(p, str) for p in paths):
+                return _json({"error": "paths は文字列のリストで指定してください"}, 400)
+            for p in paths:
+                if path_root is not None and not _inside(p, path_root):
+                    return _json({"error": f"path_root の外のパスは指定できません: {p}"}, 403)
+                items.append((p, None))
+        elif request.mimetype == "multipart/form-data":
+            for f in request.files.getlist("file") or list(request.files.values()):
+                items.append((f.filename or "upload", f.read()))
+        else:
+            data = request.get_data(cache=False)
+            if data:
+                items.append((request.args.get("name", "upload"), data))
+        if not items:
+            return _json({"error": "画像がありません"}, 400)
+
+        try:
+            futures = batcher.submit_many(items)
+        except ServerBusy as e:
+            return _json({"error": str(e)}, 429, {"Retry-After": "1"})
+        deadline = time.monotonic() + timeout
+        out = []
+        for (name, data), fut in zip(items, futures):
+            try:
+                analysis, error = fut.result(max(0.0, deadline - time.monotonic()))
+            except FutureTimeout:
+                return _json({"error": "timeout"}, 504)
+            if analysis is None:
+                out.append({"path": name, "error": error})
+                continue
+            if data is not None:
+                analysis.path = name   # メモリ上の画像は絶対パスではなく名前のまま返す
+            out.append(analysis.to_dict())
+        if len(out) == 1:
+            return _json(out[0], 422 if "error" in out[0] else 200)
+        return _json({"results": out})
+
+    @app.get("/healthz")
+    def healthz():
+        return _json({"ok": True, "workers": batcher.workers, "queued": batcher.queued})
+
+    @app.get("/metrics")
+    def metrics():
+        snap = batcher.snapshot()
+        lines = snap["stats"].prometheus()
+        lines += [
+            "# HELP twins_serve_requests_total Images accepted by the inference server.",
+            "# TYPE twins_serve_requests_total counter",
+            f"twins_serve_requests_total {snap['requests']}",
+            "# HELP twins_serve_rejected_total Images rejected with 429 because the queue was full.",
+            "# TYPE twins_serve_rejected_total counter",
+            f"twins_serve_rejected_total {snap['rejected']}",
+            "# HELP twins_serve_batches_total Micro-batches dispatched to workers.",
+            "# TYPE twins_serve_batches_total counter",
+            f"twins_serve_batches_total {snap['batches']}",
+            "# HELP twins_serve_batched_images_total Images dispatched in micro-batches.",
+            "# TYPE twins_serve_batched_images_total counter",
+            f"twins_serve_batched_images_total {snap['batched_images']}",
+            "# HELP twins_serve_queued Images waiting to be batched.",
+            "# TYPE twins_serve_queued gauge",
+            f"twins_serve_queued {batcher.queued}",
+            "# HELP twins_serve_inflight Images being analyzed by workers.",
+            "# TYPE twins_serve_inflight gauge",
+            f"twins_serve_inflight {snap['inflight']}",
+        ]
+        return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+    @app.errorhandler(413)
+    def too_large(_e):
+        return _json({"error": f"要求が大きすぎます (上限 {max_bytes // (1024 * 1024)}MB)"}, 413)
+
+    return app
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    from .cli import add_analysis_args, analysis_options
+
+    parser = argparse.ArgumentParser(prog="twins-serve", description="マイクロバッチ付きのローカル推論サーバー (JSON API)")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="待ち受けアドレス (既定: ローカルのみ)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--mode", choices=["process", "thread"], default="process", help="ワーカーの種類")
+    parser.add_argument("--max-batch", type=int, default=8, help="1回にまとめる画像の最大数")
+    parser.add_argument("--max-wait-ms", type=float, default=5.0, help="バッチがそろうのを待つ最大時間 (ms)")
+    parser.add_argument("--max-queue", type=int, default=64, help="受付待ちの上限 (超えると 429)")
+    parser.add_argument("--max-mb", type=int, default=32, help="1要求の本文の上限 (MB)")
+    parser.add_argument("--timeout", type=float, default=30.0, help="1要求の処理待ちの上限 (秒)")
+    parser.add_argument("--path-root", type=str, default=None, help="パス指定をこのディレクトリ配下に限る")
+    add_analysis_args(parser)
+    parser.set_defaults(workers=default_workers())
+    args = parser.parse_args(argv)
+
+    batcher = MicroBatcher(workers=args.workers, max_batch=args.max_batch, max_wait_ms=args.max_wait_ms,
+                           max_queue=args.max_queue, mode=args.mode, options=analysis_options(args))
+    t0 = time.perf_counter()
+    batcher.start(preload=True)
+    print(f"ワーカー {batcher.workers} 個を起動しました ({time.perf_counter() - t0:.1f}s)", file=sys.stderr)
+    app = create_app(batcher, max_bytes=args.max_mb * 1024 * 1024, path_root=args.path_root, timeout=args.timeout)
+    try:
+        app.run(host=args.host, port=args.port, debug=False, threaded=True)
+    finally:
+        batcher.shutdown(wait=False)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,258 @@
+"""逐次集計
+ラベル件数と距離の平均/中央値を、画像数に依存しない一定メモリで更新する。
+中央値は固定幅ヒストグラムからの推定値 (誤差は BIN_WIDTH / 2 以下)。
+StageStats はバッチ解析の段階ごとの処理時間・枚数 (images/sec) と、1枚あたり時間の
+パーセンタイル (対数ヒストグラム) を集計する。
+"""
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import math
+import time
+
+import numpy as np
+
+# 128次元埋め込みのユークリッド距離は実用上 0〜2 に収まる (超過分は最終ビンへ)
+MAX_DISTANCE = 2.0
+BIN_WIDTH = 1e-4
+
+
+class RunningSummary:
+    def __init__(self):
+        self.counts: Dict[str, int] = {}   # 初出順 (collections.Counter と同じ並び)
+        self.errors = 0
+        self.duplicates = 0
+        self.n_distances = 0
+        self._sum = 0.0
+        self._hist = np.zeros(int(round(MAX_DISTANCE / BIN_WIDTH)), dtype=np.int64)
+
+    @property
+    def total(self) -> int:
+        return sum(self.counts.values())
+
+    def add(self, label: str, distance: Optional[float], duplicate: bool = False):
+        self.counts[label] = self.counts.get(label, 0) + 1
+        if duplicate:
+            self.duplicates += 1
+        if distance is None:
+            return
+        self.n_distances += 1
+        self._sum += distance
+        b = min(max(int(distance / BIN_WIDTH), 0), self._hist.size - 1)
+        self._hist[b] += 1
+
+    def add_error(self):
+        self.errors += 1
+
+    def merge(self, other: "RunningSummary"):
+        for label, cnt in other.counts.items():
+            self.counts[label] = self.counts.get(label, 0) + cnt
+        self.errors += other.errors
+        self.duplicates += other.duplicates
+        self.n_distances += other.n_distances
+        self._sum += other._sum
+        self._hist += other._hist
+
+    @property
+    def mean(self) -> Optional[float]:
+        return self._sum / self.n_distances if self.n_distances else None
+
+    @property
+    def median(self) -> Optional[float]:
+        """ヒストグラムの累積から中央値を線形補間で推定する。"""
+        n = self.n_distances
+        if n == 0:
+            return None
+        cum = np.cumsum(self._hist)
+        # statistics.median と同じく、偶数件は中央2点の平均
+        lo = self._quantile_rank(cum, (n - 1) // 2)
+        hi = self._quantile_rank(cum, n // 2)
+        return (lo + hi) / 2
+
+    def _quantile_rank(self, cum: np.ndarray, rank: int) -> float:
+        b = int(np.searchsorted(cum, rank, side="right"))
+        before = int(cum[b - 1]) if b > 0 else 0
+        in_bin = int(self._hist[b])
+        # ビン内では値が一様に並んでいるとみなす
+        frac = (rank - before + 0.5) / in_bin
+        return (b + frac) * BIN_WIDTH
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Web の summary と同じ形 (counts/total/mean_distance/median_distance)。"""
+        d: Dict[str, Any] = {"counts": dict(self.counts), "total": self.total}
+        if self.n_distances:
+            d["mean_distance"] = round(self.mean, 3)  # type: ignore[arg-type]
+            d["median_distance"] = round(self.median, 3)  # type: ignore[arg-type]
+        if self.errors:
+            d["errors"] = self.errors
+        if self.duplicates:
+            d["duplicates"] = self.duplicates
+        return d
+
+
+# バッチ解析の段階 (表示順)。thumbnail / output は Web / CLI 側で計測する
+STAGES = ("decode", "detect", "align", "encode", "classify", "thumbnail", "output")
+
+# 1枚あたり処理時間のヒストグラム: 10µs〜1000秒を 1桁10分割の対数幅で区切る
+LATENCY_MIN = 1e-5
+LATENCY_STEPS_PER_DECADE = 10
+LATENCY_BUCKETS = 8 * LATENCY_STEPS_PER_DECADE
+
+
+class LatencyHistogram:
+    """対数幅ビンの件数だけを持つ遅延分布 (一定メモリでマージ可能)。
+
+    パーセンタイルはビン内を対数一様とみなした推定値 (相対誤差は約 ±12% 以内)。
+    """
+
+    def __init__(self):
+        self.counts = np.zeros(LATENCY_BUCKETS + 2, dtype=np.int64)   # [下限未満, ビン..., 上限以上]
+        self.count = 0
+        self.sum = 0.0
+
+    @staticmethod
+    def bound(i: int) -> float:
+        """i 番目のビンの上端 (秒)。"""
+        return LATENCY_MIN * 10 ** ((i + 1) / LATENCY_STEPS_PER_DECADE)
+
+    def add(self, seconds: float, n: int = 1):
+        if n <= 0:
+            return
+        if seconds < LATENCY_MIN:
+            b = 0
+        else:
+            b = int(math.log10(seconds / LATENCY_MIN) * LATENCY_STEPS_PER_DECADE) + 1
+            b = min(b, self.counts.size - 1)
+        self.counts[b] += n
+        self.count += n
+        self.sum += seconds * n
+
+    def merge(self, other: "LatencyHistogram"):
+        self.counts += other.counts
+        self.count += other.count
+        self.sum += other.sum
+
+    def quantile(self, q: float) -> Optional[float]:
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        cum = np.cumsum(self.counts)
+        b = int(np.searchsorted(cum, rank, side="right"))
+        if b == 0:
+            return LATENCY_MIN
+        if b >= self.counts.size - 1:
+            return self.bound(LATENCY_BUCKETS - 1)
+        before = int(cum[b - 1])
+        frac = (rank - before + 0.5) / int(self.counts[b])
+        lo = LATENCY_MIN * 10 ** ((b - 1) / LATENCY_STEPS_PER_DECADE)
+        return lo * 10 ** (frac / LATENCY_STEPS_PER_DECADE)
+
+    def cumulative(self, every: int = 5) -> List[Tuple[float, int]]:
+        """Prometheus の histogram 用に (上端, 累積件数) を every ビンおきに返す。"""
+        cum = np.cumsum(self.counts)
+        return [(self.bound(i), int(cum[i + 1])) for i in range(every - 1, LATENCY_BUCKETS, every)]
+
+
+class StageStats:
+    """段階ごとの所要秒数・処理枚数と1枚あたり時間の分布。ワーカーから返した分を merge で合算する。
+
+    秒数はワーカーごとの合計なので、images_per_sec は1ワーカーあたりの速度になる。
+    まとめて処理した段階 (detect/encode など) は、所要時間を枚数で割った値を1枚の時間とみなす。
+    """
+
+    def __init__(self):
+        self.seconds: Dict[str, float] = {}
+        self.images: Dict[str, int] = {}
+        self.latency: Dict[str, LatencyHistogram] = {}
+        self.faces = 0
+        self.cache_hits = 0
+        self.duplicates = 0        # 重複画像として検出・エンコードを省いた枚数
+        self.duplicate_faces = 0   # そのうち流用した顔の数 (エンコードを省いた顔)
+
+    @contextmanager
+    def stage(self, name: str, images: int = 1) -> Iterator[None]:
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - t0, images)
+
+    def add(self, name: str, seconds: float, images: int):
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+        self.images[name] = self.images.get(name, 0) + images
+        if images > 0:
+            self._hist(name).add(seconds / images, images)
+
+    def _hist(self, name: str) -> LatencyHistogram:
+        h = self.latency.get(name)
+        if h is None:
+            h = self.latency[name] = LatencyHistogram()
+        return h
+
+    def merge(self, other: "StageStats"):
+        for name, sec in other.seconds.items():
+            self.seconds[name] = self.seconds.get(name, 0.0) + sec
+            self.images[name] = self.images.get(name, 0) + other.images.get(name, 0)
+        for name, h in other.latency.items():
+            self._hist(name).merge(h)
+        self.faces += other.faces
+        self.cache_hits += other.cache_hits
+        self.duplicates += other.duplicates
+        self.duplicate_faces += other.duplicate_faces
+
+    def stage_names(self) -> List[str]:
+        return [n for n in STAGES if n in self.seconds] + [n for n in self.seconds if n not in STAGES]
+
+    def to_dict(self) -> Dict[str, Any]:
+        stages = {}
+        for n in self.stage_names():
+            sec, cnt = self.seconds[n], self.images.get(n, 0)
+            d: Dict[str, Any] = {"images": cnt, "seconds": round(sec, 3),
+                                 "images_per_sec": round(cnt / sec, 2) if sec > 0 else None}
+            h = self.latency.get(n)
+            if h is not None and h.count:
+                for label, q in (("p50_ms", 0.5), ("p95_ms", 0.95), ("p99_ms", 0.99)):
+                    d[label] = round(h.quantile(q) * 1000, 3)  # type: ignore[operator]
+            stages[n] = d
+        return {"stages": stages, "faces": self.faces, "cache_hits": self.cache_hits,
+                "duplicates": self.duplicates, "duplicate_faces": self.duplicate_faces}
+
+    def format(self) -> str:
+        lines = [f"{'stage':<10}{'枚':>8}{'秒':>10}{'枚/秒':>10}{'p50ms':>10}{'p95ms':>10}{'p99ms':>10}"]
+        for n, d in self.to_dict()["stages"].items():
+            rate = f"{d['images_per_sec']:.2f}" if d["images_per_sec"] is not None else "-"
+            pcts = "".join(f"{d[k]:>10.1f}" if k in d else f"{'-':>10}" for k in ("p50_ms", "p95_ms", "p99_ms"))
+            lines.append(f"{n:<10}{d['images']:>8}{d['seconds']:>10.3f}{rate:>10}{pcts}")
+        lines.append(f"顔数: {self.faces}  キャッシュヒット: {self.cache_hits}  "
+                     f"重複省略: {self.duplicates} 枚 (顔 {self.duplicate_faces})")
+        return "\n".join(lines)
+
+    def prometheus(self, prefix: str = "twins") -> List[str]:
+        """Prometheus テキスト形式の行 (段階ごとの histogram と件数)。"""
+        lines = [
+            f"# HELP {prefix}_stage_seconds Per-image processing time by stage.",
+            f"# TYPE {prefix}_stage_seconds histogram",
+        ]
+        for n in self.stage_names():
+            h = self.latency.get(n)
+            if h is None:
+                continue
+            for le, c in h.cumulative():
+                lines.append(f'{prefix}_stage_seconds_bucket{{stage="{n}",le="{le:.6g}"}} {c}')
+            lines.append(f'{prefix}_stage_seconds_bucket{{stage="{n}",le="+Inf"}} {h.count}')
+            lines.append(f'{prefix}_stage_seconds_sum{{stage="{n}"}} {h.sum:.6f}')
+            lines.append(f'{prefix}_stage_seconds_count{{stage="{n}"}} {h.count}')
+        lines += [
+            f"# HELP {prefix}_faces_total Faces detected and encoded.",
+            f"# TYPE {prefix}_faces_total counter",
+            f"{prefix}_faces_total {self.faces}",
+            f"# HELP {prefix}_cache_hits_total Images served from the embedding cache.",
+            f"# TYPE {prefix}_cache_hits_total counter",
+            f"{prefix}_cache_hits_total {self.cache_hits}",
+            f"# HELP {prefix}_duplicates_total Images whose detection and encoding were skipped as duplicates.",
+            f"# TYPE {prefix}_duplicates_total counter",
+            f"{prefix}_duplicates_total {self.duplicates}",
+            f"# HELP {prefix}_duplicate_faces_total Faces reused from duplicate images instead of being encoded.",
+            f"# TYPE {prefix}_duplicate_faces_total counter",
+            f"{prefix}_duplicate_faces_total {self.duplicate_faces}",
+        ]
+        return lines
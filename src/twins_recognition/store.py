@@ -0,0 +1,474 @@
+"""解析結果のバイナリストア
+顔埋め込みを float32/float16 (または quantize の正規化表現) の行列として、その他のメタデータ (パス番号・顔枠・
+ラベル・距離) を列ごとの固定長バイナリとして追記保存する。読み出しは np.memmap に
+よるゼロコピーで、JSON/CSV 出力はこのストアから生成するビューとして扱う。
+
+ディレクトリ構成:
+    meta.json            形式情報と確定済みの件数
+    paths.jsonl          画像パス (1行1画像, JSON 文字列)
+    errors.jsonl         解析失敗の {"index", "error"}
+    duplicates.jsonl     重複画像として結果を流用した {"index", "duplicate"}
+    embeddings.bin       (顔数, dim) float32/float16 (float16n/int8n は単位ベクトルの符号)
+    embedding_scale.bin  (顔数,) float32 復元用の係数 (float16n/int8n のみ)
+    face_boxes.bin       (顔数, 4) int32 (top, right, bottom, left)
+    face_image.bin       (顔数,) int32 所属画像番号
+    image_label.bin      (画像数,) uint8 ラベル番号
+    image_distance.bin   (画像数,) float64 代表距離 (無い場合 NaN)
+    image_face_start.bin (画像数,) int64 顔列の開始位置
+    image_face_count.bin (画像数,) int32 顔数
+"""
+from typing import Any, Callable, Dict, Iterator, List, Optional, TextIO
+import csv
+import json
+import math
+import os
+
+import numpy as np
+
+from .processor import ImageAnalysis
+from .quantize import KINDS, NORMALIZED_KINDS, EncodedEmbeddings, code_dtype, encode
+
+STORE_VERSION = 1
+EMBEDDING_DIM = 128
+
+LABELS = ["twins", "siblings", "similar", "different", "single_person", "no_face"]
+LABEL_CODES = {label: i for i, label in enumerate(LABELS)}
+ERROR_CODE = 255
+
+# 列名 -> (dtype, 1行あたりの要素数)。embeddings は dtype がストアごとに変わるので別扱い
+_FACE_COLUMNS = {
+    "face_boxes": (np.int32, 4),
+    "face_image": (np.int32, 1),
+}
+_IMAGE_COLUMNS = {
+    "image_label": (np.uint8, 1),
+    "image_distance": (np.float64, 1),
+    "image_face_start": (np.int64, 1),
+    "image_face_count": (np.int32, 1),
+}
+
+
+class EmbeddingStore:
+    """追記型の列指向ストア。書き込みはバッファし、flush 時に meta.json の件数を確定する。
+
+    readonly=True で開くと既存の列を memmap するだけで、途中書き込みの切り捨て (_recover) や
+    meta.json の書き換えを行わない。別プロセス/スレッドの書き込み中でも確定済みの件数だけを読む。
+    """
+
+    def __init__(self, root: str, dtype: str = "float32", dim: int = EMBEDDING_DIM, flush_every: int = 256,
+                 readonly: bool = False):
+        self.root = root
+        self.flush_every = flush_every
+        self.readonly = readonly
+        meta_path = os.path.join(root, "meta.json")
+        if readonly and not os.path.exists(meta_path):
+            raise FileNotFoundError(f"ストアがありません: {root}")
+        if not readonly:
+            os.makedirs(root, exist_ok=True)
+        if os.path.exists(meta_path):
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta.get("version") != STORE_VERSION:
+                raise ValueError(f"未対応のストア形式です: {meta.get('version')}")
+        else:
+            if dtype not in KINDS:
+                raise ValueError(f"embedding dtype は {'/'.join(KINDS)} のみ対応: {dtype}")
+            meta = {"version": STORE_VERSION, "dim": dim, "dtype": dtype, "n_images": 0, "n_faces": 0}
+        self.meta = meta
+        self.dim: int = meta["dim"]
+        self.kind: str = meta["dtype"]
+        self.dtype = code_dtype(self.kind)
+        face_columns = dict(_FACE_COLUMNS)
+        if self.kind in NORMALIZED_KINDS:
+            face_columns["embedding_scale"] = (np.float32, 1)
+        self._face_names = ("embeddings", *face_columns)
+        self._columns = {"embeddings": (self.dtype, self.dim), **face_columns, **_IMAGE_COLUMNS}
+        self._buffers: Dict[str, List[np.ndarray]] = {name: [] for name in self._columns}
+        self._paths_buf: List[str] = []
+        self._errors_buf: List[Dict[str, Any]] = []
+        self._dups_buf: List[Dict[str, Any]] = []
+        self._pending_images = 0
+        self._pending_faces = 0
+        self._maps: Dict[str, np.ndarray] = {}
+        self._paths: Optional[List[str]] = None
+        self._errors: Optional[Dict[int, str]] = None
+        self._dups: Optional[Dict[int, Dict[str, Any]]] = None
+        if not readonly:
+            self._recover()
+            self._write_meta()
+
+    # --- 件数 ---
+
+    @property
+    def n_images(self) -> int:
+        return self.meta["n_images"] + self._pending_images
+
+    @property
+    def n_faces(self) -> int:
+        return self.meta["n_faces"] + self._pending_faces
+
+    def __len__(self) -> int:
+        return self.n_images
+
+    # --- 書き込み ---
+
+    def append(self, analysis: ImageAnalysis) -> int:
+        """解析結果を1画像分追記し、画像番号を返す。"""
+        emb = analysis.embeddings
+        if emb is None:
+            emb = np.empty((0, self.dim), dtype=np.float32)
+        emb = np.asarray(emb).reshape(-1, self.dim)
+        # 顔はあるが埋め込みが無い場合 (呼び出し側で省いた等) も顔枠は残す
+        n = len(analysis.faces)
+        if emb.shape[0] != n:
+            emb = np.full((n, self.dim), np.nan, dtype=np.float32)
+        cls = analysis.classification
+        index = self._append_row(
+            path=analysis.path,
+            label=LABEL_CODES[cls.label],
+            distance=cls.distance,
+            emb=emb,
+            boxes=np.asarray(analysis.faces, dtype=np.int32).reshape(-1, 4),
+        )
+        if analysis.duplicate is not None:
+            self._dups_buf.append({"index": index, "duplicate": analysis.duplicate})
+        return index
+
+    def append_error(self, path: str, error: Optional[str]) -> int:
+        """解析に失敗した画像を記録する (出力順を保つため画像番号を消費する)。"""
+        index = self._append_row(path=os.path.abspath(path), label=ERROR_CODE, distance=None,
+                                 emb=np.empty((0, self.dim), dtype=np.float32),
+                                 boxes=np.empty((0, 4), dtype=np.int32))
+        self._errors_buf.append({"index": index, "error": error})
+        return index
+
+    def _append_row(self, path: str, label: int, distance: Optional[float], emb: np.ndarray, boxes: np.ndarray) -> int:
+        if self.readonly:
+            raise ValueError(f"読み取り専用で開いたストアには書き込めません: {self.root}")
+        index = self.n_images
+        n = emb.shape[0]
+        b = self._buffers
+        enc = encode(emb, self.kind)
+        b["embeddings"].append(enc.codes)
+        if enc.scales is not None:
+            b["embedding_scale"].append(enc.scales)
+        b["face_boxes"].append(boxes)
+        b["face_image"].append(np.full(n, index, dtype=np.int32))
+        b["image_label"].append(np.array([label], dtype=np.uint8))
+        b["image_distance"].append(np.array([math.nan if distance is None else distance], dtype=np.float64))
+        b["image_face_start"].append(np.array([self.n_faces], dtype=np.int64))
+        b["image_face_count"].append(np.array([n], dtype=np.int32))
+        self._paths_buf.append(path)
+        self._pending_images += 1
+        self._pending_faces += n
+        if self._pending_images >= self.flush_every:
+            self.flush()
+        return index
+
+    def flush(self):
+        """バッファを各列ファイルへ追記し、meta.json の件数を確定する。"""
+        if self._pending_images == 0:
+            return
+        for name, chunks in self._buffers.items():
+            if chunks:
+                with open(self._col_path(name), "ab") as f:
+                    for arr in chunks:
+                        f.write(np.ascontiguousarray(arr).tobytes())
+                chunks.clear()
+        with open(os.path.join(self.root, "paths.jsonl"), "a", encoding="utf-8") as f:
+            for p in self._paths_buf:
+                f.write(json.dumps(p, ensure_ascii=False) + "\n")
+        for name, buf in (("errors.jsonl", self._errors_buf), ("duplicates.jsonl", self._dups_buf)):
+            if buf:
+                with open(os.path.join(self.root, name), "a", encoding="utf-8") as f:
+                    for e in buf:
+                        f.write(json.dumps(e, ensure_ascii=False) + "\n")
+        if self._paths is not None:
+            self._paths.extend(self._paths_buf)
+        if self._errors is not None:
+            self._errors.update({e["index"]: e["error"] for e in self._errors_buf})
+        if self._dups is not None:
+            self._dups.update({e["index"]: e["duplicate"] for e in self._dups_buf})
+        self._paths_buf.clear()
+        self._errors_buf.clear()
+        self._dups_buf.clear()
+        self.meta["n_images"] += self._pending_images
+        self.meta["n_faces"] += self._pending_faces
+        self._pending_images = 0
+        self._pending_faces = 0
+        self._maps.clear()
+        self._write_meta()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self) -> "EmbeddingStore":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _col_path(self, name: str) -> str:
+        return os.path.join(self.root, f"{name}.bin")
+
+    def _write_meta(self):
+        tmp = os.path.join(self.root, ".meta.json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.meta, f)
+        os.replace(tmp, os.path.join(self.root, "meta.json"))
+
+    def _recover(self):
+        """meta.json に確定していない途中書き込み (クラッシュ時) を切り捨てる。"""
+        for name, (dtype, width) in self._columns.items():
+            rows = self.meta["n_faces"] if name in self._face_names else self.meta["n_images"]
+            size = rows * width * np.dtype(dtype).itemsize
+            p = self._col_path(name)
+            if os.path.exists(p) and os.path.getsize(p) > size:
+                os.truncate(p, size)
+        self._truncate_lines("paths.jsonl", self.meta["n_images"])
+        for name in ("errors.jsonl", "duplicates.jsonl"):
+            p = os.path.join(self.root, name)
+            if os.path.exists(p):
+                with open(p, "r", encoding="utf-8") as f:
+                    keep = [line for line in f if line.endswith("\n") and json.loads(line)["index"] < self.meta["n_images"]]
+                with open(p, "w", encoding="utf-8") as f:
+                    f.writelines(keep)
+
+    def _truncate_lines(self, name: str, n: int):
+        p = os.path.join(self.root, name)
+        if not os.path.exists(p):
+            return
+        with open(p, "rb+") as f:
+            pos = 0
+            for _ in range(n):
+                line = f.readline()
+                if not line:
+                    return
+                pos += len(line)
+            f.truncate(pos)
+
+    # --- 読み出し (ゼロコピー) ---
+
+    def column(self, name: str) -> np.ndarray:
+        """確定済みの列を memmap で返す (flush 前の追記分は含まない)。"""
+        arr = self._maps.get(name)
+        if arr is not None:
+            return arr
+        dtype, width = self._columns[name]
+        rows = self.meta["n_faces"] if name in self._face_names else self.meta["n_images"]
+        shape = (rows, width) if width > 1 or name == "embeddings" else (rows,)
+        if rows == 0:
+            arr = np.empty(shape, dtype=dtype)
+        else:
+            arr = np.memmap(self._col_path(name), dtype=dtype, mode="r", shape=shape)
+        self._maps[name] = arr
+        return arr
+
+    def encoded(self) -> EncodedEmbeddings:
+        """埋め込みを保存した表現のまま返す (memmap。コサイン距離は .unit() で求まる)。"""
+        scales = self.column("embedding_scale") if self.kind in NORMALIZED_KINDS else None
+        return EncodedEmbeddings(self.kind, self.column("embeddings"), scales)
+
+    @property
+    def embeddings(self) -> np.ndarray:
+        """(顔数, dim) の埋め込み。float32/float16 は memmap、float16n/int8n は復元した float32 (コピー)。"""
+        if self.kind in NORMALIZED_KINDS:
+            return self.encoded().decode()
+        return self.column("embeddings")
+
+    @property
+    def paths(self) -> List[str]:
+        if self._paths is None:
+            p = os.path.join(self.root, "paths.jsonl")
+            n = self.meta["n_images"]
+            paths: List[str] = []
+            if os.path.exists(p):
+                # 書き込み中の行 (確定件数より後ろ) は読まない
+                with open(p, "r", encoding="utf-8") as f:
+                    for line in f:
+                        if len(paths) >= n:
+                            break
+                        paths.append(json.loads(line))
+            self._paths = paths
+        return self._paths
+
+    @property
+    def errors(self) -> Dict[int, str]:
+        if self._errors is None:
+            self._errors = {}
+            p = os.path.join(self.root, "errors.jsonl")
+            if os.path.exists(p):
+                with open(p, "r", encoding="utf-8") as f:
+                    for e in self._committed_lines(f):
+                        self._errors[e["index"]] = e["error"]
+        return self._errors
+
+    @property
+    def duplicates(self) -> Dict[int, Dict[str, Any]]:
+        """重複画像として結果を流用した画像番号 -> ImageAnalysis.duplicate。"""
+        if self._dups is None:
+            self._dups = {}
+            p = os.path.join(self.root, "duplicates.jsonl")
+            if os.path.exists(p):
+                with open(p, "r", encoding="utf-8") as f:
+                    for e in self._committed_lines(f):
+                        self._dups[e["index"]] = e["duplicate"]
+        return self._dups
+
+    def _committed_lines(self, f: TextIO) -> Iterator[Dict[str, Any]]:
+        """確定済みの画像番号を指す行だけを返す (読み取り専用で開いた場合の書き込み途中の行を除く)。"""
+        for line in f:
+            if not line.endswith("\n"):
+                break
+            e = json.loads(line)
+            if e["index"] < self.meta["n_images"]:
+                yield e
+
+    def image_faces(self, i: int) -> List[List[int]]:
+        """画像 i の顔枠を列から返す (paths.jsonl は読まない)。"""
+        start = int(self.column("image_face_start")[i])
+        n = int(self.column("image_face_count")[i])
+        return self.column("face_boxes")[start:start + n].tolist()
+
+    def image_embeddings(self, i: int) -> np.ndarray:
+        start = int(self.column("image_face_start")[i])
+        n = int(self.column("image_face_count")[i])
+        enc = self.encoded()
+        if enc.scales is None:
+            return enc.codes[start:start + n]
+        return EncodedEmbeddings(self.kind, enc.codes[start:start + n], enc.scales[start:start + n]).decode()
+
+    def record(self, i: int) -> Dict[str, Any]:
+        """画像 i を ImageAnalysis.to_dict() と同じ形の dict で返す (失敗時は path/error)。"""
+        path = self.paths[i]
+        code = int(self.column("image_label")[i])
+        if code == ERROR_CODE:
+            return {"path": path, "error": self.errors.get(i)}
+        faces = self.image_faces(i)
+        n = len(faces)
+        dist = float(self.column("image_distance")[i])
+        distance = None if math.isnan(dist) else dist
+        detail: Dict[str, float] = {}
+        if distance is not None:
+            detail["distance"] = distance
+            if n > 2:
+                detail["faces_count"] = n
+                detail["min_pair_distance"] = distance
+        d: Dict[str, Any] = {
+            "path": path,
+            "faces": faces,
+            "embeddings_count": n,
+            "classification": {"label": LABELS[code], "distance": distance, "detail": detail},
+        }
+        dup = self.duplicates.get(i)
+        if dup is not None:
+            d["duplicate"] = dup
+        return d
+
+    def iter_records(self, start: int = 0, stop: Optional[int] = None, include_errors: bool = True) -> Iterator[Dict[str, Any]]:
+        """レコードを1件ずつ生成する (全件をメモリに載せない)。"""
+        self.flush()
+        stop = self.n_images if stop is None else min(stop, self.n_images)
+        labels = self.column("image_label")
+        for i in range(start, stop):
+            if not include_errors and labels[i] == ERROR_CODE:
+                continue
+            yield self.record(i)
+
+
+# --- JSON/CSV ビュー ---
+
+def write_json_array(records: Iterator[Dict[str, Any]], f: TextIO, indent: Optional[int] = None, level: int = 0):
+    """json.dump(list(records), f, indent=indent) と同じ出力を逐次書き出す。
+
+    level はオブジェクト内に埋め込む場合のネスト段数 (indent 指定時のみ意味を持つ)。
+    """
+    first = True
+    pad = " " * (indent or 0) * (level + 1)
+    for r in records:
+        text = json.dumps(r, ensure_ascii=False, indent=indent)
+        if indent:
+            text = "\n".join(pad + line for line in text.split("\n"))
+            f.write(("[\n" if first else ",\n") + text)
+        else:
+            f.write(("[" if first else ", ") + text)
+        first = False
+    if first:
+        f.write("[]")
+    elif indent:
+        f.write("\n" + " " * indent * level + "]")
+    else:
+        f.write("]")
+
+
+def write_results_json(records: Iterator[Dict[str, Any]], summary: Dict[str, Any], f: TextIO):
+    """Web の results.json ({"results": [...], "summary": {...}}, indent=2) を逐次書き出す。"""
+    f.write('{\n  "results": ')
+    write_json_array(records, f, indent=2, level=1)
+    summary_text = json.dumps(summary, ensure_ascii=False, indent=2).replace("\n", "\n  ")
+    f.write(',\n  "summary": ' + summary_text + "\n}")
+
+
+def summarize(store: EmbeddingStore) -> Dict[str, Any]:
+    """ラベル件数と距離の平均/中央値を列データから集計する (失敗画像は除く)。"""
+    store.flush()
+    labels = np.asarray(store.column("image_label"))
+    ok = labels != ERROR_CODE
+    counts = np.bincount(labels[ok], minlength=len(LABELS))
+    summary: Dict[str, Any] = {
+        "counts": {LABELS[i]: int(c) for i, c in enumerate(counts) if c},
+        "total": int(ok.sum()),
+    }
+    dists = np.asarray(store.column("image_distance"))[ok]
+    dists = dists[~np.isnan(dists)]
+    if dists.size:
+        summary["mean_distance"] = round(float(dists.mean()), 3)
+        summary["median_distance"] = round(float(np.median(dists)), 3)
+    if store.duplicates:
+        summary["duplicates"] = len(store.duplicates)
+    return summary
+
+
+SORT_KEYS = ("index", "label", "distance")
+
+
+def sorted_indices(store: EmbeddingStore, by: str = "index", descending: bool = False) -> np.ndarray:
+    """失敗画像を除いた画像番号を並べ替えて返す (レコードは読まず、ラベル/距離の列だけを使う)。
+
+    label はラベル順 (twins → no_face) で同じラベル内は距離の昇順。距離の無い画像は常に末尾。
+    """
+    if by not in SORT_KEYS:
+        raise ValueError(f"並べ替えのキーは {', '.join(SORT_KEYS)} のいずれか: {by}")
+    store.flush()
+    labels = np.asarray(store.column("image_label"))
+    idx = np.flatnonzero(labels != ERROR_CODE)
+    if by == "index":
+        return idx[::-1] if descending else idx
+    dist = np.asarray(store.column("image_distance"))[idx]
+    missing = np.isnan(dist)
+    dist = np.where(missing, 0.0, -dist if descending and by == "distance" else dist)
+    if by == "distance":
+        order = np.lexsort((idx, dist, missing))
+    else:
+        code = labels[idx].astype(np.int64)
+        order = np.lexsort((idx, dist, missing, -code if descending else code))
+    return idx[order]
+
+
+def write_csv(records: Iterator[Dict[str, Any]], f: TextIO, label_fn: Callable[[str], str] = lambda x: x):
+    """file,label,distance,faces,abs_path の CSV を書き出す。"""
+    writer = csv.writer(f)
+    writer.writerow(["file", "label", "distance", "faces", "abs_path"])
+    for r in records:
+        if "error" in r:
+            continue
+        label = label_fn(r.get("classification", {}).get("label"))
+        dist = r.get("classification", {}).get("distance")
+        faces_cnt = len(r.get("faces", []))
+        writer.writerow([
+            os.path.basename(r.get("path", "")),
+            label,
+            ("" if dist is None else round(dist, 3)),
+            faces_cnt,
+            r.get("path", ""),
+        ])
@@ -0,0 +1,181 @@
+"""サムネイル生成
+解析とは別のスレッドプールで、顔枠を重ねたサムネイル JPEG を作る。
+- JPEG は Pillow の draft() で DCT 段階の縮小デコードを使う (原寸デコードを避ける)
+- 画像内容の SHA-256 + 顔枠 + サイズをキーにキャッシュし、同じ画像は再生成しない
+- 出力先ごとに生成中の Future を持ち、未生成の URL へのアクセスは完了を待つか
+  その場で生成する (遅延生成)
+- キャッシュは sweep で最終利用 (mtime) から max_age 秒を過ぎたもの、max_bytes を超えた分を古い順に消す
+"""
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from .stats import StageStats
+
+THUMB_SIZE = (320, 320)
+THUMB_QUALITY = 85
+
+Box = Sequence[int]   # (top, right, bottom, left)
+Source = Union[str, bytes]   # 元画像のパス、またはエンコード済み画像のバイト列
+
+
+def render_thumbnail(src: Source, faces: Optional[Sequence[Box]] = None, size: Tuple[int, int] = THUMB_SIZE) -> bytes:
+    """顔枠付きサムネイルの JPEG バイト列を返す。faces は原寸座標。"""
+    from PIL import Image, ImageDraw
+    with Image.open(io.BytesIO(src) if isinstance(src, bytes) else src) as im:
+        full_w, full_h = im.size
+        # JPEG は 1/2, 1/4, 1/8 の縮小デコードで済ませる (size 以上の解像度は保つ)
+        im.draft("RGB", size)
+        im = im.convert("RGB")
+        im.thumbnail(size)
+        if faces:
+            sx, sy = im.width / float(full_w), im.height / float(full_h)
+            draw = ImageDraw.Draw(im)
+            for (t, r, b, l) in faces:
+                # Pillowは (left, top, right, bottom)
+                draw.rectangle([(l * sx, t * sy), (r * sx, b * sy)], outline=(255, 0, 0), width=2)
+        buf = io.BytesIO()
+        im.save(buf, format="JPEG", quality=THUMB_QUALITY)
+        return buf.getvalue()
+
+
+def thumb_key(src: Source, faces: Optional[Sequence[Box]], size: Tuple[int, int]) -> str:
+    h = hashlib.sha256()
+    if isinstance(src, bytes):
+        h.update(src)
+    else:
+        with open(src, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+    h.update(json.dumps({"faces": [list(x) for x in faces or []], "size": list(size)}).encode())
+    return h.hexdigest()
+
+
+class ThumbnailCache:
+    """内容ハッシュで共有するサムネイルキャッシュと、生成用スレッドプール。"""
+
+    def __init__(self, root: str, workers: int = 2, size: Tuple[int, int] = THUMB_SIZE,
+                 max_bytes: Optional[int] = None):
+        self.root = root
+        self.size = size
+        self.max_bytes = max_bytes   # sweep で保つ合計サイズの上限 (None で無制限)
+        os.makedirs(root, exist_ok=True)
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="twins-thumb")
+        self._pending: Dict[str, Future] = {}   # 出力先パス -> 生成中の Future
+        self._lock = threading.Lock()
+        self.stats = StageStats()   # "thumbnail" 段階 (実際に描画した分のみ)
+        self._stats_lock = threading.Lock()
+
+    def _cache_path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key + ".jpg")
+
+    def ensure(self, src_path: Source, dst_path: str, faces: Optional[Sequence[Box]] = None) -> str:
+        """dst_path にサムネイルを用意する (キャッシュにあればリンク/コピーのみ)。"""
+        if os.path.exists(dst_path):
+            return dst_path
+        cached = self._cache_path(thumb_key(src_path, faces, self.size))
+        try:
+            os.utime(cached)   # 最終利用時刻 (sweep の基準) を更新
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(cached), exist_ok=True)
+            stats = StageStats()
+            with stats.stage("thumbnail"):
+                data = render_thumbnail(src_path, faces, self.size)
+            with self._stats_lock:
+                self.stats.merge(stats)
+            fd, tmp = tempfile.mkstemp(prefix=".thumb_", dir=os.path.dirname(cached))
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, cached)
+        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+        tmp = f"{dst_path}.{threading.get_ident()}.tmp"
+        try:
+            os.link(cached, tmp)
+        except OSError:
+            shutil.copyfile(cached, tmp)
+        os.replace(tmp, dst_path)
+        return dst_path
+
+    def submit(self, src_path: Source, dst_path: str, faces: Optional[Sequence[Box]] = None) -> Future:
+        """バックグラウンドで生成する。同じ出力先の生成中の Future があればそれを返す。"""
+        faces = [list(f) for f in faces] if faces else None
+        with self._lock:
+            fut = self._pending.get(dst_path)
+            if fut is not None:
+                return fut
+            fut = self._pool.submit(self.ensure, src_path, dst_path, faces)
+            self._pending[dst_path] = fut
+        fut.add_done_callback(lambda _f, p=dst_path: self._forget(p))
+        return fut
+
+    def _forget(self, dst_path: str):
+        with self._lock:
+            self._pending.pop(dst_path, None)
+
+    def pending(self, dst_path: str) -> Optional[Future]:
+        with self._lock:
+            return self._pending.get(dst_path)
+
+    def get(self, src_path: Source, dst_path: str, faces: Optional[Sequence[Box]] = None,
+            timeout: Optional[float] = 30.0) -> Optional[str]:
+        """サムネイルのパスを返す。生成中なら待ち、未着手ならその場で生成する。"""
+        if os.path.exists(dst_path):
+            return dst_path
+        fut = self.pending(dst_path)
+        try:
+            if fut is not None:
+                return fut.result(timeout)
+            return self.ensure(src_path, dst_path, faces)
+        except Exception:
+            # サムネイル生成に失敗しても致命的ではない
+            return None
+
+    def sweep(self, max_age: Optional[float] = None) -> int:
+        """最終利用から max_age 秒を過ぎたサムネイルと、max_bytes を超えた分を古い順に消し、消した数を返す。
+
+        バッチ側の thumbs/ はハードリンクかコピーなので、ここで消しても表示中のバッチには影響しない。
+        """
+        entries: List[Tuple[float, int, str]] = []
+        for dirpath, _, names in os.walk(self.root):
+            for name in names:
+                p = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(p)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, p))
+        entries.sort()
+        cutoff = time.time() - max_age if max_age is not None else None
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for mtime, size, p in entries:
+            expired = cutoff is not None and mtime < cutoff
+            if not expired and (self.max_bytes is None or total <= self.max_bytes):
+                break
+            if not expired and os.path.basename(p).startswith(".thumb_"):
+                continue   # 書き込み中
+            try:
+                os.unlink(p)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        return removed
+
+    def snapshot_stats(self) -> StageStats:
+        with self._stats_lock:
+            copy = StageStats()
+            copy.merge(self.stats)
+            return copy
+
+    def shutdown(self, wait: bool = True):
+        self._pool.shutdown(wait=wait)
+
@@ -0,0 +1,180 @@
+"""アップロードの取り込み (Web)
+multipart 本文をリクエストのストリームから少しずつ読み、画像をメモリ上のバイト列として受け取る。
+解析・サムネイル生成はこのバイト列から直接行い、アップロード画像を一時ファイルに書かない。
+ディスクへ書くのは次の場合のみ (書き先はバッチディレクトリ内の最終的な場所):
+- 利用者が元画像の保存 (結果ページからのリンク) を選んだ画像
+- 1ファイルが spill_bytes を超えた、またはバッチ全体のメモリ上限 memory_bytes を超えた画像
+werkzeug の通常の form 解析 (500KB を超えると一時ファイルへ退避) は使わない。
+"""
+from dataclasses import dataclass
+from typing import BinaryIO, Dict, Iterator, List, Optional, Set, Tuple
+import os
+
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
+
+CHUNK_SIZE = 64 * 1024
+MAX_FIELD_BYTES = 64 * 1024      # 画像以外のフォーム項目の上限
+RESERVED_NAMES = {"thumbs", "store", "summary.json", "results.json", "results.csv"}
+
+
+class UploadError(Exception):
+    """アップロードを受け付けられない (不正な形式など)。"""
+
+
+class UploadTooLarge(UploadError):
+    """1ファイルの上限を超えた。"""
+
+
+@dataclass
+class Upload:
+    name: str               # バッチ内のファイル名
+    path: str               # バッチディレクトリ内のパス (結果の path。保存しない場合はファイルは無い)
+    data: Optional[bytes]   # メモリ上の内容 (ディスクへ退避した場合は None)
+    size: int
+    stored: bool            # ディスクにある (元画像として配信できる)
+
+
+class _Budget:
+    """バッチ全体でメモリに持つバイト数の上限。"""
+
+    def __init__(self, limit: int):
+        self.remaining = limit
+
+    def take(self, n: int) -> bool:
+        if n > self.remaining:
+            return False
+        self.remaining -= n
+        return True
+
+    def give(self, n: int):
+        self.remaining += n
+
+
+class _Sink:
+    """1ファイル分の受け取り先。メモリに貯め、必要になった時点でディスクへ切り替える。"""
+
+    def __init__(self, name: str, path: str, keep: bool, spill_bytes: int, budget: _Budget,
+                 max_file_bytes: Optional[int]):
+        self.name = name
+        self.path = path
+        self.spill_bytes = spill_bytes
+        self.budget = budget
+        self.max_file_bytes = max_file_bytes
+        self.size = 0
+        self.buf: Optional[bytearray] = bytearray()
+        self.file: Optional[BinaryIO] = open(path, "wb") if keep else None
+
+    def write(self, data: bytes):
+        self.size += len(data)
+        if self.max_file_bytes is not None and self.size > self.max_file_bytes:
+            raise UploadTooLarge(f"{self.name}: 1ファイルの上限 ({self.max_file_bytes // (1024 * 1024)}MB) を超えています")
+        if self.buf is not None and (len(self.buf) + len(data) > self.spill_bytes or not self.budget.take(len(data))):
+            # 大きいファイルはディスクへ退避し、以降はメモリに持たない
+            if self.file is None:
+                self.file = open(self.path, "wb")
+                self.file.write(self.buf)
+            self.budget.give(len(self.buf))
+            self.buf = None
+        if self.buf is not None:
+            self.buf += data
+        if self.file is not None:
+            self.file.write(data)
+
+    def close(self) -> Upload:
+        stored = self.file is not None
+        if self.file is not None:
+            self.file.close()
+        data = bytes(self.buf) if self.buf is not None else None
+        return Upload(self.name, self.path, data, self.size, stored)
+
+    def abort(self):
+        if self.file is not None:
+            self.file.close()
+
+
+def safe_name(filename: str, taken: Set[str]) -> Optional[str]:
+    """ディレクトリ部分を除いたファイル名 (重複・予約名には連番を付ける)。使えない名前なら None。"""
+    name = os.path.basename(filename.replace("\\", "/")).strip()
+    if not name or name in (".", "..") or name.startswith("."):
+        return None
+    stem, ext = os.path.splitext(name)
+    candidate, n = name, 1
+    while candidate in taken or candidate in RESERVED_NAMES:
+        candidate = f"{stem}_{n}{ext}"
+        n += 1
+    taken.add(candidate)
+    return candidate
+
+
+def _chunks(stream: BinaryIO, size: int) -> Iterator[Optional[bytes]]:
+    while True:
+        data = stream.read(size)
+        if not data:
+            break
+        yield data
+    yield None   # 終端
+
+
+def ingest_multipart(stream: BinaryIO, boundary: bytes, root: str, field: str = "files",
+                     keep_field: str = "keep_originals", keep_default: bool = False,
+                     spill_bytes: int = 16 * 1024 * 1024, memory_bytes: int = 256 * 1024 * 1024,
+                     max_file_bytes: Optional[int] = None) -> Tuple[List[Upload], Dict[str, str]]:
+    """multipart 本文を読み、field のファイルを Upload の列として返す (その他の項目は dict)。
+
+    keep_field の項目が真 ("1"/"on"/"true") ならそれ以降のファイルはディスクにも保存する
+    (ブラウザはフォームの並び順に送るので、ファイルより前に置く)。
+    """
+    # デコーダの内部バッファ (未処理の受信データ) の上限。ヘッダが異常に長い本文を弾く
+    decoder = MultipartDecoder(boundary, max_form_memory_size=CHUNK_SIZE + MAX_FIELD_BYTES)
+    budget = _Budget(memory_bytes)
+    uploads: List[Upload] = []
+    fields: Dict[str, str] = {}
+    taken: Set[str] = set()
+    keep = keep_default
+    sink: Optional[_Sink] = None
+    field_name: Optional[str] = None
+    field_buf = bytearray()
+    try:
+        for chunk in _chunks(stream, CHUNK_SIZE):
+            decoder.receive_data(chunk)
+            event = decoder.next_event()
+            while not isinstance(event, (Epilogue, NeedData)):
+                if isinstance(event, File):
+                    name = safe_name(event.filename or "", taken) if event.name == field else None
+                    sink = _Sink(name, os.path.join(root, name), keep, spill_bytes, budget, max_file_bytes) if name else None
+                    field_name = None
+                elif isinstance(event, Field):
+                    field_name, field_buf = event.name, bytearray()
+                    sink = None
+                elif isinstance(event, Data):
+                    if sink is not None:
+                        sink.write(event.data)
+                        if not event.more_data:
+                            uploads.append(sink.close())
+                            sink = None
+                    elif field_name is not None:
+                        field_buf += event.data
+                        if len(field_buf) > MAX_FIELD_BYTES:
+                            raise UploadError(f"フォーム項目 {field_name} が大きすぎます")
+                        if not event.more_data:
+                            fields[field_name] = field_buf.decode("utf-8", "replace")
+                            if field_name == keep_field:
+                                keep = fields[field_name].strip().lower() in ("1", "on", "true", "yes")
+                            field_name = None
+                event = decoder.next_event()
+        if sink is not None:
+            raise UploadError(f"{sink.name}: アップロードが途中で終わりました")
+    except RequestEntityTooLarge as e:
+        if sink is not None:
+            sink.abort()
+        raise UploadError("multipart のヘッダが大きすぎます") from e
+    except ValueError as e:
+        if sink is not None:
+            sink.abort()
+        raise UploadError(f"multipart の形式が不正です: {e}") from e
+    except BaseException:
+        if sink is not None:
+            sink.abort()
+        raise
+    return uploads, fields
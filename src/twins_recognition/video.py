@@ -0,0 +1,248 @@
+"""動画/フレームストリームの解析
+OpenCV (cv2.VideoCapture) でフレームを逐次デコードし、顔をフレーム間で追跡する。
+- stride フレームごとに1枚だけ取り出す (間のフレームは grab のみでデコードしない)
+- 縮小グレースケールの差分による動きゲート: 変化の無いフレームは検出を省略、
+  大きく変わったフレーム (シーン切り替え) では追跡中のトラックをすべて閉じる
+- 顔位置の IoU で前フレームのトラックへ対応付け、埋め込みはトラック開始時に1回だけ求める
+- トラックは閉じた時点で、同時に映っていた他トラックのうち最も近いものと
+  classify_embeddings で分類する (同時に映る2人は別人なので双子/兄弟の判定になる)
+入力は動画ファイル、カメラ番号 ("0" など)、RTSP/HTTP の URL のいずれでもよい。
+"""
+from dataclasses import asdict, dataclass, field
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from .classifier import TwinClassificationResult, classify_embeddings, pairwise_distances
+from .detector import FaceLocation, iou
+from .embedding import face_embeddings
+from .processor import AnalyzeOptions
+
+# 顔位置のリストから (n, 128) の埋め込みを求める関数
+EmbedFn = Callable[[List[FaceLocation]], np.ndarray]
+
+_GATE_SIZE = 64   # 動きゲートで比較する縮小画像の一辺
+
+
+@dataclass(frozen=True)
+class VideoOptions:
+    stride: int = 5                      # 何フレームごとに解析するか
+    motion_threshold: float = 0.01       # 平均輝度差 (0〜1) がこれ未満なら検出を省略
+    scene_threshold: float = 0.25        # これ以上ならシーン切り替えとしてトラックを閉じる
+    keyframe_interval: int = 10          # 変化が無くても解析フレームこの数ごとに検出する
+    iou_threshold: float = 0.3           # トラックへ対応付ける IoU の下限
+    max_age: int = 3                     # 検出で見失ってから閉じるまでの解析フレーム数
+
+
+@dataclass
+class FaceTrack:
+    track_id: int
+    first_frame: int
+    last_frame: int
+    first_time: float
+    last_time: float
+    box: FaceLocation
+    hits: int = 1
+    misses: int = 0
+    embedding: Optional[np.ndarray] = field(default=None, repr=False, compare=False)
+    classification: Optional[TwinClassificationResult] = None
+    nearest_track: Optional[int] = None
+
+    def overlaps(self, other: "FaceTrack") -> bool:
+        return self.first_frame <= other.last_frame and other.first_frame <= self.last_frame
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "track_id": self.track_id,
+            "first_frame": self.first_frame,
+            "last_frame": self.last_frame,
+            "first_time": round(self.first_time, 3),
+            "last_time": round(self.last_time, 3),
+            "hits": self.hits,
+            "box": list(self.box),
+            "nearest_track": self.nearest_track,
+            "classification": asdict(self.classification) if self.classification is not None else None,
+        }
+
+
+@dataclass
+class VideoStats:
+    frames_read: int = 0        # grab したフレーム数
+    frames_decoded: int = 0     # stride で取り出してデコードしたフレーム数
+    frames_gated: int = 0       # 動きゲートで検出を省略したフレーム数
+    frames_detected: int = 0
+    scene_cuts: int = 0
+    faces_detected: int = 0
+    tracks: int = 0             # = エンコードした顔の数 (トラックにつき1回)
+
+    def to_dict(self) -> Dict[str, int]:
+        return asdict(self)
+
+
+class MotionGate:
+    """直前に検出したフレームとの差分で、検出が必要かどうかを安価に判定する。"""
+
+    def __init__(self, motion_threshold: float, scene_threshold: float, keyframe_interval: int):
+        self.motion_threshold = motion_threshold
+        self.scene_threshold = scene_threshold
+        self.keyframe_interval = max(1, keyframe_interval)
+        self._ref: Optional[np.ndarray] = None
+        self._since = 0
+
+    def check(self, rgb: np.ndarray) -> Tuple[bool, bool]:
+        """(検出するか, シーン切り替えか) を返す。"""
+        import cv2
+        small = cv2.resize(cv2.cvtColor(rgb, cv2.COLOR_RGB2GRAY), (_GATE_SIZE, _GATE_SIZE), interpolation=cv2.INTER_AREA)
+        small = small.astype(np.float32) / 255.0
+        if self._ref is None:
+            self._ref, self._since = small, 0
+            return True, False
+        diff = float(np.abs(small - self._ref).mean())
+        self._since += 1
+        if diff < self.motion_threshold and self._since < self.keyframe_interval:
+            return False, False
+        self._ref, self._since = small, 0
+        return True, diff >= self.scene_threshold
+
+
+class FaceTracker:
+    """IoU の貪欲対応付けによる顔トラッカー。閉じたトラックには分類を付けて返す。"""
+
+    def __init__(self, iou_threshold: float = 0.3, max_age: int = 3,
+                 classify: Callable[..., TwinClassificationResult] = classify_embeddings):
+        self.iou_threshold = iou_threshold
+        self.classify = classify   # 埋め込み列 -> 分類 (閾値を変えるなら AnalyzeOptions.classify)
+        self.max_age = max_age
+        self.active: List[FaceTrack] = []
+        self._closed: List[FaceTrack] = []   # 追跡中トラックと時間が重なり得る閉じたトラック
+        self._next_id = 0
+
+    def update(self, frame: int, t: float, boxes: List[FaceLocation], embed: EmbedFn) -> List[FaceTrack]:
+        """検出結果でトラックを更新し、このフレームで閉じたトラックを返す。"""
+        pairs = sorted(((iou(tr.box, b), ti, bi) for ti, tr in enumerate(self.active) for bi, b in enumerate(boxes)),
+                       reverse=True)
+        used_t, used_b = set(), set()
+        for score, ti, bi in pairs:
+            if score < self.iou_threshold:
+                break
+            if ti in used_t or bi in used_b:
+                continue
+            used_t.add(ti)
+            used_b.add(bi)
+            tr = self.active[ti]
+            tr.box, tr.last_frame, tr.last_time = boxes[bi], frame, t
+            tr.hits += 1
+            tr.misses = 0
+        for ti, tr in enumerate(self.active):
+            if ti not in used_t:
+                tr.misses += 1
+        # 新しい顔だけをまとめてエンコード (トラックにつき1回)
+        new_boxes = [b for bi, b in enumerate(boxes) if bi not in used_b]
+        if new_boxes:
+            emb = embed(new_boxes)
+            for b, e in zip(new_boxes, emb):
+                self.active.append(FaceTrack(track_id=self._next_id, first_frame=frame, last_frame=frame,
+                                             first_time=t, last_time=t, box=b, embedding=e))
+                self._next_id += 1
+        expired = [tr for tr in self.active if tr.misses > self.max_age]
+        return self._close(expired)
+
+    def close_all(self) -> List[FaceTrack]:
+        return self._close(list(self.active))
+
+    def _close(self, tracks: List[FaceTrack]) -> List[FaceTrack]:
+        if not tracks:
+            return []
+        ids = set(id(tr) for tr in tracks)
+        self.active = [tr for tr in self.active if id(tr) not in ids]
+        self._closed.extend(tracks)
+        for tr in tracks:
+            self._classify(tr)
+        # 追跡中のどのトラックより前に終わったものは、もう誰とも重ならない
+        if self.active:
+            start = min(tr.first_frame for tr in self.active)
+            self._closed = [tr for tr in self._closed if tr.last_frame >= start]
+        else:
+            self._closed = []
+        return sorted(tracks, key=lambda tr: tr.track_id)
+
+    def _classify(self, track: FaceTrack):
+        partners = [tr for tr in self.active + self._closed
+                    if tr is not track and tr.embedding is not None and tr.overlaps(track)]
+        if not partners or track.embedding is None:
+            track.classification = self.classify([] if track.embedding is None else [track.embedding])
+            return
+        d = pairwise_distances(np.stack([track.embedding] + [p.embedding for p in partners]))[0, 1:]
+        nearest = partners[int(np.argmin(d))]
+        track.nearest_track = nearest.track_id
+        track.classification = self.classify(np.stack([track.embedding, nearest.embedding]))
+
+
+def open_capture(source: str):
+    import cv2
+    cap = cv2.VideoCapture(int(source) if source.isdigit() else source)
+    if not cap.isOpened():
+        raise FileNotFoundError(f"動画を開けません: {source}")
+    return cap
+
+
+def iter_frames(source: str, stride: int = 1, stats: Optional[VideoStats] = None) -> Iterator[Tuple[int, float, np.ndarray]]:
+    """(フレーム番号, 秒, RGB 配列) を stride フレームごとに返す。
+
+    間のフレームは grab だけで読み飛ばす (デコード・色変換をしない)。
+    """
+    import cv2
+    stats = stats if stats is not None else VideoStats()
+    stride = max(1, stride)
+    cap = open_capture(source)
+    try:
+        fps = cap.get(cv2.CAP_PROP_FPS) or 0.0
+        index = -1
+        while True:
+            if not cap.grab():
+                return
+            index += 1
+            stats.frames_read += 1
+            if index % stride:
+                continue
+            ok, bgr = cap.retrieve()
+            if not ok:
+                return
+            stats.frames_decoded += 1
+            pos = cap.get(cv2.CAP_PROP_POS_MSEC)
+            t = pos / 1000.0 if pos > 0 else (index / fps if fps > 0 else 0.0)
+            yield index, t, cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+    finally:
+        cap.release()
+
+
+def track_video(source: str, options: Optional[VideoOptions] = None, analyze: Optional[AnalyzeOptions] = None,
+                stats: Optional[VideoStats] = None) -> Iterator[FaceTrack]:
+    """動画の顔トラックを閉じた順に返す (分類付き)。最後に残りのトラックも返す。"""
+    options = options or VideoOptions()
+    analyze = analyze or AnalyzeOptions()
+    stats = stats if stats is not None else VideoStats()
+    gate = MotionGate(options.motion_threshold, options.scene_threshold, options.keyframe_interval)
+    tracker = FaceTracker(options.iou_threshold, options.max_age, analyze.classify)
+
+    for index, t, rgb in iter_frames(source, options.stride, stats):
+        detect, cut = gate.check(rgb)
+        if cut:
+            stats.scene_cuts += 1
+            yield from tracker.close_all()
+        if not detect:
+            # 変化が無いので前回の顔位置をそのまま延長する
+            stats.frames_gated += 1
+            for tr in tracker.active:
+                tr.last_frame, tr.last_time = index, t
+            continue
+        stats.frames_detected += 1
+        boxes = analyze.detect(rgb)
+        stats.faces_detected += len(boxes)
+
+        def embed(new_boxes: List[FaceLocation]) -> np.ndarray:
+            stats.tracks += len(new_boxes)
+            return face_embeddings(rgb, new_boxes, crop=analyze.crop_faces(rgb))
+
+        yield from tracker.update(index, t, boxes, embed)
+    yield from tracker.close_all()
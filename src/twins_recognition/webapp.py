@@ -1,21 +1,67 @@
 from __future__ import annotations
-from flask import Flask, request, render_template, send_from_directory, Response, redirect, url_for, stream_with_context
+from flask import Flask, request, render_template, render_template_string, send_from_directory, Response, redirect, url_for, stream_with_context
 import os
 import tempfile
 import shutil
+import sys
 import io
 import json
+import threading
 from datetime import datetime, timedelta
-from typing import List, Dict, Any
-from .processor import analyze_image
-import csv
+from typing import List, Dict, Any, Optional
+from .classifier import runtime_thresholds, thresholds_for
+from .jobs import Job, JobQueueFull, get_manager
+from .processor import AnalyzeOptions, ImageAnalysis
+from .stats import RunningSummary
+from .store import SORT_KEYS, EmbeddingStore, sorted_indices, summarize, write_csv, write_results_json
+from .thumbs import ThumbnailCache, render_thumbnail
+from .uploads import Upload, UploadError, UploadTooLarge, ingest_multipart
 
 app = Flask(__name__)
 
 UPLOAD_ROOT = os.path.join(tempfile.gettempdir(), "twins_uploads")
 THUMB_DIRNAME = "thumbs"
+STORE_DIRNAME = "store"
+SUMMARY_NAME = "summary.json"          # 完了時に書くサマリー (完了済みバッチの目印も兼ねる)
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+THUMB_CACHE_DIRNAME = "_thumbcache"   # バッチ横断の内容ハッシュキャッシュ
+
+
+
+def _env_mb(name: str, default: int) -> int:
+    try:
+        return max(1, int(os.environ.get(name, default)))
+    except ValueError:
+        return default
+
+
+# アップロードの上限と、メモリに持つ量 (超えた分だけバッチディレクトリへ書く)
+MAX_UPLOAD_MB = _env_mb("TWINS_MAX_UPLOAD_MB", 2048)       # 1リクエストの本文
+MAX_FILE_MB = _env_mb("TWINS_MAX_FILE_MB", 64)             # 1ファイル
+SPILL_MB = _env_mb("TWINS_SPILL_MB", 16)                   # これを超えるファイルはディスクへ
+UPLOAD_MEMORY_MB = _env_mb("TWINS_UPLOAD_MEMORY_MB", 256)  # 1バッチでメモリに持つ合計
+THUMB_CACHE_MB = _env_mb("TWINS_THUMB_CACHE_MB", 256)      # バッチ横断のサムネイルキャッシュ
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_MB * 1024 * 1024
+# TWINS_DEDUP=1: 同じ/ほぼ同じ画像 (再エンコード・縮小) は解析済みの結果を流用する
+# TWINS_METRIC=cosine: 正規化した埋め込みのコサイン距離で分類する
+_DEDUP = os.environ.get("TWINS_DEDUP", "") not in ("", "0")
+_METRIC = os.environ.get("TWINS_METRIC", "euclidean")
+
+
+def _web_thresholds(metric: str) -> Dict[str, float]:
+    # 閾値の設定ファイル (TWINS_THRESHOLDS / 既定の場所) は Web の起動時に1回だけ読む
+    try:
+        return runtime_thresholds(metric)
+    except (OSError, ValueError) as e:
+        print(f"閾値設定を読み込めないため既定値を使います: {e}", file=sys.stderr)
+        return dict(thresholds_for(metric))
+
+
+ANALYZE_OPTIONS = AnalyzeOptions(dedup=_DEDUP, metric=_METRIC, thresholds=_web_thresholds(_METRIC))
 
 os.makedirs(UPLOAD_ROOT, exist_ok=True)
+thumb_cache = ThumbnailCache(os.path.join(UPLOAD_ROOT, THUMB_CACHE_DIRNAME), max_bytes=THUMB_CACHE_MB * 1024 * 1024)
 
 
 # 日本語表示用ラベルフィルタ（siblings を 兄弟/姉妹/兄妹/姉弟 として表示）
@@ -36,100 +82,181 @@ def ensure_dir(path: str):
     os.makedirs(path, exist_ok=True)
 
 
+def display_record(d: Dict[str, Any], batch: str, index: int) -> Dict[str, Any]:
+    """ストアのレコードに表示用の項目 (日本語ラベル/サムネイルURL/元画像URL) を付ける。
+
+    サムネイルURLには画像番号を付け、未生成のサムネイルの顔枠をストアの列から直接引けるようにする。
+    元画像を保存していない画像のリンク先はサムネイルにする。
+    """
+    root = os.path.join(UPLOAD_ROOT, batch)
+    name = os.path.basename(d["path"])
+    d["classification"]["label_ja"] = ja_label(d["classification"]["label"])
+    d["thumb_url"] = f"/static_tmp/{batch}/{THUMB_DIRNAME}/{name}.thumb.jpg?i={index}"
+    d["relpath"] = f"/static_tmp/{batch}/{name}" if os.path.isfile(os.path.join(root, name)) else d["thumb_url"]
+    return d
+
+
+def batch_records(store: EmbeddingStore, batch: str):
+    for i in sorted_indices(store):
+        yield display_record(store.record(int(i)), batch, int(i))
+
+
+def open_store(root: str) -> Optional[EmbeddingStore]:
+    """バッチのストアを読み取り専用で開く (無ければ None)。
+
+    ジョブの書き込み中でも途中書き込みの切り捨てや meta.json の書き換えはせず、確定済みの件数だけを読む。
+    """
+    path = os.path.join(root, STORE_DIRNAME)
+    if not os.path.exists(os.path.join(path, "meta.json")):
+        return None
+    return EmbeddingStore(path, readonly=True)
+
+
+def load_summary(root: str, store: Optional[EmbeddingStore] = None) -> Optional[Dict[str, Any]]:
+    """完了時に保存したサマリーを読む。無い (旧形式のバッチ) ならストアの列から集計する。"""
+    try:
+        with open(os.path.join(root, SUMMARY_NAME), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        pass
+    return summarize(store) if store is not None else None
+
+
+def write_summary(root: str, summary: Dict[str, Any]):
+    tmp = os.path.join(root, f".{SUMMARY_NAME}.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(summary, f, ensure_ascii=False)
+    os.replace(tmp, os.path.join(root, SUMMARY_NAME))
+
+
+def ensure_exports(root: str, batch: str) -> bool:
+    """results.json / results.csv (CSV のラベルは日本語) を、初回のダウンロード時にストアから生成する。"""
+    if os.path.exists(os.path.join(root, "results.json")) and os.path.exists(os.path.join(root, "results.csv")):
+        return True
+    store = open_store(root)
+    if store is None:
+        return False
+    summary = load_summary(root, store)
+    for name, write in (("results.json", lambda f: write_results_json(batch_records(store, batch), summary, f)),
+                        ("results.csv", lambda f: write_csv(store.iter_records(include_errors=False), f, label_fn=ja_label))):
+        tmp = os.path.join(root, f".{name}.tmp")
+        with open(tmp, "w", encoding="utf-8", newline="") as f:
+            write(f)
+        os.replace(tmp, os.path.join(root, name))
+    return True
+
+
 def make_thumb(src_path: str, dst_path: str, faces: List[List[int]] | None = None, size=(320, 320)):
     try:
-        from PIL import Image
-        from PIL import ImageDraw
-        with Image.open(src_path) as im:
-            im.thumbnail(size)
-            # 顔枠を描画 (faces は [top, right, bottom, left])
-            if faces:
-                draw = ImageDraw.Draw(im)
-                for (t, r, b, l) in faces:
-                    # Pillowは (left, top, right, bottom)
-                    draw.rectangle([(l, t), (r, b)], outline=(255, 0, 0), width=2)
-            im.save(dst_path)
+        data = render_thumbnail(src_path, faces, size)
+        with open(dst_path, "wb") as f:
+            f.write(data)
     except Exception:
         # サムネイル生成に失敗しても致命的ではない
         pass
 
 
+def thumb_path(root: str, name: str) -> str:
+    return os.path.join(root, THUMB_DIRNAME, f"{name}.thumb.jpg")
+
+
 @app.route("/")
 def index():
     cleanup_old_batches(hours=24)
     return render_template("index.html")
 
 
+def receive_uploads(tmpdir: str) -> List[Upload]:
+    """リクエスト本文を逐次読み、画像をメモリ (大きいもの・保存指定のものはバッチディレクトリ) に受け取る。"""
+    boundary = request.mimetype_params.get("boundary")
+    if request.mimetype != "multipart/form-data" or not boundary:
+        raise UploadError("multipart/form-data で送信してください")
+    uploads, _ = ingest_multipart(request.stream, boundary.encode("latin-1"), tmpdir,
+                                  spill_bytes=SPILL_MB * 1024 * 1024, memory_bytes=UPLOAD_MEMORY_MB * 1024 * 1024,
+                                  max_file_bytes=MAX_FILE_MB * 1024 * 1024)
+    return uploads
+
+
+def batch_files(root: str) -> List[str]:
+    """バッチ内の処理対象ファイル名 (thumbs/ や store/、生成物は除外) を名前順で返す。"""
+    files = [f for f in os.listdir(root)
+             if os.path.isfile(os.path.join(root, f)) and not f.endswith('.json') and not f.endswith('.csv')]
+    return sorted(files)
+
+
+_job_lock = threading.Lock()
+
+
+def start_job(batch: str, uploads: Optional[List[Upload]] = None) -> Job:
+    """バッチの解析ジョブを共有キューへ登録する (既にあればそれを返す)。
+
+    解析・ストア追記・サムネイル生成はジョブのディスパッチャスレッドで行い、
+    リクエスト側は進捗イベントを購読するだけにする。満杯なら JobQueueFull。
+    uploads を渡すとメモリ上の画像はそのまま解析し、省略時はバッチディレクトリのファイルを使う。
+    """
+    manager = get_manager()
+    with _job_lock:
+        job = manager.get(batch)
+        if job is not None:
+            return job
+        root = os.path.join(UPLOAD_ROOT, batch)
+        ensure_dir(os.path.join(root, THUMB_DIRNAME))
+        if uploads is None:
+            uploads = [Upload(n, os.path.join(root, n), None, 0, True) for n in batch_files(root)]
+        names = [u.name for u in uploads]
+        total = len(names)
+        # 再起動などで途中まで書かれたストアは作り直す
+        shutil.rmtree(os.path.join(root, STORE_DIRNAME), ignore_errors=True)
+        # 結果は届いた順にストアへ追記し、サマリーも1件ずつ更新する (完了時に全件を読み直さない)
+        store = EmbeddingStore(os.path.join(root, STORE_DIRNAME), flush_every=16)
+        summary = RunningSummary()
+
+        def on_result(job: Job, i: int, a: Optional[ImageAnalysis], error: Optional[str]) -> Dict[str, Any]:
+            idx = i + 1
+            name = names[i]
+            payload: Dict[str, Any] = {"index": idx, "total": total, "pct": int(idx / max(total, 1) * 100), "filename": name}
+            if a is None:
+                # 失敗した画像は一覧から除外 (バッチ全体は継続)
+                store.append_error(job.paths[i], error or "")
+                summary.add_error()
+                payload["error"] = error
+                return payload
+            store.append(a)
+            summary.add(a.classification.label, a.classification.distance, a.duplicate is not None)
+            # サムネイルは別スレッドで作る (次の結果と進捗通知を待たせない)
+            blob = job.blobs[i] if job.blobs is not None else None
+            thumb_cache.submit(blob if blob is not None else job.paths[i], thumb_path(root, name), faces=a.faces)
+            payload["label"] = a.classification.label
+            payload["distance"] = a.classification.distance
+            return payload
+
+        def on_finish(job: Job) -> Dict[str, Any]:
+            # JSON/CSV はダウンロード時にストアから生成する
+            store.flush()
+            write_summary(root, summary.to_dict())
+            return {"url": f"/batch/{batch}"}
+
+        job = Job(batch, [u.path for u in uploads], on_result,
+                  on_finish=on_finish, on_close=lambda job: store.close(), options=ANALYZE_OPTIONS,
+                  blobs=[u.data for u in uploads])
+        try:
+            return manager.submit(job)
+        except JobQueueFull:
+            store.close()
+            raise
+
+
 @app.route("/analyze", methods=["POST"])
 def analyze():
-    # 一時ディレクトリを作成してアップロードを保管
+    # フォーム送信 (JavaScript 無効時): 保存してジョブに登録し、結果ページで完了を待つ
     tmpdir = tempfile.mkdtemp(prefix="twins_", dir=UPLOAD_ROOT)
-    thumbs = os.path.join(tmpdir, THUMB_DIRNAME)
-    ensure_dir(thumbs)
-
-    files = request.files.getlist("files")
-    results: List[Dict[str, Any]] = []
-    for f in files:
-        if not f.filename:
-            continue
-        save_path = os.path.join(tmpdir, f.filename)
-        ensure_dir(os.path.dirname(save_path))
-        f.save(save_path)
-        # 解析実行
-        a = analyze_image(save_path)
-        d = a.to_dict()
-        # 日本語ラベル付与
-        try:
-            raw = d.get("classification", {}).get("label")
-            d["classification"]["label_ja"] = ja_label(raw)
-        except Exception:
-            pass
-        # サムネイル
-        thumb_name = f"{os.path.basename(save_path)}.thumb.jpg"
-        thumb_path = os.path.join(thumbs, thumb_name)
-        make_thumb(save_path, thumb_path, faces=d.get("faces"))
-        d["thumb_url"] = f"/static_tmp/{os.path.basename(tmpdir)}/{THUMB_DIRNAME}/{thumb_name}"
-        d["relpath"] = f"/static_tmp/{os.path.basename(tmpdir)}/{os.path.basename(save_path)}"
-        results.append(d)
-
-    # サマリー
-    from collections import Counter
-    labels = [r["classification"]["label"] for r in results]
-    c = Counter(labels)
-    total = sum(c.values()) or 1
-    summary = {
-        "counts": dict(c),
-        "total": total,
-    }
-    dists = [r["classification"]["distance"] for r in results if r["classification"]["distance"] is not None]
-    if dists:
-        import statistics
-        summary["mean_distance"] = round(statistics.mean(dists), 3)
-        summary["median_distance"] = round(statistics.median(dists), 3)
-
-    # 結果JSONを保存してダウンロード可能に
-    results_json_path = os.path.join(tmpdir, "results.json")
-    with open(results_json_path, "w", encoding="utf-8") as f:
-        json.dump({"results": results, "summary": summary}, f, ensure_ascii=False, indent=2)
-
-    # CSV も保存（ラベルは日本語で出力）
-    results_csv_path = os.path.join(tmpdir, "results.csv")
-    with open(results_csv_path, "w", encoding="utf-8", newline="") as f:
-        writer = csv.writer(f)
-        writer.writerow(["file", "label", "distance", "faces", "abs_path"])
-        for r in results:
-            label = ja_label(r.get("classification", {}).get("label"))
-            dist = r.get("classification", {}).get("distance")
-            faces_cnt = len(r.get("faces", []))
-            writer.writerow([
-                os.path.basename(r.get("path", "")),
-                label,
-                ("" if dist is None else round(dist, 3)),
-                faces_cnt,
-                r.get("path", ""),
-            ])
-
-    return render_template("result.html", results=results, summary=summary, batch=os.path.basename(tmpdir))
+    batch = os.path.basename(tmpdir)
+    try:
+        start_job(batch, receive_uploads(tmpdir))
+    except (JobQueueFull, UploadError) as e:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        return Response(str(e), status=upload_error_status(e), mimetype="text/plain")
+    return redirect(url_for("view_batch", batch=batch))
 
 
 @app.route("/static_tmp/<batch>/<path:filename>")
@@ -137,19 +264,56 @@ def static_tmp(batch: str, filename: str):
     root = os.path.join(UPLOAD_ROOT, batch)
     # thumbs または元画像の配送
     if filename.startswith(THUMB_DIRNAME + "/"):
-        return send_from_directory(os.path.join(root, THUMB_DIRNAME), filename.split("/",1)[1])
+        thumb_name = filename.split("/", 1)[1]
+        lazy_thumb(root, thumb_name, request.args.get("i", type=int))
+        return send_from_directory(os.path.join(root, THUMB_DIRNAME), thumb_name)
     return send_from_directory(root, filename)
 
 
+def lazy_thumb(root: str, thumb_name: str, index: Optional[int] = None):
+    """まだ無いサムネイルは、生成中なら完了を待ち、未着手ならここで生成する。
+
+    index はストア上の画像番号 (サムネイルURLの ?i=)。分かれば顔枠を付けて生成する。
+    """
+    dst = os.path.join(root, THUMB_DIRNAME, thumb_name)
+    if os.path.exists(dst) or not thumb_name.endswith(".thumb.jpg"):
+        return
+    name = thumb_name[:-len(".thumb.jpg")]
+    src = os.path.join(root, name)
+    # 元画像を保存していない画像も、生成中ならその完了を待つ
+    if os.path.dirname(name) or (thumb_cache.pending(dst) is None and not os.path.isfile(src)):
+        return
+    faces = None
+    if thumb_cache.pending(dst) is None and index is not None:
+        # 顔枠は完了済みバッチのストアから引く
+        faces = batch_faces(root, index)
+    thumb_cache.get(src, dst, faces)
+
+
+def batch_faces(root: str, index: int) -> Optional[List[List[int]]]:
+    """バッチのストアから画像番号 index の顔枠を列だけで引く (paths.jsonl は読まない)。"""
+    try:
+        store = open_store(root)
+    except (OSError, ValueError):
+        return None
+    if store is None or not 0 <= index < store.n_images:
+        return None
+    return store.image_faces(index)
+
+
 @app.route('/download/<batch>.json')
 def download_json(batch: str):
     root = os.path.join(UPLOAD_ROOT, batch)
+    if not ensure_exports(root, batch):
+        return Response(status=404)
     return send_from_directory(root, 'results.json', as_attachment=True)
 
 
 @app.route('/download/<batch>.csv')
 def download_csv(batch: str):
     root = os.path.join(UPLOAD_ROOT, batch)
+    if not ensure_exports(root, batch):
+        return Response(status=404)
     return send_from_directory(root, 'results.csv', as_attachment=True, mimetype='text/csv')
 
 
@@ -170,9 +334,16 @@ def favicon():
 
 
 def cleanup_old_batches(hours: int = 24):
+    try:
+        # サムネイルキャッシュは最終利用から hours 時間、または容量上限を超えた分を古い順に消す
+        thumb_cache.sweep(max_age=hours * 3600)
+    except Exception:
+        pass
     try:
         cutoff = datetime.now() - timedelta(hours=hours)
         for name in os.listdir(UPLOAD_ROOT):
+            if name == THUMB_CACHE_DIRNAME:
+                continue
             p = os.path.join(UPLOAD_ROOT, name)
             try:
                 st = os.stat(p)
@@ -187,7 +358,8 @@ def cleanup_old_batches(hours: int = 24):
 
 @app.route('/reset/<batch>', methods=['POST'])
 def reset(batch: str):
-    # 指定バッチを削除してトップへ
+    # 指定バッチを削除してトップへ (処理中なら取り消す)
+    get_manager().cancel(batch)
     try:
         root = os.path.join(UPLOAD_ROOT, batch)
         if os.path.isdir(root):
@@ -207,101 +379,119 @@ def run():
 @app.post('/upload')
 def upload():
     tmpdir = tempfile.mkdtemp(prefix="twins_", dir=UPLOAD_ROOT)
-    ensure_dir(os.path.join(tmpdir, THUMB_DIRNAME))
-    files = request.files.getlist('files')
-    saved = []
-    for f in files:
-        if not f.filename:
-            continue
-        save_path = os.path.join(tmpdir, f.filename)
-        ensure_dir(os.path.dirname(save_path))
-        f.save(save_path)
-        saved.append(os.path.basename(save_path))
-    resp = {"batch": os.path.basename(tmpdir), "files": saved}
+    batch = os.path.basename(tmpdir)
+    # アップロード完了時点でジョブに登録する (ストリームへ接続しなくても処理は進む)
+    try:
+        uploads = receive_uploads(tmpdir)
+        job = start_job(batch, uploads)
+    except (JobQueueFull, UploadError) as e:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        return Response(json.dumps({"error": str(e)}, ensure_ascii=False), status=upload_error_status(e),
+                        mimetype='application/json')
+    except Exception:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        raise
+    resp = {"batch": batch, "files": [u.name for u in uploads], "job": job.to_dict()}
     return Response(json.dumps(resp), mimetype='application/json')
 
 
+def upload_error_status(e: Exception) -> int:
+    if isinstance(e, JobQueueFull):
+        return 429
+    return 413 if isinstance(e, UploadTooLarge) else 400
+
+
+def sse(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\n" + f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
 @app.get('/process/<batch>/stream')
 def process_stream(batch: str):
+    """ジョブの進捗イベントを購読する。切断してもジョブは止まらない。"""
     root = os.path.join(UPLOAD_ROOT, batch)
-    thumbs = os.path.join(root, THUMB_DIRNAME)
-    ensure_dir(thumbs)
-
-    # 処理対象ファイルを列挙（thumbs/や生成物は除外）
-    files = [f for f in os.listdir(root)
-             if os.path.isfile(os.path.join(root, f)) and not f.endswith('.json') and not f.endswith('.csv')]
-    files = [f for f in files if f != 'results.json' and f != 'results.csv']
-    total = len(files)
+    if not os.path.isdir(root):
+        return Response(status=404)
+    job = get_manager().get(batch)
+    if job is None:
+        if os.path.exists(os.path.join(root, SUMMARY_NAME)) or os.path.exists(os.path.join(root, 'results.json')):
+            # 完了済み (サーバー再起動後など)
+            return Response(sse("done", {"url": f"/batch/{batch}"}), mimetype='text/event-stream')
+        try:
+            job = start_job(batch)
+        except JobQueueFull as e:
+            return Response(sse("failed", {"error": str(e)}), mimetype='text/event-stream')
 
     def gen():
-        results: List[Dict[str, Any]] = []
-        for idx, name in enumerate(sorted(files), start=1):
-            path = os.path.join(root, name)
-            try:
-                a = analyze_image(path)
-                d = a.to_dict()
-                # サムネイル生成
-                thumb_name = f"{name}.thumb.jpg"
-                thumb_path = os.path.join(thumbs, thumb_name)
-                make_thumb(path, thumb_path, faces=d.get('faces'))
-                d["thumb_url"] = f"/static_tmp/{batch}/{THUMB_DIRNAME}/{thumb_name}"
-                d["relpath"] = f"/static_tmp/{batch}/{name}"
-                try:
-                    raw = d.get("classification", {}).get("label")
-                    d["classification"]["label_ja"] = ja_label(raw)
-                except Exception:
-                    pass
-                results.append(d)
-                # 進捗通知
-                pct = int(idx / max(total, 1) * 100)
-                payload = {
-                    "index": idx,
-                    "total": total,
-                    "pct": pct,
-                    "filename": name,
-                    "label": d.get("classification", {}).get("label"),
-                    "distance": d.get("classification", {}).get("distance"),
-                }
-                yield f"event: progress\n" + f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
-            except Exception as e:
-                payload = {"index": idx, "total": total, "pct": int(idx/max(total,1)*100), "filename": name, "error": str(e)}
-                yield f"event: progress\n" + f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
-
-        # サマリーと結果保存
-        from collections import Counter
-        labels = [r["classification"]["label"] for r in results]
-        c = Counter(labels)
-        summary: Dict[str, Any] = {"counts": dict(c), "total": len(results)}
-        dists = [r["classification"]["distance"] for r in results if r["classification"]["distance"] is not None]
-        if dists:
-            import statistics
-            summary["mean_distance"] = round(statistics.mean(dists), 3)
-            summary["median_distance"] = round(statistics.median(dists), 3)
-
-        with open(os.path.join(root, 'results.json'), 'w', encoding='utf-8') as f:
-            json.dump({"results": results, "summary": summary}, f, ensure_ascii=False, indent=2)
-        with open(os.path.join(root, 'results.csv'), 'w', encoding='utf-8', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow(["file", "label", "distance", "faces", "abs_path"])
-            for r in results:
-                label = ja_label(r.get("classification", {}).get("label"))
-                dist = r.get("classification", {}).get("distance")
-                faces_cnt = len(r.get("faces", []))
-                writer.writerow([os.path.basename(r.get("path", "")), label, ("" if dist is None else round(dist, 3)), faces_cnt, r.get("path", "")])
-
-        done_payload = {"url": f"/batch/{batch}"}
-        yield f"event: done\n" + f"data: {json.dumps(done_payload)}\n\n"
+        for event, data in job.events(timeout=15.0):
+            if data is None:
+                yield ": ping\n\n"
+                continue
+            yield sse(event, data)
 
     return Response(stream_with_context(gen()), mimetype='text/event-stream')
 
 
+@app.get('/jobs/<batch>')
+def job_status(batch: str):
+    job = get_manager().get(batch)
+    if job is None:
+        return Response(json.dumps({"error": "not found"}), status=404, mimetype='application/json')
+    return Response(json.dumps(job.to_dict(), ensure_ascii=False), mimetype='application/json')
+
+
+@app.get('/metrics')
+def metrics():
+    """Prometheus 形式の計測値 (段階別ヒストグラム、ジョブ数、処理枚数)。"""
+    manager = get_manager()
+    stats, ok, failed = manager.snapshot_stats()
+    stats.merge(thumb_cache.snapshot_stats())
+    lines = stats.prometheus()
+    lines += [
+        "# HELP twins_images_total Images analyzed by background jobs.",
+        "# TYPE twins_images_total counter",
+        f'twins_images_total{{result="ok"}} {ok}',
+        f'twins_images_total{{result="error"}} {failed}',
+        "# HELP twins_jobs Jobs currently held by the job manager, by state.",
+        "# TYPE twins_jobs gauge",
+    ]
+    lines += [f'twins_jobs{{state="{state}"}} {n}' for state, n in manager.counts().items()]
+    lines += [
+        "# HELP twins_inflight_images Images submitted to the worker pool and not yet collected.",
+        "# TYPE twins_inflight_images gauge",
+        f"twins_inflight_images {manager.inflight}",
+    ]
+    return Response("\n".join(lines) + "\n", mimetype='text/plain; version=0.0.4')
+
+
+_PENDING_HTML = """<!doctype html>
+<html lang="ja"><head><meta charset="utf-8"><meta http-equiv="refresh" content="2">
+<title>解析中</title></head>
+<body><p>解析中... {{ job.completed }}/{{ job.total }}</p></body></html>"""
+
+
 @app.get('/batch/<batch>')
 def view_batch(batch: str):
     root = os.path.join(UPLOAD_ROOT, batch)
+    job = get_manager().get(batch)
+    if job is not None and not job.finished:
+        # 処理中は進捗だけ表示して自動更新
+        return render_template_string(_PENDING_HTML, job=job)
     try:
-        with open(os.path.join(root, 'results.json'), 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        return render_template('result.html', results=data.get('results', []), summary=data.get('summary', {}), batch=batch)
-    except Exception:
+        store = open_store(root)
+    except (OSError, ValueError):
+        store = None
+    if store is None:
         # 結果がまだ無い/壊れている場合はトップへ
         return redirect(url_for('index'))
+    # 1ページ分のレコードだけを読む (並べ替えはラベル/距離の列だけで行う)
+    sort = request.args.get('sort', 'index')
+    if sort not in SORT_KEYS:
+        sort = 'index'
+    order = 'desc' if request.args.get('order') == 'desc' else 'asc'
+    per = min(max(request.args.get('per', PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    indices = sorted_indices(store, sort, descending=order == 'desc')
+    pages = max(1, -(-len(indices) // per))
+    page = min(max(request.args.get('page', 1, type=int), 1), pages)
+    results = [display_record(store.record(int(i)), batch, int(i)) for i in indices[(page - 1) * per:page * per]]
+    return render_template('result.html', results=results, summary=load_summary(root, store), batch=batch,
+                           sort=sort, order=order, page=page, pages=pages, per=per)
@@ -3,3 +3,12 @@ ROOT = os.path.dirname(os.path.dirname(__file__))
 src = os.path.join(ROOT, 'src')
 if src not in sys.path:
     sys.path.insert(0, src)
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def _default_thresholds(tmp_path_factory, monkeypatch):
+    # 開発機の閾値設定ファイル (TWINS_THRESHOLDS / ~/.config/twins-recognition) を読まず既定値で動かす
+    monkeypatch.delenv("TWINS_THRESHOLDS", raising=False)
+    monkeypatch.setenv("XDG_CONFIG_HOME", str(tmp_path_factory.mktemp("config")))
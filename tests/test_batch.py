@@ -0,0 +1,34 @@
+import numpy as np
+
+from twins_recognition.batch import analyze_batch
+from twins_recognition.bench import synth_image
+
+
+def test_analyze_batch_reports_failures_in_order(tmp_path):
+    paths = [str(tmp_path / f"missing_{i}.jpg") for i in range(5)]
+    for workers in (1, 2):
+        items = list(analyze_batch(paths, workers=workers, chunksize=2))
+        assert [it.index for it in items] == list(range(5))
+        assert [it.path for it in items] == paths
+        assert all(not it.ok and it.analysis is None for it in items)
+
+
+def test_worker_pool_matches_sequential_on_faces(tmp_path):
+    rng = np.random.default_rng(7)
+    paths = []
+    for i, n in enumerate((2, 0, 3, 1, 2)):
+        im, _ = synth_image(480, 320, n, rng)
+        paths.append(str(tmp_path / f"img{i}.jpg"))
+        im.save(paths[-1], quality=95)
+    paths.insert(2, str(tmp_path / "missing.jpg"))
+
+    seq = list(analyze_batch(paths, workers=1, chunksize=2))
+    par = list(analyze_batch(paths, workers=2, chunksize=2))
+    assert [it.path for it in par] == paths and [it.index for it in par] == list(range(len(paths)))
+    assert [it.ok for it in par] == [it.ok for it in seq] == [True, True, False, True, True, True]
+    assert sum(it.analysis.embeddings_count for it in seq if it.ok) >= 4   # HOG が描画した顔を検出する
+    for a, b in zip(seq, par):
+        if not a.ok:
+            continue
+        assert a.analysis.to_dict() == b.analysis.to_dict()
+        assert np.allclose(a.analysis.embeddings, b.analysis.embeddings, atol=1e-6)
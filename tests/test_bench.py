@@ -0,0 +1,46 @@
+import numpy as np
+
+from twins_recognition.bench import build_cases, compare_results, latency_summary, measure_startup
+
+
+def _result(ips, p50, rss=100.0):
+    stage = {"images_per_sec": ips, "mean_ms": p50, "p50_ms": p50, "p95_ms": p50 * 1.2}
+    return {"version": 1, "cases": {"640x480_f1": {"pipeline": dict(stage), "stages": {"detect": dict(stage)},
+                                                  "peak_rss_mb": rss}}}
+
+
+def test_compare_flags_only_regressions_beyond_limits():
+    base = _result(10.0, 100.0)
+    rows = compare_results(base, _result(9.5, 110.0, rss=110.0), throughput_pct=10, latency_pct=20, rss_pct=25)
+    assert rows and not any(r.regressed for r in rows)
+    rows = compare_results(base, _result(8.0, 130.0), throughput_pct=10, latency_pct=20)
+    bad = {r.metric for r in rows if r.regressed}
+    assert bad == {"pipeline.images_per_sec", "pipeline.p50_ms", "pipeline.p95_ms",
+                   "stages.detect.images_per_sec", "stages.detect.p50_ms", "stages.detect.p95_ms"}
+    # 速くなった分は劣化ではない / 誤差の大きい短い段階は比較しない
+    assert not any(r.regressed for r in compare_results(base, _result(20.0, 50.0)))
+    assert [r.metric for r in compare_results(_result(1e5, 0.01), _result(1e3, 1.0), min_ms=1.0)] == ["peak_rss_mb"]
+
+
+def test_latency_summary_percentiles():
+    s = latency_summary([0.01] * 99 + [1.0])
+    assert s["n"] == 100 and s["p50_ms"] == 10.0 and s["p99_ms"] > 10.0
+    assert abs(s["images_per_sec"] - 100 / 1.99) < 1e-3
+
+
+def test_synthetic_cases_are_reproducible(tmp_path):
+    from PIL import Image
+    (tmp_path / "a").mkdir()
+    (tmp_path / "b").mkdir()
+    a = build_cases(str(tmp_path / "a"), ["160x120"], [0, 3], images=2, seed=1)
+    b = build_cases(str(tmp_path / "b"), ["160x120"], [3], images=2, seed=1)
+    assert [c.name for c in a] == ["160x120_f0", "160x120_f3"]
+    assert a[1].boxes == b[0].boxes and all(len(x) == 3 for x in a[1].boxes)
+    with Image.open(a[1].paths[0]) as ia, Image.open(b[0].paths[0]) as ib:
+        assert ia.size == (160, 120)
+        assert np.array_equal(np.asarray(ia), np.asarray(ib))
+
+
+def test_cli_import_does_not_load_models():
+    # dlib / face_recognition などは初回使用時に読み込む
+    assert measure_startup(runs=1)["heavy_modules"] == []
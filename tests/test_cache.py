@@ -0,0 +1,65 @@
+import numpy as np
+
+import pytest
+
+from twins_recognition.cache import EmbeddingCache
+from twins_recognition.processor import AnalyzeOptions, analyze_image, analyze_images
+
+
+def test_cache_roundtrip_and_digest_reuse(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "c"))
+    img = tmp_path / "a.jpg"
+    img.write_bytes(b"fake-image-bytes")
+    digest, data = cache.digest_file(str(img))
+    assert data == b"fake-image-bytes"
+    # 2回目はファイルを読まずに記録済みハッシュを返す
+    assert cache.digest_file(str(img)) == (digest, None)
+
+    key = EmbeddingCache.make_key(digest, "hog", 1)
+    assert key != EmbeddingCache.make_key(digest, "hog", 2)
+    assert EmbeddingCache.make_key(digest, "hog", 1, tile=4096, tile_overlap=256) not in (key, EmbeddingCache.make_key(digest, "hog", 1, tile=4096))
+    assert cache.get(key) is None
+    emb = [[0.1 * i] * 128 for i in range(2)]
+    cache.put(key, [(1, 2, 3, 4), (5, 6, 7, 8)], emb)
+    faces, got = cache.get(key)
+    assert faces == [(1, 2, 3, 4), (5, 6, 7, 8)]
+    assert got.dtype == np.float32 and got.shape == (2, 128)
+    assert np.allclose(got, emb)
+
+
+def test_cache_lru_eviction(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "c"), max_bytes=2500)
+    for i in range(6):
+        cache.put(f"k{i}", [(0, 0, 0, 0)], [[float(i)] * 128])
+    cache.get("k0")  # k0 を最近使ったことにする
+    cache.evict()
+    assert cache.total_bytes() <= 2500
+    assert cache.get("k0") is not None
+    assert cache.get("k1") is None
+
+
+def test_eviction_bounds_digest_table(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "c"), max_bytes=6000)
+    keys = []
+    for i in range(40):   # 結果の無い (改名・削除で残った) 対応表の行も上限に数える
+        img = tmp_path / f"renamed-{i:03d}-" f"{'x' * 40}.jpg"
+        img.write_bytes(b"img%d" % i)
+        digest, _ = cache.digest_file(str(img))
+        keys.append(EmbeddingCache.make_key(digest, "hog", 1))
+    for key in keys[:4]:
+        cache.put(key, [(0, 0, 0, 0)], [[1.0] * 128])
+    assert cache.total_bytes() > 6000
+    cache.evict()
+    assert cache.total_bytes() <= 6000
+    live = {row[0] for row in cache._conn.execute("SELECT digest FROM digests")}
+    assert len(live) == 4 and all(cache.get(EmbeddingCache.make_key(d, "hog", 1)) is not None for d in live)
+
+
+def test_undecodable_file_error_names_the_path(tmp_path):
+    bad = tmp_path / "broken.jpg"
+    bad.write_bytes(b"not an image")
+    options = AnalyzeOptions(cache_dir=str(tmp_path / "c"))
+    with pytest.raises(OSError, match="broken.jpg"):
+        analyze_image(str(bad), options)
+    [(analysis, error)] = analyze_images([str(bad)], options)
+    assert analysis is None and "broken.jpg" in error and "BytesIO" not in error
@@ -0,0 +1,84 @@
+import argparse
+import io
+import json
+import os
+
+import numpy as np
+
+from twins_recognition import classifier
+from twins_recognition.calibrate import RANKS, EmbeddingTable, choose_thresholds, read_pairs, resolve_rows, sweep
+from twins_recognition.cli import add_analysis_args, analysis_options, calibrate_main
+from twins_recognition.processor import ImageAnalysis
+from twins_recognition.store import EmbeddingStore
+
+
+def test_sweep_recovers_separating_thresholds():
+    rng = np.random.default_rng(0)
+    # ラベルごとに重ならない距離帯: twins < 0.3 < siblings < 0.5 < similar < 0.7 < different
+    bands = {"twins": (0.1, 0.3), "siblings": (0.31, 0.5), "similar": (0.51, 0.7), "different": (0.71, 1.2)}
+    dist, ranks = [], []
+    for label, (lo, hi) in bands.items():
+        dist.append(rng.uniform(lo, hi, 5000))
+        ranks.append(np.full(5000, RANKS[label], dtype=np.int8))
+    dist = np.concatenate(dist + [np.array([np.nan])])
+    ranks = np.concatenate(ranks + [np.array([0], dtype=np.int8)])
+    curves = sweep(dist, ranks)
+    assert curves["twins"].positives == 5000 and curves["twins"].negatives == 15000
+    chosen = choose_thresholds(curves)
+    assert 0.3 <= chosen["twins"] < 0.31
+    assert 0.5 <= chosen["siblings"] < 0.51
+    assert 0.7 <= chosen["similar"] < 0.71
+    for c in curves.values():
+        i = c.at(chosen[c.label])
+        assert c.precision[i] == 1.0 and c.recall[i] == 1.0 and c.auc() == 1.0
+    # 陽性の無いラベルは現在値、順序は保つ
+    only = sweep(dist[ranks != 1], ranks[ranks != 1])
+    kept = choose_thresholds(only, current={"twins": 0.4, "siblings": 0.2, "similar": 0.6})
+    assert kept["siblings"] == kept["twins"]
+
+
+def test_calibrate_cli_writes_loadable_config(tmp_path, monkeypatch):
+    rng = np.random.default_rng(1)
+    base = rng.normal(scale=0.3, size=128).astype(np.float32)
+    step = rng.normal(size=128).astype(np.float32)
+    step /= np.linalg.norm(step)
+    with EmbeddingStore(str(tmp_path / "store")) as store:
+        for k, gap in enumerate((0.2, 0.25, 0.45, 0.9)):
+            emb = np.stack([base + k, base + k + step * gap])
+            store.append(ImageAnalysis(path=str(tmp_path / f"p{k}.jpg"), faces=[(0, 10, 10, 0), (0, 30, 10, 20)],
+                                       embeddings_count=2, classification=classifier.classify_embeddings(emb),
+                                       embeddings=emb))
+    labels = ["twins", "twins", "siblings", "different"]
+    rows = [f"p{k}.jpg,0,,1,{label}" for k, label in enumerate(labels)] + ["missing.jpg,0,,1,twins"]
+    (tmp_path / "pairs.csv").write_text("# pairs\npath_a,face_a,path_b,face_b,label\n" + "\n".join(rows) + "\n")
+
+    table = EmbeddingTable.from_store(str(tmp_path / "store"))
+    ra, rb, ranks, skipped = resolve_rows(table, read_pairs(io.StringIO("\n".join(rows))), str(tmp_path))
+    assert ra.tolist() == [0, 2, 4, 6] and rb.tolist() == [1, 3, 5, 7] and skipped == 1
+
+    out = tmp_path / "thresholds.json"
+    assert calibrate_main(["--store", str(tmp_path / "store"), "--pairs", str(tmp_path / "pairs.csv"),
+                           "--output", str(out)]) == 0
+    chosen = json.loads(out.read_text())["thresholds"]
+    assert 0.25 <= chosen["twins"] < 0.45 and 0.45 <= chosen["siblings"] < 0.9
+    assert classifier.runtime_thresholds(path=str(out)) == chosen
+    assert classifier.label_for_distance(chosen["twins"], thresholds=chosen) == "twins"
+    assert classifier.label_for_distance(chosen["twins"] + 0.01, thresholds=chosen) == "siblings"
+
+    # 壊れた既存の設定ファイルは警告して作り直す
+    broken = tmp_path / "broken.json"
+    broken.write_text("{not json")
+    assert calibrate_main(["--store", str(tmp_path / "store"), "--pairs", str(tmp_path / "pairs.csv"),
+                           "--output", str(broken)]) == 0
+    assert classifier.runtime_thresholds(path=str(broken)) == chosen
+
+    # 閾値は解析設定ごとに渡し、グローバルの閾値も環境変数も変えない
+    parser = argparse.ArgumentParser()
+    add_analysis_args(parser)
+    with_file = analysis_options(parser.parse_args(["--thresholds", str(out)]))
+    assert with_file.thresholds == chosen
+    assert with_file.classify(np.stack([base, base + step * 0.3])).label == "siblings"
+    assert analysis_options(parser.parse_args([])).thresholds == classifier.DEFAULT_THRESHOLDS
+    assert classifier.THRESHOLDS == classifier.DEFAULT_THRESHOLDS and classifier.THRESHOLDS_ENV not in os.environ
+    monkeypatch.setenv(classifier.THRESHOLDS_ENV, str(out))
+    assert analysis_options(parser.parse_args([])).thresholds == chosen
@@ -18,3 +18,23 @@ def test_classify_pair_boundaries():
     diff = [0.0]*127 + [ THRESHOLDS['similar'] + 0.1 ]
     r4 = classify_pair(base, diff)
     assert r4.label == 'different'
+
+
+def test_classify_embeddings_matrix_matches_pairwise():
+    import itertools
+    import numpy as np
+    from twins_recognition.classifier import classify_embeddings, euclidean_distance
+
+    rng = np.random.default_rng(0)
+    embs = rng.normal(scale=0.05, size=(7, 128)).astype(np.float32)
+    r = classify_embeddings(embs)
+    expected = min(euclidean_distance(embs[i].tolist(), embs[j].tolist())
+                   for i, j in itertools.combinations(range(7), 2))
+    assert abs(r.distance - expected) < 1e-6
+    assert r.detail["faces_count"] == 7
+    # リスト入力 / 2顔 / 0顔 も従来どおり
+    r2 = classify_embeddings(embs[:2].tolist())
+    assert abs(r2.distance - euclidean_distance(embs[0].tolist(), embs[1].tolist())) < 1e-6
+    assert "faces_count" not in r2.detail
+    assert classify_embeddings([]).label == 'no_face'
+    assert classify_embeddings(embs[:1]).label == 'single_person'
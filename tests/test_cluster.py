@@ -0,0 +1,68 @@
+import numpy as np
+
+from twins_recognition.classifier import THRESHOLDS, pairwise_distances
+from twins_recognition.cluster import FaceClusters, describe
+from twins_recognition.index import IVF, _nearest_centroid, kmeans
+
+
+def _faces(seed=0, people=30, per=4):
+    """人物ごとの中心の周りに顔を散らした埋め込み。"""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(scale=0.6, size=(people, 128)).astype(np.float32)
+    # 奇数番の人物は直前の人物の兄弟程度の距離に置く
+    step = rng.normal(size=(people // 2, 128)).astype(np.float32)
+    centers[1::2] = centers[0::2] + 0.5 * step / np.linalg.norm(step, axis=1, keepdims=True)
+    x = centers.repeat(per, axis=0) + rng.normal(scale=0.012, size=(people * per, 128)).astype(np.float32)
+    return x[rng.permutation(x.shape[0])]
+
+
+def _components(x, radius):
+    """全ペアの距離行列から求めた連結成分 (各顔のクラスタ内最小番号)。"""
+    d = pairwise_distances(x) <= radius
+    labels = np.arange(x.shape[0])
+    changed = True
+    while changed:
+        new = np.where(d, labels[None, :], x.shape[0]).min(axis=1)
+        changed = not np.array_equal(new, labels)
+        labels = new
+    return labels
+
+
+def test_incremental_clusters_match_full_components():
+    x = _faces()
+    full = FaceClusters()
+    full.update(x, block=17)
+    inc = FaceClusters()
+    for stop in (10, 55, 90, x.shape[0]):
+        inc.update(x[:stop], block=16)
+    assert not np.array_equal(full.labels("twins"), full.labels("siblings"))
+    for level in ("twins", "siblings"):
+        expected = _components(x, THRESHOLDS[level])
+        assert np.array_equal(full.labels(level), expected)
+        assert np.array_equal(inc.labels(level), expected)
+
+
+def test_ivf_with_all_lists_matches_exact():
+    x = _faces(seed=1)
+    centroids = kmeans(x, 8, seed=0)
+    ivf = IVF(centroids, _nearest_centroid(x, centroids))
+    approx = FaceClusters()
+    approx.update(x, block=32, ivf=ivf, nprobe=8)
+    assert np.array_equal(approx.labels("twins"), _components(x, THRESHOLDS["twins"]))
+
+
+def test_describe_marks_twins_and_sibling_families():
+    rng = np.random.default_rng(2)
+    a = rng.normal(scale=0.6, size=128).astype(np.float32)
+    step = rng.normal(size=128).astype(np.float32)
+    step /= np.linalg.norm(step)
+    b = a + step * 0.3            # a と同じ写真に写る双子
+    c = a + step * 0.9            # 別人 (兄弟ではない距離)
+    d = b + np.roll(step, 1) * 0.5  # b の兄弟
+    x = np.stack([a, b, c, d, a + 0.001])
+    clusters = FaceClusters()
+    clusters.update(x)
+    cols = describe(clusters, np.array([0, 0, 1, 2, 3]))
+    assert cols["person"].tolist()[:2] == [0, 0] and cols["person_kind"][0] == "twins"
+    assert cols["person_kind"][2] == "person" and cols["family_kind"][2] == "single"
+    assert cols["family"][3] == 0 and cols["family_kind"][3] == "siblings"
@@ -0,0 +1,23 @@
+import io
+import os
+
+from twins_recognition import cache as cache_module
+from twins_recognition import dedup as dedup_module
+from twins_recognition.daemon import _run_cli
+
+
+def test_requests_get_client_environment_and_fresh_state(tmp_path, monkeypatch):
+    broken = tmp_path / "thresholds.json"
+    broken.write_text("{")
+    monkeypatch.setenv("XDG_CACHE_HOME", "/daemon/cache")
+    env = {"TWINS_THRESHOLDS": str(broken), "XDG_CACHE_HOME": str(tmp_path / "cache")}
+    out = io.BytesIO()
+    code = _run_cli(["--image", "missing.jpg", "--dedup"], str(tmp_path), out, env)
+    sent = out.getvalue().decode("utf-8")
+    assert code == 0 and "missing.jpg" in sent
+    # クライアントの TWINS_THRESHOLDS を読んだ (壊れているので既定値で続行)
+    assert "閾値設定を読み込めない" in sent
+    assert (tmp_path / "cache" / "twins-recognition" / "cache.sqlite").exists()
+    # 実行後はデーモン自身の環境に戻り、キャッシュ・索引は持ち越さない
+    assert os.environ["XDG_CACHE_HOME"] == "/daemon/cache" and "TWINS_THRESHOLDS" not in os.environ
+    assert cache_module._CACHES == {} and dedup_module._INDEXES == {}
@@ -0,0 +1,70 @@
+import sqlite3
+
+import numpy as np
+from PIL import Image
+
+from twins_recognition.cache import EmbeddingCache
+from twins_recognition.dedup import DuplicateIndex, dhash
+from twins_recognition.processor import AnalyzeOptions, analyze_images
+from twins_recognition.stats import StageStats
+
+
+def _pattern(seed: int, size=(240, 180)) -> Image.Image:
+    rng = np.random.default_rng(seed)
+    small = rng.integers(0, 255, size=(6, 8, 3), dtype=np.uint8)
+    return Image.fromarray(small).resize(size, Image.BICUBIC)
+
+
+def test_near_duplicate_faces_are_rescaled():
+    img = np.asarray(_pattern(0))
+    ph, usable = dhash(img)
+    assert usable
+    index = DuplicateIndex(max_distance=2)
+    emb = np.ones((1, 128), dtype=np.float32)
+    index.add("/a.png", "d0", ph, 240, 180, [(20, 100, 60, 40)], emb)
+    half = np.asarray(_pattern(0).resize((120, 90), Image.BILINEAR))
+    dup = index.near(dhash(half)[0], 120, 90)
+    assert dup is not None and not dup.exact and dup.source == "/a.png"
+    assert dup.faces == [(10, 50, 30, 20)]
+    # 縦横比が違う (トリミング) ものは流用しない
+    assert index.near(ph, 240, 120) is None
+    assert index.exact("d0").exact and index.exact("other") is None
+
+
+def test_analyze_images_reuses_duplicates(tmp_path):
+    paths = []
+    base = _pattern(1)
+    for name, img, fmt in (("orig.png", base, "PNG"), ("copy.jpg", base, "JPEG"),
+                           ("small.png", base.resize((120, 90), Image.BILINEAR), "PNG"),
+                           ("other.png", _pattern(2), "PNG")):
+        img.save(tmp_path / name, format=fmt, quality=90)
+        paths.append(str(tmp_path / name))
+    (tmp_path / "same.png").write_bytes((tmp_path / "orig.png").read_bytes())
+    paths.append(str(tmp_path / "same.png"))
+
+    stats = StageStats()
+    options = AnalyzeOptions(dedup=True, dedup_distance=4)
+    results = analyze_images(paths, options, stats)
+    dups = [a.duplicate for a, _ in results]
+    assert dups[0] is None and dups[3] is None
+    assert dups[1]["of"] == paths[0] and not dups[1]["exact"]
+    assert dups[2]["of"] == paths[0]
+    assert dups[4] == {"of": paths[0], "exact": True, "distance": 0}
+    assert stats.duplicates == 3
+    assert "duplicate" in results[4][0].to_dict() and "duplicate" not in results[0][0].to_dict()
+
+
+def test_cache_write_failure_keeps_results(tmp_path, monkeypatch):
+    base = _pattern(3)
+    for name in ("a.png", "b.png"):
+        base.save(tmp_path / name, format="PNG")
+    paths = [str(tmp_path / "a.png"), str(tmp_path / "b.png")]
+
+    def fail(self, key, faces, embeddings):
+        raise sqlite3.OperationalError("database is locked")
+    monkeypatch.setattr(EmbeddingCache, "put", fail)
+    # 重複の流用でも通常の解析でも、キャッシュへの保存失敗で例外を送出しない
+    options = AnalyzeOptions(dedup=True, cache_dir=str(tmp_path / "cache"))
+    results = analyze_images(paths, options)
+    assert [err for _, err in results] == [None, None]
+    assert results[0][0].duplicate is None and results[1][0].duplicate["exact"]
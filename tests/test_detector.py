@@ -0,0 +1,44 @@
+import numpy as np
+
+from twins_recognition.detector import (detect_faces_tiled, downscale_factor, iou, merge_boxes, scale_locations,
+                                        tile_grid)
+
+
+def test_downscaled_boxes_map_back_to_original():
+    assert downscale_factor((4000, 6000, 3), None) == 1.0
+    assert downscale_factor((400, 600, 3), 1024) == 1.0
+    scale = downscale_factor((4000, 6000, 3), 1500)
+    assert scale == 0.25
+    small = [(100, 300, 200, 200), (0, 1500, 1000, 1400)]
+    big = scale_locations(small, 1 / scale, (4000, 6000, 3))
+    assert big[0] == (400, 1200, 800, 800)
+    assert big[1] == (0, 6000, 4000, 5600)  # 画像範囲内に収める
+    assert iou(big[0], big[0]) == 1.0
+    assert iou(big[0], (800, 1200, 1200, 800)) == 0.0
+
+
+def test_tiles_cover_image_and_merge_cut_faces():
+    tiles = tile_grid(1000, 2500, tile=1024, overlap=200)
+    assert {t[:2] for t in tiles} == {(0, 0), (0, 824), (0, 1476)}
+    assert all(b - t == 1000 and r - l == 1024 for t, l, b, r in tiles)
+    assert tile_grid(500, 500, tile=1024) == [(0, 0, 500, 500)]
+
+    # 偽の検出器: タイルに掛かる顔を、タイル端で切れた枠のまま返す (タイルは tile_grid の順に来る)
+    faces = [(100, 900, 250, 750), (400, 1700, 520, 1580), (700, 2400, 800, 2300)]
+    calls = []
+
+    def detect(part):
+        top, left, bottom, right = tiles[len(calls)]
+        calls.append(part.shape[:2])
+        out = []
+        for t, r, b, l in faces:
+            ct, cr, cb, cl = max(t, top), min(r, right), min(b, bottom), max(l, left)
+            if cb > ct and cr > cl:
+                out.append((ct - top, cr - left, cb - top, cl - left))
+        return out
+
+    found = detect_faces_tiled(np.zeros((1000, 2500, 3), dtype=np.uint8), detect, tile=1024, overlap=200)
+    assert calls == [(1000, 1024)] * 3
+    assert found == faces
+
+    assert merge_boxes([(0, 100, 100, 0), (0, 100, 100, 60), (0, 300, 100, 200)]) == [(0, 100, 100, 0), (0, 300, 100, 200)]
@@ -0,0 +1,75 @@
+import numpy as np
+
+from twins_recognition.classifier import THRESHOLDS, classify_embeddings
+from twins_recognition.index import EmbeddingIndex
+from twins_recognition.processor import ImageAnalysis
+
+
+def make_analysis(path, embs):
+    embs = np.asarray(embs, dtype=np.float32)
+    faces = [(i, i + 10, i + 10, i) for i in range(len(embs))]
+    return ImageAnalysis(path=path, faces=faces, embeddings_count=len(embs),
+                         classification=classify_embeddings(embs), embeddings=embs)
+
+
+def build(n_images=40, seed=0):
+    rng = np.random.default_rng(seed)
+    index = EmbeddingIndex()
+    for i in range(n_images):
+        index.add(make_analysis(f"/img/{i}.jpg", rng.normal(scale=0.1, size=(2, 128))))
+    return index, rng
+
+
+def test_exact_search_matches_brute_force(tmp_path):
+    index, rng = build()
+    q = rng.normal(scale=0.1, size=(3, 128)).astype(np.float32)
+    hits = index.search(q, k=5, block=7)
+    dist = np.linalg.norm(index.embeddings[None, :, :] - q[:, None, :], axis=2)
+    for qi in range(3):
+        expected = np.sort(dist[qi])[:5]
+        assert np.allclose([h.distance for h in hits[qi]], expected, atol=1e-5)
+
+    # 自己一致の除外
+    own = index.search(index.embeddings[:1], k=3, exclude_path="/img/0.jpg")[0]
+    assert all(h.path != "/img/0.jpg" for h in own)
+
+    # 保存/読み込み後も同じ結果
+    index.save(str(tmp_path / "idx"))
+    loaded = EmbeddingIndex.load(str(tmp_path / "idx"))
+    assert [h.to_dict() for h in loaded.search(q, k=5)[0]] == [h.to_dict() for h in hits[0]]
+
+
+def test_faceless_image_is_remembered(tmp_path):
+    index, rng = build(n_images=3)
+    assert index.add(make_analysis("/img/empty.jpg", np.empty((0, 128)))) == 0
+    q = rng.normal(scale=0.1, size=(1, 128)).astype(np.float32)
+    hits = index.search(q, k=6)[0]
+    index.save(str(tmp_path / "idx"))
+    loaded = EmbeddingIndex.load(str(tmp_path / "idx"))
+    # 顔の無い画像も登録済みとして扱い、次回の差分追加で再解析しない
+    assert "/img/empty.jpg" in loaded and len(loaded) == 6
+    assert [h.to_dict() for h in loaded.search(q, k=6)[0]] == [h.to_dict() for h in hits]
+    loaded.add(make_analysis("/img/3.jpg", rng.normal(scale=0.1, size=(1, 128))))
+    assert loaded.search(loaded.embeddings[-1:], k=1)[0][0].path == "/img/3.jpg"
+
+
+def test_radius_and_ivf():
+    index, rng = build()
+    base = index.embeddings[0]
+    twin = base + np.full(128, (THRESHOLDS["twins"] - 0.05) / np.sqrt(128), dtype=np.float32)
+    index.add(make_analysis("/img/twin.jpg", [twin]))
+    found = index.radius_search(base[None, :], label="twins", exclude_path="/img/0.jpg")[0]
+    assert [h.path for h in found] == ["/img/twin.jpg"]
+    assert found[0].label == "twins"
+    # 設定した閾値 (calibrate の結果など) で半径とラベルが決まる
+    tight = {"twins": THRESHOLDS["twins"] - 0.1, "siblings": THRESHOLDS["twins"], "similar": THRESHOLDS["similar"]}
+    assert index.radius_search(base[None, :], label="twins", exclude_path="/img/0.jpg", thresholds=tight) == [[]]
+    near = index.search(base[None, :], k=1, exclude_path="/img/0.jpg", thresholds=tight)[0]
+    assert near[0].path == "/img/twin.jpg" and near[0].label == "siblings"
+
+    index.train_ivf(nlist=4, iters=5)
+    q = rng.normal(scale=0.1, size=(2, 128)).astype(np.float32)
+    # 全リストを走査すれば厳密検索と一致する
+    exact = index.search(q, k=4)
+    approx = index.search(q, k=4, nprobe=4)
+    assert [[h.distance for h in r] for r in exact] == [[h.distance for h in r] for r in approx]
@@ -0,0 +1,35 @@
+import threading
+
+import pytest
+
+from twins_recognition.jobs import DONE, Job, JobManager, JobQueueFull
+
+
+def test_jobs_share_pool_and_replay_events(tmp_path):
+    manager = JobManager(workers=2, mode="thread", max_jobs=4)
+    gate = threading.Event()
+    seen = []
+
+    def on_result(job, i, analysis, error):
+        gate.wait(10)
+        seen.append((job.id, i))
+        return {"index": i + 1, "error": error}
+
+    try:
+        a = manager.submit(Job("a", [str(tmp_path / f"a{i}.jpg") for i in range(3)], on_result,
+                               on_finish=lambda job: {"url": job.id}))
+        b = manager.submit(Job("b", [str(tmp_path / f"b{i}.jpg") for i in range(2)], on_result))
+        with pytest.raises(JobQueueFull):
+            manager.submit(Job("c", ["x"], on_result))
+            manager.submit(Job("d", ["x"], on_result))
+            manager.submit(Job("e", ["x"], on_result))
+        gate.set()
+        assert a.wait(30) and b.wait(30)
+        assert a.state == DONE and a.to_dict()["failed"] == 3
+        # ジョブ内では入力順、購読は後から接続しても最初から受け取れる
+        assert [i for j, i in seen if j == "a"] == [0, 1, 2]
+        events = list(a.events(timeout=1))
+        assert [e for e, _ in events] == ["progress"] * 3 + ["done"]
+        assert events[-1][1] == {"url": "a"}
+    finally:
+        manager.shutdown()
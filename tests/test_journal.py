@@ -0,0 +1,31 @@
+import os
+
+from twins_recognition.journal import Journal
+
+
+def test_journal_resume_and_torn_tail(tmp_path):
+    img_a = tmp_path / "a.jpg"
+    img_b = tmp_path / "b.jpg"
+    img_a.write_bytes(b"a")
+    img_b.write_bytes(b"b")
+    jpath = str(tmp_path / "run.journal")
+    ok = {"path": str(img_a), "faces": [], "embeddings_count": 0,
+          "classification": {"label": "no_face", "distance": None, "detail": {}}}
+    with Journal(jpath) as j:
+        j.record(str(img_a), ok)
+        j.record(str(img_b), {"path": str(img_b), "error": "broken"})
+    # 書き込み途中で落ちた行を再現
+    with open(jpath, "a", encoding="utf-8") as f:
+        f.write('{"path": "/x.jpg", "si')
+
+    j = Journal(jpath)
+    assert j.is_done(str(img_a))
+    assert not j.is_done(str(img_b))  # 失敗は再試行対象
+    assert list(j.results([str(img_b), str(img_a)])) == [{"path": str(img_b), "error": "broken"}, ok]
+    assert open(jpath, encoding="utf-8").read().endswith("\n")
+
+    # 内容が変わった (サイズ/mtime が違う) 画像は再解析対象
+    img_a.write_bytes(b"changed")
+    os.utime(img_a, ns=(1, 1))
+    assert not j.is_done(str(img_a))
+    j.close()
@@ -0,0 +1,50 @@
+import numpy as np
+
+from twins_recognition.bench import synthetic_embeddings
+from twins_recognition.classifier import classify_embeddings, labels_for_distances, pairwise_distances
+from twins_recognition.processor import ImageAnalysis
+from twins_recognition.quantize import accuracy_report, bytes_per_face, encode
+from twins_recognition.store import EmbeddingStore
+
+
+def test_normalized_kinds_keep_distances():
+    x = synthetic_embeddings(50, seed=3)
+    ref = pairwise_distances(x)
+    for kind, tol in (("float16n", 1e-3), ("int8n", 1.5e-2)):
+        enc = encode(x, kind)
+        assert np.abs(pairwise_distances(enc.decode()) - ref).max() < tol
+        assert np.allclose(np.linalg.norm(enc.unit(), axis=1), 1.0, atol=1e-5)
+        assert enc.nbytes == bytes_per_face(kind) * x.shape[0]
+    cos = pairwise_distances(x, "cosine")
+    x64 = x.astype(np.float64)
+    u = x64 / np.linalg.norm(x64, axis=1, keepdims=True)
+    assert np.allclose(cos, np.clip(1 - u @ u.T, 0, 2) * (1 - np.eye(len(x))), atol=1e-9)
+    # 埋め込みの無い行は NaN のまま
+    assert np.isnan(encode(np.full((1, 128), np.nan), "int8n").decode()).all()
+
+
+def test_cosine_mode_and_label_vector():
+    x = synthetic_embeddings(10, per=2, seed=1)
+    r = classify_embeddings(x[:2], metric="cosine")
+    assert 0 <= r.distance < 0.05 and r.label == "twins"
+    assert classify_embeddings(x[:3] * [[1.0], [3.0], [1.0]], metric="cosine").distance == r.distance
+    d = np.array([0.1, 0.40, 0.41, 0.55, 0.6, 0.61])
+    assert labels_for_distances(d).tolist() == ["twins", "twins", "siblings", "siblings", "similar", "different"]
+
+
+def test_int8_store_and_accuracy_report(tmp_path):
+    x = synthetic_embeddings(40, seed=2)
+    with EmbeddingStore(str(tmp_path / "s"), dtype="int8n") as store:
+        for k in range(0, x.shape[0], 4):
+            emb = x[k:k + 4]
+            store.append(ImageAnalysis(path=f"/img/{k}.jpg", faces=[(0, 1, 1, 0)] * 4, embeddings_count=4,
+                                       classification=classify_embeddings(emb), embeddings=emb))
+    store = EmbeddingStore(str(tmp_path / "s"))
+    assert store.column("embeddings").dtype == np.int8
+    assert np.abs(store.embeddings - x).max() < 0.02
+    assert np.array_equal(store.image_embeddings(2), store.embeddings[8:12])
+
+    rows = {(r["kind"], r["metric"]): r for r in accuracy_report(x, kinds=("float32", "int8n"))}
+    assert rows[("float32", "euclidean")]["label_agreement"] == 1.0
+    assert rows[("int8n", "euclidean")]["label_agreement"] > 0.99
+    assert rows[("int8n", "euclidean")]["faces_per_gb"] > 3.8 * rows[("float32", "euclidean")]["faces_per_gb"]
@@ -0,0 +1,52 @@
+import os
+
+from twins_recognition.cli import iter_images
+from twins_recognition.scanner import Scanner, background, scan_images
+
+
+def test_scan_sniffs_unknown_extensions_and_reuses_manifest(tmp_path):
+    root = tmp_path / "imgs"
+    (root / "b").mkdir(parents=True)
+    (root / "a").mkdir()
+    (root / "z.jpg").write_bytes(b"not even checked")
+    (root / "noext").write_bytes(b"\x89PNG\r\n\x1a\n....")
+    (root / "notes.txt").write_bytes(b"hello")
+    (root / "a" / "x.bin").write_bytes(b"\xff\xd8\xff\xe0")
+    (root / "b" / "y.png").write_bytes(b"")
+    expected = [str(root / "noext"), str(root / "z.jpg"), str(root / "a" / "x.bin"), str(root / "b" / "y.png")]
+    manifest = str(tmp_path / "manifest.json")
+    # ディレクトリ内は名前順、ファイル→サブディレクトリの深さ優先 (os.walk のトップダウン順)
+    assert list(scan_images(str(root), manifest_path=manifest)) == expected
+
+    s = Scanner(manifest_path=manifest)
+    assert list(s.scan(str(root))) == expected
+    assert s.dirs_reused == 3 and s.files_probed == 0
+
+    # エントリが増えたディレクトリだけ再走査
+    (root / "a" / "w.gif").write_bytes(b"GIF89a")
+    s = Scanner(manifest_path=manifest)
+    assert str(root / "a" / "w.gif") in list(s.scan(str(root)))
+    assert s.dirs_scanned == 1
+
+
+def test_folder_order_lists_files_before_subdirectories(tmp_path):
+    for rel in ("b.jpg", "a/x.jpg", "a/c/y.jpg", "a/z.jpg"):
+        (tmp_path / rel).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / rel).write_bytes(b"")
+    order = [os.path.relpath(p, tmp_path) for p in background(iter_images(str(tmp_path), scan_workers=1))]
+    # --folder はパス全体の sorted() ではなく、ディレクトリ単位で走査した順に解析へ渡す
+    assert order == ["b.jpg", os.path.join("a", "x.jpg"), os.path.join("a", "z.jpg"), os.path.join("a", "c", "y.jpg")]
+
+
+def test_background_propagates_errors():
+    def gen():
+        yield "a"
+        raise RuntimeError("boom")
+    it = background(gen())
+    assert next(it) == "a"
+    try:
+        next(it)
+    except RuntimeError as e:
+        assert str(e) == "boom"
+    else:
+        raise AssertionError("expected error")
@@ -0,0 +1,69 @@
+import io
+import threading
+
+import pytest
+from PIL import Image
+
+from twins_recognition import cache as cache_module
+from twins_recognition.processor import AnalyzeOptions
+from twins_recognition.server import MicroBatcher, ServerBusy, create_app
+
+
+def _png(shade: int = 160) -> bytes:
+    buf = io.BytesIO()
+    Image.new("RGB", (48, 32), (200, 180, shade)).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def test_concurrent_requests_are_coalesced_into_micro_batches():
+    batcher = MicroBatcher(workers=1, max_batch=8, max_wait_ms=300, mode="thread").start(preload=False)
+    client = create_app(batcher).test_client()
+    responses = []
+
+    def call(i):
+        r = client.post(f"/v1/analyze?name=img{i}.png", data=_png(), content_type="image/png")
+        responses.append((r.status_code, r.get_json()))
+
+    try:
+        threads = [threading.Thread(target=call, args=(i,)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(30)
+        bad = client.post("/v1/analyze", data=b"not an image", content_type="application/octet-stream")
+        snap = batcher.snapshot()
+    finally:
+        batcher.shutdown()
+    assert sorted(body["path"] for _, body in responses) == [f"img{i}.png" for i in range(4)]
+    assert all(status == 200 and body["classification"]["label"] == "no_face" for status, body in responses)
+    assert snap["batches"] < 5 and snap["batched_images"] == 5   # 4枚は期限内にまとまる
+    assert bad.status_code == 422 and "error" in bad.get_json()
+
+
+def test_queue_limit_rejects_with_busy():
+    batcher = MicroBatcher(workers=1, max_queue=2, mode="thread")   # 未起動なので要求は溜まったまま
+    batcher.submit("a.png", b"x")
+    with pytest.raises(ServerBusy):
+        batcher.submit_many([("b.png", b"x"), ("c.png", b"x")])
+    batcher.submit("b.png", b"x")
+    r = create_app(batcher).test_client().post("/v1/analyze", data=_png(), content_type="image/png")
+    assert r.status_code == 429 and r.headers["Retry-After"] == "1"
+    assert batcher.snapshot()["rejected"] == 3
+
+
+def test_thread_workers_share_the_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache_module, "_CACHES", {})
+    options = AnalyzeOptions(cache_dir=str(tmp_path / "cache"))
+    batcher = MicroBatcher(workers=3, max_batch=1, max_wait_ms=0, mode="thread", options=options).start(preload=False)
+    try:
+        for _ in range(2):   # 2巡目はキャッシュから
+            futures = batcher.submit_many([(f"img{i}.png", _png(100 + i)) for i in range(6)])
+            results = [f.result(30) for f in futures]
+            assert [error for _, error in results] == [None] * 6
+            assert [a.classification.label for a, _ in results] == ["no_face"] * 6
+    finally:
+        batcher.shutdown()
+    assert len(cache_module._CACHES) == 1
+    cache = options.cache()
+    assert cache.hits >= 6
+    cache.close()
@@ -0,0 +1,57 @@
+import random
+import statistics
+
+from twins_recognition.stats import BIN_WIDTH, RunningSummary, StageStats
+
+
+def test_running_summary_matches_exact_statistics():
+    rng = random.Random(0)
+    for n in (1, 2, 7, 1000):
+        dists = [rng.uniform(0.2, 0.9) for _ in range(n)]
+        s = RunningSummary()
+        for d in dists:
+            s.add("different", d)
+        s.add("no_face", None)
+        s.add_error()
+        assert abs(s.mean - statistics.mean(dists)) < 1e-9
+        assert abs(s.median - statistics.median(dists)) <= BIN_WIDTH
+        assert s.counts == {"different": n, "no_face": 1}
+        assert s.total == n + 1 and s.errors == 1
+
+
+def test_running_summary_merge():
+    a, b = RunningSummary(), RunningSummary()
+    a.add("twins", 0.3)
+    b.add("twins", 0.5)
+    b.add("siblings", 0.5)
+    a.merge(b)
+    assert a.counts == {"twins": 2, "siblings": 1}
+    assert abs(a.median - 0.5) <= BIN_WIDTH
+
+
+def test_stage_stats_merge_and_rates():
+    a, b = StageStats(), StageStats()
+    a.add("encode", 2.0, 4)
+    b.add("encode", 2.0, 4)
+    b.add("decode", 0.5, 5)
+    b.faces = 3
+    a.merge(b)
+    d = a.to_dict()
+    assert list(d["stages"]) == ["decode", "encode"]
+    enc = d["stages"]["encode"]
+    assert (enc["images"], enc["seconds"], enc["images_per_sec"]) == (8, 4.0, 2.0)
+    # 1枚 0.5 秒 (対数ビンの推定誤差内)
+    assert abs(enc["p50_ms"] - 500) < 60 and abs(enc["p99_ms"] - 500) < 60
+    assert d["faces"] == 3
+
+
+def test_stage_stats_prometheus():
+    s = StageStats()
+    s.add("detect", 0.02, 1)
+    s.add("detect", 0.2, 1)
+    lines = s.prometheus()
+    assert '# TYPE twins_stage_seconds histogram' in lines
+    assert 'twins_stage_seconds_bucket{stage="detect",le="+Inf"} 2' in lines
+    assert 'twins_stage_seconds_count{stage="detect"} 2' in lines
+    counts = [int(l.rsplit(" ", 1)[1]) for l in lines if l.startswith("twins_stage_seconds_bucket")]
+    assert counts == sorted(counts)   # 累積
@@ -0,0 +1,97 @@
+import io
+import json
+
+import numpy as np
+import pytest
+
+from twins_recognition.classifier import classify_embeddings
+from twins_recognition.processor import ImageAnalysis
+from twins_recognition.store import LABELS, EmbeddingStore, sorted_indices, summarize, write_json_array
+
+
+def make_analysis(path, n, seed=0):
+    embs = np.random.default_rng(seed).normal(scale=0.1, size=(n, 128)).astype(np.float32)
+    faces = [(i, i + 10, i + 10, i) for i in range(n)]
+    return ImageAnalysis(path=path, faces=faces, embeddings_count=n,
+                         classification=classify_embeddings(embs), embeddings=embs)
+
+
+def test_store_roundtrip_matches_to_dict(tmp_path):
+    analyses = [make_analysis(f"/img/{n}.jpg", n, seed=n) for n in (0, 1, 2, 3)]
+    with EmbeddingStore(str(tmp_path / "s"), flush_every=2) as store:
+        for a in analyses[:2]:
+            store.append(a)
+        store.append_error("/img/bad.jpg", "broken")
+        for a in analyses[2:]:
+            store.append(a)
+
+    store = EmbeddingStore(str(tmp_path / "s"))
+    assert store.n_images == 5 and store.n_faces == 6
+    records = list(store.iter_records())
+    expected = [a.to_dict() for a in analyses]
+    assert records[:2] + records[3:] == expected
+    assert records[2] == {"path": "/img/bad.jpg", "error": "broken"}
+    assert np.array_equal(store.image_embeddings(4), analyses[3].embeddings)
+
+    for indent in (None, 2):
+        buf = io.StringIO()
+        write_json_array(iter(records), buf, indent=indent)
+        assert buf.getvalue() == json.dumps(records, ensure_ascii=False, indent=indent)
+
+    summary = summarize(store)
+    assert summary["total"] == 4
+    assert summary["counts"] == {"no_face": 1, "single_person": 1, "different": 2}
+
+
+def test_store_truncates_unflushed_tail(tmp_path):
+    store = EmbeddingStore(str(tmp_path / "s"), dtype="float16", flush_every=1000)
+    store.append(make_analysis("/img/a.jpg", 2))
+    store.flush()
+    store.append(make_analysis("/img/b.jpg", 2))
+    # flush 前に途中まで書かれた状態を再現
+    with open(tmp_path / "s" / "embeddings.bin", "ab") as f:
+        f.write(b"\0" * 100)
+    reopened = EmbeddingStore(str(tmp_path / "s"))
+    assert reopened.n_images == 1
+    assert reopened.embeddings.dtype == np.float16 and reopened.embeddings.shape == (2, 128)
+
+
+def test_readonly_store_leaves_writer_tail(tmp_path):
+    root = tmp_path / "s"
+    writer = EmbeddingStore(str(root), flush_every=1000)
+    writer.append(make_analysis("/img/a.jpg", 2))
+    writer.flush()
+    # 書き込み中 (meta.json 未確定) の追記と途中までの行を再現
+    with open(root / "embeddings.bin", "ab") as f:
+        f.write(b"\0" * 100)
+    with open(root / "paths.jsonl", "a", encoding="utf-8") as f:
+        f.write('"/img/b.j')
+    meta = (root / "meta.json").read_bytes()
+    size = (root / "embeddings.bin").stat().st_size
+    reader = EmbeddingStore(str(root), readonly=True)
+    assert reader.n_images == 1 and reader.paths == ["/img/a.jpg"]
+    assert reader.image_faces(0) == writer.record(0)["faces"]
+    assert (root / "meta.json").read_bytes() == meta
+    assert (root / "embeddings.bin").stat().st_size == size
+    with pytest.raises(ValueError):
+        reader.append(make_analysis("/img/c.jpg", 1))
+    with pytest.raises(FileNotFoundError):
+        EmbeddingStore(str(tmp_path / "missing"), readonly=True)
+    assert not (tmp_path / "missing").exists()
+
+
+def test_sorted_indices_by_label_and_distance(tmp_path):
+    with EmbeddingStore(str(tmp_path / "s")) as store:
+        for i, n in enumerate((2, 0, 2, 1, 2)):
+            store.append(make_analysis(f"/img/{i}.jpg", n, seed=i))
+        store.append_error("/img/bad.jpg", "broken")
+    dist = np.asarray(store.column("image_distance"))
+    pairs = [0, 2, 4]
+    by_dist = sorted(pairs, key=lambda i: dist[i])
+    assert sorted_indices(store).tolist() == [0, 1, 2, 3, 4]
+    assert sorted_indices(store, "index", descending=True).tolist() == [4, 3, 2, 1, 0]
+    # 距離の無い画像 (顔1つ/顔なし) は昇順でも降順でも末尾
+    assert sorted_indices(store, "distance").tolist() == by_dist + [1, 3]
+    assert sorted_indices(store, "distance", descending=True).tolist() == by_dist[::-1] + [1, 3]
+    labels = [store.record(int(i))["classification"]["label"] for i in sorted_indices(store, "label")]
+    assert labels == sorted(labels, key=LABELS.index)
@@ -0,0 +1,54 @@
+import os
+import time
+
+from PIL import Image
+
+from twins_recognition.thumbs import ThumbnailCache, render_thumbnail, thumb_key
+
+
+def test_thumbnail_cache_shares_rendered_images(tmp_path):
+    src = tmp_path / "big.jpg"
+    Image.new("RGB", (2000, 1000), (0, 128, 0)).save(src)
+    faces = [(100, 600, 500, 200)]
+    cache = ThumbnailCache(str(tmp_path / "cache"), workers=2)
+    try:
+        a = cache.submit(str(src), str(tmp_path / "b1" / "big.jpg.thumb.jpg"), faces).result(30)
+        # 同じ内容・同じ顔枠は別の出力先でもキャッシュから用意される
+        b = cache.get(str(src), str(tmp_path / "b2" / "big.jpg.thumb.jpg"), faces)
+    finally:
+        cache.shutdown()
+    with Image.open(a) as im:
+        assert im.size == (320, 160)
+        # 顔枠は縮小後の座標に描かれる (左上 (32, 16))
+        r, g, _ = im.getpixel((32, 40))
+        assert r > 150 and g < 100
+        assert im.getpixel((10, 40))[1] > 100
+    with open(a, "rb") as fa, open(b, "rb") as fb:
+        assert fa.read() == fb.read()
+    cached = [f for _, _, fs in os.walk(tmp_path / "cache") for f in fs]
+    assert len(cached) == 1
+    assert cache.snapshot_stats().images["thumbnail"] == 1   # 描画は1回だけ
+    assert render_thumbnail(str(src))[:2] == b"\xff\xd8"
+
+
+def test_thumbnail_cache_sweep_by_age_and_size(tmp_path):
+    cache = ThumbnailCache(str(tmp_path / "cache"), workers=1)
+    try:
+        paths = []
+        for i in range(4):
+            src = tmp_path / f"s{i}.png"
+            Image.new("RGB", (64, 64), (i * 40, 0, 0)).save(src)
+            cache.ensure(str(src), str(tmp_path / "batch" / f"s{i}.thumb.jpg"))
+            paths.append(cache._cache_path(thumb_key(str(src), None, cache.size)))
+    finally:
+        cache.shutdown()
+    old = time.time() - 3 * 86400
+    for k, p in enumerate(paths):
+        os.utime(p, (old + k, old + k))
+    os.utime(paths[3])   # 最近使った
+    assert cache.sweep(max_age=86400) == 3
+    assert [os.path.exists(p) for p in paths] == [False, False, False, True]
+    # 表示中のバッチのサムネイルは残る
+    assert os.path.exists(tmp_path / "batch" / "s0.thumb.jpg")
+    cache.max_bytes = 0
+    assert cache.sweep() == 1 and not os.path.exists(paths[3])
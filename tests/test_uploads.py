@@ -0,0 +1,57 @@
+import io
+import os
+
+import pytest
+
+from twins_recognition.uploads import UploadTooLarge, ingest_multipart, safe_name
+
+BOUNDARY = b"----twinsboundary"
+
+
+def _body(parts) -> io.BytesIO:
+    out = io.BytesIO()
+    for name, filename, data in parts:
+        out.write(b"--" + BOUNDARY + b"\r\n")
+        disp = f'form-data; name="{name}"' + (f'; filename="{filename}"' if filename is not None else "")
+        out.write(f"Content-Disposition: {disp}\r\n".encode())
+        if filename is not None:
+            out.write(b"Content-Type: application/octet-stream\r\n")
+        out.write(b"\r\n" + data + b"\r\n")
+    out.write(b"--" + BOUNDARY + b"--\r\n")
+    out.seek(0)
+    return out
+
+
+def test_small_files_stay_in_memory_and_large_ones_spill(tmp_path):
+    small, large = b"a" * 1000, os.urandom(300 * 1024)
+    body = _body([("files", "small.jpg", small), ("files", "dir/large.jpg", large)])
+    uploads, _ = ingest_multipart(body, BOUNDARY, str(tmp_path), spill_bytes=100 * 1024)
+    assert [u.name for u in uploads] == ["small.jpg", "large.jpg"]
+    assert uploads[0].data == small and not uploads[0].stored
+    assert not (tmp_path / "small.jpg").exists()
+    assert uploads[1].data is None and uploads[1].stored
+    assert (tmp_path / "large.jpg").read_bytes() == large
+
+
+def test_keep_originals_field_writes_following_files(tmp_path):
+    body = _body([("keep_originals", None, b"1"), ("files", "a.jpg", b"x" * 10), ("files", "a.jpg", b"y" * 10)])
+    uploads, fields = ingest_multipart(body, BOUNDARY, str(tmp_path))
+    assert fields["keep_originals"] == "1"
+    assert [u.name for u in uploads] == ["a.jpg", "a_1.jpg"]
+    assert all(u.stored and u.data is not None for u in uploads)
+    assert (tmp_path / "a_1.jpg").read_bytes() == b"y" * 10
+
+
+def test_per_file_limit(tmp_path):
+    body = _body([("files", "big.jpg", b"z" * 5000)])
+    with pytest.raises(UploadTooLarge):
+        ingest_multipart(body, BOUNDARY, str(tmp_path), max_file_bytes=1000)
+
+
+def test_safe_name():
+    taken = set()
+    assert safe_name("../../etc/passwd", taken) == "passwd"
+    assert safe_name("C:\\photos\\x.jpg", taken) == "x.jpg"
+    assert safe_name("thumbs", taken) == "thumbs_1"
+    assert safe_name(".hidden", taken) is None
+    assert safe_name("", taken) is None
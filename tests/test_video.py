@@ -0,0 +1,49 @@
+import numpy as np
+
+from twins_recognition.video import FaceTracker, VideoStats, iter_frames
+
+
+def _embed_from(table):
+    calls = []
+
+    def embed(boxes):
+        calls.append(list(boxes))
+        return np.stack([table[b[3] // 100] for b in boxes])  # left 座標の百の位で人物を決める
+    return embed, calls
+
+
+def test_tracker_encodes_once_per_track_and_classifies_cooccurring():
+    rng = np.random.default_rng(0)
+    a = rng.normal(size=128).astype(np.float32)
+    a /= np.linalg.norm(a) * 2
+    table = {0: a, 1: a + 0.01, 3: -a}
+    embed, calls = _embed_from(table)
+    tracker = FaceTracker(iou_threshold=0.3, max_age=1)
+    closed = []
+    for frame in range(4):
+        # 2人が少しずつ動く
+        boxes = [(10, 50 + frame, 50, frame), (10, 150 + frame, 50, 100 + frame)]
+        closed += tracker.update(frame, frame / 10, boxes, embed)
+    closed += tracker.update(4, 0.4, [(10, 340, 50, 300)], embed)
+    closed += tracker.close_all()
+
+    assert [len(c) for c in calls] == [2, 1]          # 各トラックは開始時に1回だけエンコード
+    by_id = {t.track_id: t for t in closed}
+    assert by_id[0].hits == 4 and by_id[0].nearest_track == 1
+    assert by_id[0].classification.label == "twins"
+    # 単独で映ったトラックは比較相手が無い
+    assert by_id[2].classification.label == "single_person"
+
+
+def test_iter_frames_stride(tmp_path):
+    import cv2
+    path = str(tmp_path / "v.avi")
+    vw = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), 10, (32, 24))
+    for i in range(10):
+        vw.write(np.full((24, 32, 3), i * 20, dtype=np.uint8))
+    vw.release()
+    stats = VideoStats()
+    frames = list(iter_frames(path, stride=3, stats=stats))
+    assert [i for i, _, _ in frames] == [0, 3, 6, 9]
+    assert frames[0][2].shape == (24, 32, 3)
+    assert stats.frames_read == 10 and stats.frames_decoded == 4